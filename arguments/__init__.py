@@ -56,7 +56,7 @@ class ParamGroup:
 
 class GuidanceParams(ParamGroup):
     def __init__(self, parser, opts=None):
-        self.guidance = "SD"        
+        self.guidance = "SD" # "SD" (SDXL) or "stub" (tiny random models, runs on CPU, for benchmarking the loop)
         self.g_device = "cuda"
 
         self.model_key = None
@@ -69,8 +69,17 @@ class GuidanceParams(ParamGroup):
         self.negative_w = -2.
         self.front_decay_factor = 2.
         self.side_decay_factor = 10.   
+        self.view_embedding_bins = 361 # azimuth grid of the precomputed view-dependent prompt embeddings
         
         self.vram_O = False
+        self.vae_encoder = "full" # "full": fp32 SDXL VAE, "fp16": fp16-fix VAE, "tiny": TAESDXL encoder (decoding keeps the full VAE)
+        self.vae_fp16_key = "madebyollin/sdxl-vae-fp16-fix"
+        self.tiny_vae_key = "madebyollin/taesdxl"
+        self.tiny_vae_until_iter = None # with "tiny", switch to the full encoder from this iteration on; None keeps the tiny one
+        self.vae_encode_mode = "checkpoint" # "checkpoint": recompute the encoder per micro-batch in backward (exact), "tiled": overlapping checkpointed tiles (approximate with the SDXL VAE's GroupNorm / attention), "default": no recompute
+        self.vae_encode_batch = 1 # images per checkpointed encoder call ("checkpoint")
+        self.vae_tile_size = 512 # image-space tile size ("tiled")
+        self.vae_tile_overlap = 128 # image-space overlap blended between neighbouring tiles ("tiled")
         self.fp16 = True
         self.hf_key = None
         self.t_range = [0.02, 0.5]     
@@ -91,6 +100,7 @@ class GuidanceParams(ParamGroup):
         self.inverse_text = ''
         self.textual_inversion_path = None
         self.LoRA_path = None
+        self.embedding_cache_dir = None # e.g. "pretrained/text_embeddings"; None disables the prompt embedding cache
         self.controlnet_ratio = 0.5
         self.negative = ""
         self.guidance_scale = 7.5
@@ -104,8 +114,16 @@ class GuidanceParams(ParamGroup):
 
         # multi-batch
         self.C_batch_size = 1
+        self.unet_max_batch = 0 # largest UNet micro-batch when independent evaluations are batched, 0 for no limit
+        self.per_view_timesteps = False # draw t (and prev_t, mu_t) independently for every view of a batch
 
         self.vis_interval = 100
+        self.vis_mode = "vae" # "vae" decodes the predicted x0 panels, "latent" previews them with rgb_latent_factors (no decode)
+        self.vis_async = True # build and save the visualization grid on a background worker
+        self.vis_block = False # wait for the worker when it falls behind instead of dropping visualizations
+
+        self.profile = False # time the training / guidance phases and count UNet forwards, reported to tensorboard
+        self.profile_interval = 100
 
         super().__init__(parser, "Guidance Model Parameters")
 
@@ -124,6 +142,8 @@ class ModelParams(ParamGroup):
         self.data_device = "cuda"
         self.eval = False
         self.opt_path = None
+        self.rgb_dump = "txt" # xyz/rgb dump saved with each ply: "txt" (point_cloud_rgb.txt), "npy" (binary, faster) or "none"
+        self.camera_prefetch = 0 # random camera batches sampled ahead on a worker thread, 0 samples them in the loop
         
         # augmentation
         self.sh_deg_aug_ratio = 0.1
@@ -143,6 +163,7 @@ class PipelineParams(ParamGroup):
         self.convert_SHs_python = False
         self.compute_cov3D_python = False
         self.debug = False
+        self.rasterizer = "cuda" # "cuda" (diff_gaussian_rasterization) or "torch" (pure PyTorch, any device)
         super().__init__(parser, "Pipeline Parameters")
 
 
@@ -185,6 +206,8 @@ class OptimizationParams(ParamGroup):
         self.opacity_reset_interval = 300
         self.densify_from_iter = 100
         self.densify_until_iter = 30_00 
+        self.pooled_densification = False # keep points in preallocated buffers that densification writes into
+        self.pool_growth_factor = 1.5 # spare capacity reserved whenever a pooled buffer has to grow
         
         self.use_control_net_iter = 10000000 
         self.warmup_iter = 1500 
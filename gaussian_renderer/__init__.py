@@ -11,27 +11,75 @@
 
 import torch
 import math
-from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+try:
+    from diff_gaussian_rasterization import GaussianRasterizationSettings, GaussianRasterizer
+except ImportError:
+    GaussianRasterizationSettings = GaussianRasterizer = None
+from gaussian_renderer import torch_rasterizer
 from scene.gaussian_model import GaussianModel
 from utils.sh_utils import eval_sh, SH2RGB
 from utils.graphics_utils import fov2focal
 import random
 
 
-def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, black_video = False,
-           override_color = None, sh_deg_aug_ratio = 0.1, bg_aug_ratio = 0.3, shs_aug_ratio=1.0, scale_aug_ratio=1.0, test = False):
+def get_rasterizer(pipe):
+    # "cuda" is the diff_gaussian_rasterization extension, "torch" the pure PyTorch reference
+    backend = pipe.rasterizer
+    if backend == "torch":
+        return torch_rasterizer.GaussianRasterizationSettings, torch_rasterizer.GaussianRasterizer
+    if backend != "cuda":
+        raise ValueError("Unknown rasterizer backend: {}".format(backend))
+    if GaussianRasterizer is None:
+        raise ImportError("diff_gaussian_rasterization is not installed, set the pipeline rasterizer to 'torch'")
+    return GaussianRasterizationSettings, GaussianRasterizer
+
+def get_render_attributes(pc : GaussianModel, pipe, scaling_modifier = 1.0, override_color = None):
     """
-    Render the scene. 
-    
-    Background tensor (bg_color) must be on GPU!
+    Activated Gaussian attributes shared by every view rendered in the same step.
+    """
+    attributes = {"means3D": pc.get_xyz, "opacity": pc.get_opacity}
+
+    # If precomputed 3d covariance is provided, use it. If not, then it will be computed from
+    # scaling / rotation by the rasterizer.
+    attributes["scales"] = None
+    attributes["rotations"] = None
+    attributes["cov3D_precomp"] = None
+    if pipe.compute_cov3D_python:
+        attributes["cov3D_precomp"] = pc.get_covariance(scaling_modifier)
+    else:
+        attributes["scales"] = pc.get_scaling
+        attributes["rotations"] = pc.get_rotation
+
+    # If precomputed colors are provided, use them. Otherwise, if it is desired to precompute colors
+    # from SHs in Python, do it. If not, then SH -> RGB conversion will be done by rasterizer.
+    shs = None
+    colors_precomp = None
+    if colors_precomp is None:
+        if pipe.convert_SHs_python:
+            raw_rgb = pc.get_features.transpose(1, 2).view(-1, 3, (pc.max_sh_degree+1)**2).squeeze()[:,:3]
+            rgb = torch.sigmoid(raw_rgb)
+            colors_precomp = rgb
+        else:
+            shs = pc.get_features
+    else:
+        colors_precomp = override_color
+    attributes["shs"] = shs
+    attributes["colors_precomp"] = colors_precomp
+    return attributes
+
+def rasterize_view(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, attributes, scaling_modifier = 1.0, black_video = False,
+                   sh_deg_aug_ratio = 0.1, bg_aug_ratio = 0.3, shs_aug_ratio=1.0, scale_aug_ratio=1.0, test = False, screenspace_points = None):
+    """
+    Render one view from precomputed attributes (see get_render_attributes).
     """
  
     # Create zero tensor. We will use it to make pytorch return gradients of the 2D (screen-space) means
-    screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device="cuda") + 0
-    try:
-        screenspace_points.retain_grad()
-    except:
-        pass
+    if screenspace_points is None:
+        screenspace_points = torch.zeros_like(pc.get_xyz, dtype=pc.get_xyz.dtype, requires_grad=True, device=pc.get_xyz.device) + 0
+        try:
+            screenspace_points.retain_grad()
+        except:
+            pass
 
     if black_video:
         bg_color = torch.zeros_like(bg_color)
@@ -52,8 +100,9 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
     # Set up rasterization configuration
     tanfovx = math.tan(viewpoint_camera.FoVx * 0.5)
     tanfovy = math.tan(viewpoint_camera.FoVy * 0.5)
+    RasterizationSettings, Rasterizer = get_rasterizer(pipe)
     try:
-        raster_settings = GaussianRasterizationSettings(
+        raster_settings = RasterizationSettings(
             image_height=int(viewpoint_camera.image_height),
             image_width=int(viewpoint_camera.image_width),
             tanfovx=tanfovx,
@@ -67,7 +116,7 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             prefiltered=False
         )
     except TypeError as e:
-        raster_settings = GaussianRasterizationSettings(
+        raster_settings = RasterizationSettings(
             image_height=int(viewpoint_camera.image_height),
             image_width=int(viewpoint_camera.image_width),
             tanfovx=tanfovx,
@@ -83,36 +132,11 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
         )
 
 
-    rasterizer = GaussianRasterizer(raster_settings=raster_settings)
+    rasterizer = Rasterizer(raster_settings=raster_settings)
 
-    means3D = pc.get_xyz
     means2D = screenspace_points
-    opacity = pc.get_opacity
-
-    # If precomputed 3d covariance is provided, use it. If not, then it will be computed from
-    # scaling / rotation by the rasterizer.
-    scales = None
-    rotations = None
-    cov3D_precomp = None
-    if pipe.compute_cov3D_python:
-        cov3D_precomp = pc.get_covariance(scaling_modifier)
-    else:
-        scales = pc.get_scaling
-        rotations = pc.get_rotation
-
-    # If precomputed colors are provided, use them. Otherwise, if it is desired to precompute colors
-    # from SHs in Python, do it. If not, then SH -> RGB conversion will be done by rasterizer.
-    shs = None
-    colors_precomp = None
-    if colors_precomp is None:
-        if pipe.convert_SHs_python:
-            raw_rgb = pc.get_features.transpose(1, 2).view(-1, 3, (pc.max_sh_degree+1)**2).squeeze()[:,:3]
-            rgb = torch.sigmoid(raw_rgb)
-            colors_precomp = rgb
-        else:
-            shs = pc.get_features
-    else:
-        colors_precomp = override_color
+    shs = attributes["shs"]
+    scales = attributes["scales"]
 
     if random.random() < shs_aug_ratio and not test:
         variance = (0.2 ** 0.5) * shs
@@ -126,14 +150,14 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
     # Rasterize visible Gaussians to image, obtain their radii (on screen).
 
     rendered_image, radii, depth_alpha = rasterizer(
-        means3D = means3D,
+        means3D = attributes["means3D"],
         means2D = means2D,
         shs = shs,
-        colors_precomp = colors_precomp,
-        opacities = opacity,
+        colors_precomp = attributes["colors_precomp"],
+        opacities = attributes["opacity"],
         scales = scales,
-        rotations = rotations,
-        cov3D_precomp = cov3D_precomp)
+        rotations = attributes["rotations"],
+        cov3D_precomp = attributes["cov3D_precomp"])
     depth, alpha = torch.chunk(depth_alpha, 2)
     # bg_train = pc.get_background
     # rendered_image = bg_train*alpha.repeat(3,1,1) + rendered_image
@@ -176,3 +200,36 @@ def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor,
             "visibility_filter" : radii > 0,
             "radii": radii,
             "scales": scales}
+
+
+def render(viewpoint_camera, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, black_video = False,
+           override_color = None, sh_deg_aug_ratio = 0.1, bg_aug_ratio = 0.3, shs_aug_ratio=1.0, scale_aug_ratio=1.0, test = False):
+    """
+    Render the scene. 
+    
+    Background tensor (bg_color) must be on GPU!
+    """
+    attributes = get_render_attributes(pc, pipe, scaling_modifier, override_color)
+    return rasterize_view(viewpoint_camera, pc, pipe, bg_color, attributes, scaling_modifier, black_video,
+                          sh_deg_aug_ratio, bg_aug_ratio, shs_aug_ratio, scale_aug_ratio, test)
+
+def render_batch(viewpoint_cameras, pc : GaussianModel, pipe, bg_color : torch.Tensor, scaling_modifier = 1.0, black_video = False,
+                 override_color = None, sh_deg_aug_ratio = 0.1, bg_aug_ratio = 0.3, shs_aug_ratio=1.0, scale_aug_ratio=1.0, test = False):
+    """
+    Render several views of the scene, activating the Gaussian attributes once.
+
+    Returns the per-view outputs of render stacked along a leading camera dimension.
+    "viewspace_points" is a single (C, P, 3) leaf whose gradient holds every view.
+    Augmentations are still drawn independently for every view.
+    """
+    attributes = get_render_attributes(pc, pipe, scaling_modifier, override_color)
+    screenspace_points = torch.zeros((len(viewpoint_cameras),) + tuple(pc.get_xyz.shape), dtype=pc.get_xyz.dtype,
+                                     requires_grad=True, device=pc.get_xyz.device)
+    outputs = [rasterize_view(viewpoint_camera, pc, pipe, bg_color, attributes, scaling_modifier, black_video,
+                              sh_deg_aug_ratio, bg_aug_ratio, shs_aug_ratio, scale_aug_ratio, test, screenspace_points[i])
+               for i, viewpoint_camera in enumerate(viewpoint_cameras)]
+
+    render_pkg = {"viewspace_points": screenspace_points}
+    for key in ["render", "depth", "alpha", "visibility_filter", "radii", "scales"]:
+        render_pkg[key] = torch.stack([out[key] for out in outputs], dim=0)
+    return render_pkg
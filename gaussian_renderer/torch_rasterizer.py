@@ -0,0 +1,228 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+# Pure PyTorch reference of diff_gaussian_rasterization: same settings, inputs and outputs
+# (color, radii, depth/transmittance), backward through autograd. Runs on any device.
+
+import torch
+from typing import NamedTuple
+from torch import nn
+from torch.utils.checkpoint import checkpoint
+from utils.sh_utils import eval_sh
+from utils.general_utils import build_scaling_rotation
+
+BLOCK_X, BLOCK_Y = 16, 16
+
+class GaussianRasterizationSettings(NamedTuple):
+    image_height: int
+    image_width: int
+    tanfovx : float
+    tanfovy : float
+    bg : torch.Tensor
+    scale_modifier : float
+    viewmatrix : torch.Tensor
+    projmatrix : torch.Tensor
+    sh_degree : int
+    campos : torch.Tensor
+    prefiltered : bool
+    debug : bool = False
+
+def ndc2pix(v, S):
+    return ((v + 1.0) * S - 1.0) * 0.5
+
+def preprocess(means3D, means2D, opacities, shs, colors_precomp, scales, rotations, cov3D_precomp, raster_settings):
+    # Per-Gaussian projection, 2D conic, screen radius and color, as in preprocessCUDA
+    H, W = raster_settings.image_height, raster_settings.image_width
+    tanfovx, tanfovy = raster_settings.tanfovx, raster_settings.tanfovy
+    focal_x, focal_y = W / (2.0 * tanfovx), H / (2.0 * tanfovy)
+    viewmatrix, projmatrix = raster_settings.viewmatrix, raster_settings.projmatrix
+
+    hom = torch.cat([means3D, torch.ones_like(means3D[:, :1])], dim=1)
+    p_view = hom @ viewmatrix
+    p_hom = hom @ projmatrix
+    p_proj = p_hom[:, :2] / (p_hom[:, 3:4] + 0.0000001)
+
+    # near culling; culled rows get harmless values so they cannot leak nans into the backward pass
+    in_frustum = p_view[:, 2] > 0.2
+    tz = torch.where(in_frustum, p_view[:, 2], torch.ones_like(p_view[:, 2]))
+
+    if cov3D_precomp is not None:
+        c = cov3D_precomp
+        cov3D = torch.stack([c[:, 0], c[:, 1], c[:, 2],
+                             c[:, 1], c[:, 3], c[:, 4],
+                             c[:, 2], c[:, 4], c[:, 5]], dim=1).view(-1, 3, 3)
+    else:
+        L = build_scaling_rotation(raster_settings.scale_modifier * scales, rotations)
+        cov3D = L @ L.transpose(1, 2)
+
+    # EWA splatting with the same frustum clamp and low-pass filter as computeCov2D
+    limx, limy = 1.3 * tanfovx, 1.3 * tanfovy
+    tx = (p_view[:, 0] / tz).clamp(-limx, limx) * tz
+    ty = (p_view[:, 1] / tz).clamp(-limy, limy) * tz
+    zeros = torch.zeros_like(tz)
+    J = torch.stack([focal_x / tz, zeros, -(focal_x * tx) / (tz * tz),
+                     zeros, focal_y / tz, -(focal_y * ty) / (tz * tz)], dim=1).view(-1, 2, 3)
+    M = J @ viewmatrix[:3, :3].t()
+    cov2D = M @ cov3D @ M.transpose(1, 2)
+    a, b, c = cov2D[:, 0, 0] + 0.3, cov2D[:, 0, 1], cov2D[:, 1, 1] + 0.3
+
+    det = a * c - b * b
+    valid = torch.logical_and(in_frustum, det != 0)
+    det = torch.where(valid, det, torch.ones_like(det))
+    conic = torch.stack([c / det, -b / det, a / det], dim=1)
+
+    xy = torch.stack([ndc2pix(p_proj[:, 0] + means2D[:, 0], W), ndc2pix(p_proj[:, 1] + means2D[:, 1], H)], dim=1)
+
+    with torch.no_grad():
+        mid = 0.5 * (a + c)
+        lambda1 = mid + torch.sqrt(torch.clamp_min(mid * mid - det, 0.1))
+        radius = torch.ceil(3.0 * torch.sqrt(lambda1))
+        grid_x, grid_y = (W + BLOCK_X - 1) // BLOCK_X, (H + BLOCK_Y - 1) // BLOCK_Y
+        rect_min_x = ((xy[:, 0] - radius) / BLOCK_X).trunc().clamp(0, grid_x).long()
+        rect_min_y = ((xy[:, 1] - radius) / BLOCK_Y).trunc().clamp(0, grid_y).long()
+        rect_max_x = ((xy[:, 0] + radius + BLOCK_X - 1) / BLOCK_X).trunc().clamp(0, grid_x).long()
+        rect_max_y = ((xy[:, 1] + radius + BLOCK_Y - 1) / BLOCK_Y).trunc().clamp(0, grid_y).long()
+        valid = torch.logical_and(valid, (rect_max_x - rect_min_x) * (rect_max_y - rect_min_y) != 0)
+        radii = torch.where(valid, radius, torch.zeros_like(radius)).int()
+        rect = torch.stack([rect_min_x, rect_min_y, rect_max_x, rect_max_y], dim=1)
+
+    if colors_precomp is not None:
+        colors = colors_precomp
+    else:
+        dirs = means3D - raster_settings.campos
+        dirs = dirs / dirs.norm(dim=1, keepdim=True)
+        colors = torch.clamp_min(eval_sh(raster_settings.sh_degree, shs.transpose(1, 2), dirs) + 0.5, 0.0)
+
+    return xy, conic, opacities.view(-1), colors, p_view[:, 2], radii, rect
+
+@torch.no_grad()
+def bin_gaussians(depths, radii, rect, grid_x, grid_y):
+    # Duplicate every visible Gaussian into each tile it touches, sorted by tile then depth.
+    # Returns the flat Gaussian list and the start/count of every tile inside it.
+    idx = torch.nonzero(radii > 0).squeeze(1)
+    idx = idx[torch.argsort(depths[idx])]
+    rect = rect[idx]
+    width = rect[:, 2] - rect[:, 0]
+    touched = width * (rect[:, 3] - rect[:, 1])
+
+    point_ids = torch.repeat_interleave(idx, touched)
+    first = torch.repeat_interleave(torch.cumsum(touched, 0) - touched, touched)
+    offset = torch.arange(point_ids.shape[0], device=depths.device) - first
+    width = torch.repeat_interleave(width, touched)
+    tile_x = torch.repeat_interleave(rect[:, 0], touched) + offset % width
+    tile_y = torch.repeat_interleave(rect[:, 1], touched) + offset // width
+
+    # a stable sort keeps the depth order inside every tile
+    tile_ids, order = torch.sort(tile_y * grid_x + tile_x, stable=True)
+    counts = torch.bincount(tile_ids, minlength=grid_x * grid_y)
+    starts = torch.cumsum(counts, 0) - counts
+    return point_ids[order], starts, counts
+
+def composite_step(xy, conic, opacity, colors, depths, point_list, starts, counts, pix, d0, depth_chunk, C, D, T, done):
+    # Composites the Gaussians d0 .. d0 + depth_chunk of every tile in the chunk behind the running color C,
+    # depth D and transmittance T; done marks pixels that already saturated.
+    slot = d0 + torch.arange(depth_chunk, device=xy.device)
+    in_range = slot[None] < counts[:, None]
+    ids = point_list[torch.where(in_range, starts[:, None] + slot[None], torch.zeros_like(in_range, dtype=torch.long))]
+
+    d = xy[ids][:, None] - pix[:, :, None]
+    con = conic[ids][:, None]
+    power = -0.5 * (con[..., 0] * d[..., 0] * d[..., 0] + con[..., 2] * d[..., 1] * d[..., 1]) - con[..., 1] * d[..., 0] * d[..., 1]
+    alpha = torch.clamp_max(opacity[ids][:, None] * torch.exp(power.clamp_max(0.0)), 0.99)
+    alpha = torch.where(in_range[:, None] & (power <= 0.0) & (alpha >= 1.0 / 255.0), alpha, torch.zeros_like(alpha))
+
+    # a pixel stops at the first Gaussian that would push its transmittance below 1e-4
+    with torch.no_grad():
+        contrib = (T[..., None] * torch.cumprod(1 - alpha, dim=-1) >= 0.0001) & ~done[..., None]
+    alpha = alpha * contrib
+    trans = torch.cumprod(1 - alpha, dim=-1)
+    weights = alpha * T[..., None] * torch.cat([torch.ones_like(trans[..., :1]), trans[..., :-1]], dim=-1)
+
+    C = C + torch.einsum('tpk,tkc->tpc', weights, colors[ids])
+    D = D + (weights * depths[ids][:, None]).sum(-1)
+    return C, D, T * trans[..., -1], done | ~contrib[..., -1]
+
+def render_tiles(xy, conic, opacity, colors, depths, point_list, tiles, starts, counts, grid_x, depth_chunk, num_steps, use_checkpoint):
+    # Front-to-back compositing of a chunk of tiles in num_steps steps of depth_chunk Gaussians.
+    # With use_checkpoint every step is checkpointed, so backward only holds one step's per-Gaussian activations.
+    # Returns the accumulated color (T, 256, C), depth (T, 256) and final transmittance (T, 256).
+    num_tiles = tiles.shape[0]
+    local = torch.arange(BLOCK_X * BLOCK_Y, device=xy.device)
+    pix = torch.stack([(tiles % grid_x)[:, None] * BLOCK_X + local % BLOCK_X,
+                       (tiles // grid_x)[:, None] * BLOCK_Y + local // BLOCK_X], dim=-1).to(xy.dtype)
+
+    C = torch.zeros((num_tiles, local.shape[0], colors.shape[1]), dtype=xy.dtype, device=xy.device)
+    D = torch.zeros((num_tiles, local.shape[0]), dtype=xy.dtype, device=xy.device)
+    T = torch.ones((num_tiles, local.shape[0]), dtype=xy.dtype, device=xy.device)
+    done = torch.zeros((num_tiles, local.shape[0]), dtype=torch.bool, device=xy.device)
+
+    # saturated pixels are masked rather than tested for, so the loop never waits on the device
+    for step in range(num_steps):
+        args = (xy, conic, opacity, colors, depths, point_list, starts, counts, pix, step * depth_chunk, depth_chunk, C, D, T, done)
+        if use_checkpoint:
+            C, D, T, done = checkpoint(composite_step, *args, use_reentrant=False)
+        else:
+            C, D, T, done = composite_step(*args)
+    return C, D, T
+
+class GaussianRasterizer(nn.Module):
+    def __init__(self, raster_settings, tiles_per_chunk=64, depth_chunk=64):
+        super().__init__()
+        self.raster_settings = raster_settings
+        self.tiles_per_chunk = tiles_per_chunk
+        self.depth_chunk = depth_chunk
+
+    def markVisible(self, positions):
+        with torch.no_grad():
+            hom = torch.cat([positions, torch.ones_like(positions[:, :1])], dim=1)
+            return (hom @ self.raster_settings.viewmatrix)[:, 2] > 0.2
+
+    def forward(self, means3D, means2D, opacities, shs = None, colors_precomp = None, scales = None, rotations = None, cov3D_precomp = None):
+
+        raster_settings = self.raster_settings
+
+        if (shs is None and colors_precomp is None) or (shs is not None and colors_precomp is not None):
+            raise Exception('Please provide excatly one of either SHs or precomputed colors!')
+
+        if ((scales is None or rotations is None) and cov3D_precomp is None) or ((scales is not None or rotations is not None) and cov3D_precomp is not None):
+            raise Exception('Please provide exactly one of either scale/rotation pair or precomputed 3D covariance!')
+
+        H, W = raster_settings.image_height, raster_settings.image_width
+        grid_x, grid_y = (W + BLOCK_X - 1) // BLOCK_X, (H + BLOCK_Y - 1) // BLOCK_Y
+
+        xy, conic, opacity, colors, depths, radii, rect = preprocess(
+            means3D, means2D, opacities, shs, colors_precomp, scales, rotations, cov3D_precomp, raster_settings)
+        point_list, starts, counts = bin_gaussians(depths, radii, rect, grid_x, grid_y)
+
+        # depth steps per tile chunk, from one host read of the per-chunk maximum of Gaussians per tile
+        num_tiles, step = grid_x * grid_y, self.tiles_per_chunk
+        padded = torch.zeros((num_tiles + step - 1) // step * step, dtype=counts.dtype, device=counts.device)
+        padded[:num_tiles] = counts
+        num_steps = ((padded.view(-1, step).amax(dim=1) + self.depth_chunk - 1) // self.depth_chunk).tolist()
+
+        # checkpointing every (tile chunk, depth step) keeps the autograd memory at one step's activations
+        use_checkpoint = torch.is_grad_enabled() and any(t.requires_grad for t in (xy, conic, opacity, colors, depths))
+        C, D, T = [], [], []
+        for chunk, t0 in enumerate(range(0, num_tiles, step)):
+            tiles = torch.arange(t0, min(t0 + step, num_tiles), device=xy.device)
+            out = render_tiles(xy, conic, opacity, colors, depths, point_list, tiles, starts[tiles], counts[tiles], grid_x,
+                               self.depth_chunk, num_steps[chunk], use_checkpoint)
+            C.append(out[0]); D.append(out[1]); T.append(out[2])
+
+        def to_image(tiles):
+            # (tiles, 256, ch) -> (ch, H, W)
+            tiles = tiles.view(grid_y, grid_x, BLOCK_Y, BLOCK_X, -1).permute(4, 0, 2, 1, 3)
+            return tiles.reshape(-1, grid_y * BLOCK_Y, grid_x * BLOCK_X)[:, :H, :W]
+
+        T = to_image(torch.cat(T)[..., None])
+        color = to_image(torch.cat(C)) + T * raster_settings.bg.view(-1, 1, 1)
+        depth_alpha = torch.cat([to_image(torch.cat(D)[..., None]), T], dim=0)
+        return color, radii, depth_alpha
@@ -0,0 +1,40 @@
+import os
+import json
+import hashlib
+import torch
+
+class TextEmbeddingCache:
+    """
+    On-disk cache of SDXL prompt embeddings (hidden states and pooled output), one file per prompt.
+    Entries are keyed by the model key, the tokenizers, the text adapters, the precision and the prompt text.
+    """
+    def __init__(self, cache_dir, model_key, tokenizers, dtype, textual_inversion_path=None, LoRA_path=None):
+        self.cache_dir = cache_dir
+        self.dtype = dtype
+        os.makedirs(cache_dir, exist_ok=True)
+        self.identity = [model_key,
+                         [(tokenizer.name_or_path, tokenizer.model_max_length, len(tokenizer)) for tokenizer in tokenizers],
+                         textual_inversion_path, LoRA_path, str(dtype)]
+
+    def path(self, prompt):
+        key = hashlib.sha1(json.dumps(self.identity + [prompt]).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".pt")
+
+    def contains(self, prompts):
+        return all(os.path.isfile(self.path(prompt)) for prompt in prompts)
+
+    def load(self, prompt, device):
+        path = self.path(prompt)
+        if not os.path.isfile(path):
+            return None
+        entry = torch.load(path, map_location=device)
+        return entry["prompt_embeds"].to(self.dtype), entry["pooled_prompt_embeds"].to(self.dtype)
+
+    def save(self, prompt, prompt_embeds, pooled_prompt_embeds):
+        path = self.path(prompt)
+        # write then rename so concurrent runs never read a partial file
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        torch.save({"prompt": prompt,
+                    "prompt_embeds": prompt_embeds.detach().cpu(),
+                    "pooled_prompt_embeds": pooled_prompt_embeds.detach().cpu()}, tmp_path)
+        os.replace(tmp_path, path)
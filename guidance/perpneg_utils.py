@@ -7,42 +7,37 @@ def get_perpendicular_component(x, y):
 
 
 def batch_get_perpendicular_component(x, y):
-    assert x.shape == y.shape
-    result = []
-    for i in range(x.shape[0]):
-        result.append(get_perpendicular_component(x[i], y[i]))
-    return torch.stack(result)
+    """
+    Component of every x[i] perpendicular to y[i], for all i at once.
+    y may have fewer leading dims than x and is broadcast against them (e.g. x: [K, B, ...], y: [B, ...]);
+    the projection is taken over the trailing y.dim() - 1 dims.
+    """
+    assert x.shape[x.dim() - y.dim():] == y.shape
+    dims = tuple(range(x.dim() - y.dim() + 1, x.dim()))
+    dot = torch.mul(x, y).sum(dim=dims, keepdim=True)
+    norm = torch.mul(y, y).sum(dim=tuple(range(1, y.dim())), keepdim=True).clamp_min(1e-6)
+    return x - (dot / norm) * y
 
 
 def weighted_perpendicular_aggregator(delta_noise_preds, weights, batch_size):
-    """ 
-    Notes: 
-     - weights: an array with the weights for combining the noise predictions
+    """
+    Notes:
+     - weights: an array with the weights for combining the noise predictions, the first B must be 1
      - delta_noise_preds: [B x K, 4, 64, 64], K = max_prompts_per_dir
     """
-    delta_noise_preds = delta_noise_preds.split(batch_size, dim=0) # K x [B, 4, 64, 64]
-    weights = weights.split(batch_size, dim=0) # K x [B]
-    # print(f"{weights[0].shape = } {weights = }")
-
-    assert torch.all(weights[0] == 1.0)
+    delta_noise_preds = delta_noise_preds.reshape(-1, batch_size, *delta_noise_preds.shape[1:]) # [K, B, 4, 64, 64]
+    weights = weights.reshape(-1, batch_size) # [K, B]
 
     main_positive = delta_noise_preds[0] # [B, 4, 64, 64]
+    if delta_noise_preds.shape[0] == 1:
+        return main_positive
 
-    accumulated_output = torch.zeros_like(main_positive)
-    for i, complementary_noise_pred in enumerate(delta_noise_preds[1:], start=1):
-        # print(f"\n{i = }, {weights[i] = }, {weights[i].shape = }\n")
-
-        idx_non_zero = torch.abs(weights[i]) > 1e-4
-        
-        # print(f"{idx_non_zero.shape = }, {idx_non_zero = }")
-        # print(f"{weights[i][idx_non_zero].shape = }, {weights[i][idx_non_zero] = }")
-        # print(f"{complementary_noise_pred.shape = }, {complementary_noise_pred[idx_non_zero].shape = }")
-        # print(f"{main_positive.shape = }, {main_positive[idx_non_zero].shape = }")
-        if sum(idx_non_zero) == 0:
-            continue
-        accumulated_output[idx_non_zero] += weights[i][idx_non_zero].reshape(-1, 1, 1, 1) * batch_get_perpendicular_component(complementary_noise_pred[idx_non_zero], main_positive[idx_non_zero])
-    
-    #assert accumulated_output.shape == main_positive.shape,# f"{accumulated_output.shape = }, {main_positive.shape = }"
+    # negligible weights contribute nothing, masked instead of indexed so no sync is needed
+    negative_weights = weights[1:]
+    negative_weights = torch.where(torch.abs(negative_weights) > 1e-4, negative_weights, torch.zeros_like(negative_weights))
+    negative_weights = negative_weights.reshape(*negative_weights.shape, *([1] * (main_positive.dim() - 1)))
 
+    perpendicular = batch_get_perpendicular_component(delta_noise_preds[1:], main_positive) # [K - 1, B, 4, 64, 64]
+    accumulated_output = (negative_weights.to(perpendicular.dtype) * perpendicular).sum(dim=0)
 
-    return accumulated_output + main_positive
\ No newline at end of file
+    return accumulated_output + main_positive
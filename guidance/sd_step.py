@@ -59,13 +59,20 @@ def ddim_add_noise(
     noisy_samples = sqrt_alpha_prod * original_samples + sqrt_one_minus_alpha_prod * noise
     return noisy_samples
 
+def _expand_as_sample(values, sample):
+    # shared (0-d) or per-sample (B,) scheduler values -> broadcastable against sample
+    values = values.to(sample.device).flatten()
+    while len(values.shape) < len(sample.shape):
+        values = values.unsqueeze(-1)
+    return values
+
 # Copied from diffusers.schedulers.scheduling_ddpm.DDPMScheduler.step
 def ddim_step(
     self,
     model_output: torch.FloatTensor,
-    timestep: int,
+    timestep: Union[int, torch.IntTensor],
     sample: torch.FloatTensor,
-    delta_timestep: int = None,
+    delta_timestep: Union[int, torch.IntTensor] = None,
     eta: float = 0.0,
     use_clipped_model_output: bool = False,
     generator=None,
@@ -80,10 +87,12 @@ def ddim_step(
     Args:
         model_output (`torch.FloatTensor`):
             The direct output from learned diffusion model.
-        timestep (`float`):
-            The current discrete timestep in the diffusion chain.
+        timestep (`int` or `torch.IntTensor`):
+            The current discrete timestep in the diffusion chain, either shared or one per sample.
         sample (`torch.FloatTensor`):
             A current instance of a sample created by the diffusion process.
+        delta_timestep (`int` or `torch.IntTensor`, *optional*):
+            Step size towards the previous timestep, shared or one per sample (negative for inversion).
         eta (`float`):
             The weight of noise for added noise in diffusion step.
         use_clipped_model_output (`bool`, defaults to `False`):
@@ -128,11 +137,18 @@ def ddim_step(
     else:
         prev_timestep = timestep - delta_timestep
 
-    # 2. compute alphas, betas
-    alpha_prod_t = self.alphas_cumprod[timestep]
-    alpha_prod_t_prev = self.alphas_cumprod[prev_timestep] if prev_timestep >= 0 else self.final_alpha_cumprod
+    # 2. compute alphas, betas (per sample when the timesteps are vectors)
+    alphas_cumprod = self.alphas_cumprod.to(device=sample.device)
+    timestep = torch.as_tensor(timestep, device=sample.device)
+    prev_timestep = torch.as_tensor(prev_timestep, device=sample.device)
+    final_alpha_cumprod = torch.as_tensor(self.final_alpha_cumprod, device=sample.device, dtype=alphas_cumprod.dtype)
+
+    alpha_prod_t = _expand_as_sample(alphas_cumprod[timestep], sample)
+    alpha_prod_t_prev = torch.where(prev_timestep >= 0, alphas_cumprod[prev_timestep.clamp(min=0)], final_alpha_cumprod)
+    alpha_prod_t_prev = _expand_as_sample(alpha_prod_t_prev, sample)
 
     beta_prod_t = 1 - alpha_prod_t
+    beta_prod_t_prev = 1 - alpha_prod_t_prev
 
     # 3. compute predicted original sample from predicted noise also called
     # "predicted x_0" of formula (12) from https://arxiv.org/pdf/2010.02502.pdf
@@ -165,10 +181,11 @@ def ddim_step(
     # else:
     #     variance = abs(self._get_variance(prev_timestep, timestep))
 
-    variance = abs(self._get_variance(timestep, prev_timestep))
+    # same as self._get_variance(timestep, prev_timestep), which only takes scalar timesteps
+    variance = torch.abs((beta_prod_t_prev / beta_prod_t) * (1 - alpha_prod_t / alpha_prod_t_prev))
 
     std_dev_t = eta * variance
-    std_dev_t = min((1 - alpha_prod_t_prev) / 2, std_dev_t) ** 0.5
+    std_dev_t = torch.minimum((1 - alpha_prod_t_prev) / 2, std_dev_t) ** 0.5
 
     if use_clipped_model_output:
         # the pred_epsilon is always re-derived from the clipped x_0 in Glide
@@ -197,6 +214,10 @@ def ddim_step(
     
     prev_sample = torch.nan_to_num(prev_sample)
 
+    # the per-sample alphas are fp32 tensors, keep the dtype the scalar alphas used to give
+    out_dtype = torch.promote_types(sample.dtype, model_output.dtype)
+    prev_sample, pred_original_sample = prev_sample.to(out_dtype), pred_original_sample.to(out_dtype)
+
     if not return_dict:
         return (prev_sample,)
 
@@ -205,7 +226,7 @@ def ddim_step(
 def pred_original(
     self,
     model_output: torch.FloatTensor,
-    timesteps: int,
+    timesteps: torch.IntTensor,
     sample: torch.FloatTensor,
 ):
     if isinstance(self, DDPMScheduler) or isinstance(self, DDIMScheduler):
@@ -242,10 +263,11 @@ def pred_original(
                 -self.config.clip_sample_range, self.config.clip_sample_range
             )
     elif isinstance(self, EulerAncestralDiscreteScheduler) or isinstance(self, EulerDiscreteScheduler):
-        timestep = timesteps.to(self.timesteps.device)
+        timesteps = timesteps.to(self.timesteps.device).reshape(-1, 1)
 
-        step_index = (self.timesteps == timestep).nonzero().item()
-        sigma = self.sigmas[step_index].to(device=sample.device, dtype=sample.dtype)
+        # one sigma per sample; argmax picks the (unique) matching step without a host sync
+        step_index = (self.timesteps[None, :] == timesteps).int().argmax(dim=1)
+        sigma = _expand_as_sample(self.sigmas.to(self.timesteps.device)[step_index], sample).to(dtype=sample.dtype)
 
         # 1. compute predicted original sample (x_0) from sigma-scaled predicted noise
         if self.config.prediction_type == "epsilon":
@@ -28,8 +28,12 @@ import torchvision.transforms as T
 from torchvision.utils import save_image
 from torch.cuda.amp import custom_bwd, custom_fwd
 from .perpneg_utils import weighted_perpendicular_aggregator
+from .embedding_cache import TextEmbeddingCache
+from .visualizer import AsyncVisualizer
+from .vae_encoders import KLVAEEncoder, load_vae, load_tiny_vae_encoder, encode_kwargs
 
 from .sd_step import *
+from utils.profile_utils import PhaseProfiler
 def rgb2sat(img, T=None):
     max_ = torch.max(img, dim=1, keepdim=True).values + 1e-5
     min_ = torch.min(img, dim=1, keepdim=True).values
@@ -62,7 +66,7 @@ def seed_everything(seed):
 class StableDiffusion(nn.Module):
     def __init__(self, device, fp16, vram_O, t_range=[0.02, 0.98], max_t_range=0.98, num_train_timesteps=None, 
                  ddim_inv=False, use_control_net=False, textual_inversion_path = None, 
-                 LoRA_path = None, guidance_opt=None):
+                 LoRA_path = None, guidance_opt=None, prompts=None):
         super().__init__()
 
         self.device = device
@@ -81,19 +85,23 @@ class StableDiffusion(nn.Module):
             # "local_files_only": True,
             # "use_auth_token": token,
         }
-        vae = AutoencoderKL.from_pretrained(
-            model_key,
-            # "madebyollin/sdxl-vae-fp16-fix",
-            # "stabilityai/sdxl-vae",
-            # local_files_only=True,
-            subfolder="vae",
-            torch_dtype=torch.float32
-        )
+        vae = load_vae(guidance_opt, model_key, self.precision_t)
         
-        pipe = StableDiffusionXLPipeline.from_pretrained(model_key, vae=vae, **general_kwargs)
+        tokenizer = CLIPTokenizer.from_pretrained(model_key, subfolder="tokenizer", cache_dir=cache_dir)
+        tokenizer_2 = CLIPTokenizer.from_pretrained(model_key, subfolder="tokenizer_2", cache_dir=cache_dir)
+        self.embedding_cache = None
+        if guidance_opt.embedding_cache_dir is not None:
+            self.embedding_cache = TextEmbeddingCache(guidance_opt.embedding_cache_dir, model_key, [tokenizer, tokenizer_2],
+                                                      self.precision_t, textual_inversion_path, LoRA_path)
+        # every prompt is cached: skip the text encoders (adapters still need them patched into the pipeline)
+        if self.embedding_cache is not None and prompts is not None and textual_inversion_path is None and LoRA_path is None \
+                and self.embedding_cache.contains(prompts):
+            print(f'[INFO] all text embeddings cached, skipping the text encoders')
+            general_kwargs.update(text_encoder=None, text_encoder_2=None)
+
+        pipe = StableDiffusionXLPipeline.from_pretrained(model_key, vae=vae, tokenizer=tokenizer, tokenizer_2=tokenizer_2, **general_kwargs)
 
 
-        self.ism = not guidance_opt.sds
         self.scheduler = DDIMScheduler.from_pretrained(model_key, subfolder="scheduler", torch_dtype=self.precision_t)
         self.sche_func = ddim_step
 
@@ -130,12 +138,31 @@ class StableDiffusion(nn.Module):
 
         self.pipe = pipe
         self.vae = pipe.vae
+        self.vae_encoder = KLVAEEncoder(self.vae, encode_kwargs(guidance_opt))
+        self.tiny_vae_encoder = None
+        if guidance_opt.vae_encoder == "tiny":
+            self.tiny_vae_encoder = load_tiny_vae_encoder(guidance_opt, self.precision_t).to(self.device)
+        self.tiny_vae_until_iter = guidance_opt.tiny_vae_until_iter
         self.tokenizer = pipe.tokenizer
         self.tokenizer_2 = pipe.tokenizer_2
         self.text_encoder = pipe.text_encoder
         self.text_encoder_2 = pipe.text_encoder_2
         self.unet = pipe.unet
-        
+
+        self.setup_guidance(t_range, max_t_range, num_train_timesteps, guidance_opt)
+
+        print(f'[INFO] loaded stable diffusion!')
+
+    def setup_guidance(self, t_range, max_t_range, num_train_timesteps, guidance_opt):
+        # model-independent state; needs self.device and self.scheduler
+        device = self.device
+        self.ism = not guidance_opt.sds
+        self.unet_max_batch = guidance_opt.unet_max_batch
+        self.per_view_timesteps = guidance_opt.per_view_timesteps
+        self.vis_mode = guidance_opt.vis_mode
+        self.visualizer = AsyncVisualizer(device, guidance_opt.vis_async, block=guidance_opt.vis_block)
+        self.profiler = PhaseProfiler(device, guidance_opt.profile)
+
         self.num_train_timesteps = num_train_timesteps if num_train_timesteps is not None else self.scheduler.config.num_train_timesteps        
         self.scheduler.set_timesteps(self.num_train_timesteps, device=device)
 
@@ -144,8 +171,6 @@ class StableDiffusion(nn.Module):
         self.max_step = int(self.num_train_timesteps * t_range[1])
         self.warmup_step = int(self.num_train_timesteps*(max_t_range-t_range[1]))
         
-        self.add_time_ids_neg = None
-
         self.noise_temp = None
         self.noise_gen = torch.Generator(self.device)
         self.noise_gen.manual_seed(guidance_opt.noise_seed)
@@ -158,9 +183,6 @@ class StableDiffusion(nn.Module):
                     [-0.158,  0.189,  0.264],
                     [-0.184, -0.271, -0.473]
                 ], device=self.device)
-        
-
-        print(f'[INFO] loaded stable diffusion!')
 
     def augmentation(self, *tensors):
         augs = T.Compose([
@@ -178,6 +200,69 @@ class StableDiffusion(nn.Module):
             cur_c += channels[i]
         return (ten for ten in results)
 
+    def _time_ids(self, rows):
+        # every sample shares the same SDXL size conditioning, so time_ids get one row per sample
+        return self.add_time_ids[:1].repeat(rows, 1)
+
+    def _inversion_inputs(self, noisy_lat, ind_t, text_embeddings_0, text_embeddings, cfg):
+        # UNet request predicting the noise of noisy_lat at timesteps[ind_t] (one add_noise_with_cfg step)
+        # text_embeddings_0: [2 * B, ...] hidden states, text_embeddings: [2, ...] pooled embeddings of (uncond, inverse text)
+        noisy_lat_ = self.scheduler.scale_model_input(noisy_lat, self.timesteps[ind_t]).to(self.precision_t)
+        if cfg > 1.0:
+            latent_model_input = torch.cat([noisy_lat_, noisy_lat_])
+            encoder_hidden_states = text_embeddings_0
+            text_embeds = text_embeddings
+        else:
+            latent_model_input = noisy_lat_
+            encoder_hidden_states = text_embeddings_0.reshape(2, -1, text_embeddings_0.shape[-2], text_embeddings_0.shape[-1])[1]
+            text_embeds = text_embeddings.reshape(2, -1, text_embeddings.shape[-1])[1]
+        rows = latent_model_input.shape[0]
+        timestep_model_input = self.timesteps[ind_t].reshape(-1)
+        timestep_model_input = timestep_model_input.repeat(rows // timestep_model_input.shape[0])
+        text_embeds = text_embeds.to(self.precision_t).repeat_interleave(rows // text_embeds.shape[0], dim=0)
+        return {"sample": latent_model_input, "timestep": timestep_model_input, "encoder_hidden_states": encoder_hidden_states,
+                "text_embeds": text_embeds, "time_ids": self._time_ids(rows)}
+
+    def _inversion_output(self, unet_output, cfg):
+        if cfg > 1.0:
+            uncond, cond = torch.chunk(unet_output, chunks=2)
+            unet_output = cond + cfg * (uncond - cond) # reverse cfg to enhance the distillation
+        return unet_output
+
+    def _inversion_step(self, unet_output, cur_noisy_lat, cur_ind_t, ind_t, delta_t, eta=0.0):
+        # DDIM inversion from timesteps[cur_ind_t] towards timesteps[ind_t], at most delta_t indices at once;
+        # with per-view indices, views that already reached ind_t take a zero step
+        next_ind_t = torch.minimum(cur_ind_t + delta_t, ind_t)
+        cur_t, next_t = self.timesteps[cur_ind_t], self.timesteps[next_ind_t]
+        delta_t_ = next_t-cur_t if isinstance(self.scheduler, DDIMScheduler) else next_ind_t-cur_ind_t
+
+        cur_noisy_lat = self.sche_func(self.scheduler, unet_output, cur_t, cur_noisy_lat, -delta_t_, eta).prev_sample
+        return cur_noisy_lat, next_ind_t
+
+    def _unet_forward(self, inputs):
+        inputs = {k: v.to(self.precision_t) for k, v in inputs.items()}
+        self.profiler.count_unet(inputs["sample"].shape[0])
+        return self.unet(inputs["sample"], inputs["timestep"], encoder_hidden_states=inputs["encoder_hidden_states"],
+                         added_cond_kwargs={"text_embeds": inputs["text_embeds"], "time_ids": inputs["time_ids"]}).sample
+
+    def _run_unet(self, requests):
+        """
+        Evaluates independent UNet requests (dicts of sample, timestep, encoder_hidden_states, text_embeds
+        and time_ids) with as few forward calls as possible, at most unet_max_batch samples per call.
+        Returns one noise prediction per request.
+        """
+        # every request built in this file has one row of every input per sample, anything else is a bug
+        for r in requests:
+            if any(v.shape[0] != r["sample"].shape[0] for v in r.values()):
+                raise ValueError("UNet request with mismatched row counts: {}".format({k: tuple(v.shape) for k, v in r.items()}))
+
+        inputs = {k: torch.cat([r[k].to(self.precision_t) for r in requests]) for k in requests[0]}
+        total = inputs["sample"].shape[0]
+        step = self.unet_max_batch if self.unet_max_batch > 0 else total
+        unet_output = torch.cat([self._unet_forward({k: v[start:start + step] for k, v in inputs.items()})
+                                 for start in range(0, total, step)])
+        return list(unet_output.split([r["sample"].shape[0] for r in requests]))
+
     def add_noise_with_cfg(self, latents, noise, 
                            ind_t, ind_prev_t, text_embeddings_0=None,
                            text_embeddings=None, cfg=1.0, 
@@ -185,17 +270,6 @@ class StableDiffusion(nn.Module):
                            is_noisy_latent=False,
                            eta=0.0):
 
-        text_embeddings = text_embeddings.to(self.precision_t)
-        if self.add_time_ids_neg is not None:
-            add_time_ids, _ = self.add_time_ids_neg.reshape(self.add_time_ids_neg.shape[0] // 2, -1).chunk(2)
-            add_time_ids = add_time_ids.reshape(add_time_ids.shape[0] * 2, -1)
-        else:
-            add_time_ids, _ = self.add_time_ids.chunk(2)
-        if cfg <= 1.0:
-            uncond_text_embeddings_0 = text_embeddings_0.reshape(2, -1, text_embeddings_0.shape[-2], text_embeddings_0.shape[-1])[1]
-
-        unet = self.unet
-
         if is_noisy_latent:
             prev_noisy_lat = latents
         else:
@@ -208,44 +282,50 @@ class StableDiffusion(nn.Module):
 
         for i in range(inv_steps):
             # pred noise
-            cur_noisy_lat_ = self.scheduler.scale_model_input(cur_noisy_lat, self.timesteps[cur_ind_t]).to(self.precision_t)
-            
-            if cfg > 1.0:
-                latent_model_input = torch.cat([cur_noisy_lat_, cur_noisy_lat_])
-                timestep_model_input = self.timesteps[cur_ind_t].reshape(1, 1).repeat(latent_model_input.shape[0], 1).reshape(-1)
-                unet_output = unet(latent_model_input, timestep_model_input, 
-                                encoder_hidden_states=text_embeddings_0, added_cond_kwargs={"text_embeds": text_embeddings.repeat(2, 1), "time_ids": add_time_ids}).sample
-                
-                uncond, cond = torch.chunk(unet_output, chunks=2)
-                
-                unet_output = cond + cfg * (uncond - cond) # reverse cfg to enhance the distillation
-            else:
-                timestep_model_input = self.timesteps[cur_ind_t].reshape(1, 1).repeat(cur_noisy_lat_.shape[0], 1).reshape(-1)
-                unet_output = unet(cur_noisy_lat_, timestep_model_input, 
-                                    encoder_hidden_states=uncond_text_embeddings_0, added_cond_kwargs={"text_embeds": text_embeddings.repeat(2, 1), "time_ids": add_time_ids}).sample
+            unet_output = self._run_unet([self._inversion_inputs(cur_noisy_lat, cur_ind_t, text_embeddings_0, text_embeddings, cfg)])[0]
+            unet_output = self._inversion_output(unet_output, cfg)
 
             pred_scores.append((cur_ind_t, unet_output))
 
-            next_ind_t = min(cur_ind_t + delta_t, ind_t)
-            cur_t, next_t = self.timesteps[cur_ind_t], self.timesteps[next_ind_t]
-            delta_t_ = next_t-cur_t if isinstance(self.scheduler, DDIMScheduler) else next_ind_t-cur_ind_t
-
-            cur_noisy_lat = self.sche_func(self.scheduler, unet_output, cur_t, cur_noisy_lat, -delta_t_, eta).prev_sample
-            cur_ind_t = next_ind_t
+            cur_noisy_lat, cur_ind_t = self._inversion_step(unet_output, cur_noisy_lat, cur_ind_t, ind_t, delta_t, eta)
 
             del unet_output
             torch.cuda.empty_cache()
 
-            if cur_ind_t == ind_t:
+            if torch.all(cur_ind_t == ind_t):
                 break
 
         return prev_noisy_lat, cur_noisy_lat, pred_scores[::-1]
 
+    def ism_step(self, prev_latents_noisy, ind_prev_t, ind_mu_t, ind_t, text_embeddings_0, text_embeddings, guidance_opt,
+                 xs_delta_t, current_delta_t, target_request=None):
+        """
+        Step 2 of ISM: x_s -> x_mu -> (noise at mu) and x_s -> x_t.
+        x_mu and x_t are one inversion step from the same x_s and share its UNet evaluation; the noise
+        prediction at mu and the guidance request built by target_request(x_t) are independent, so they
+        run as one batch. Returns x_t, the noise prediction at mu and the output of the target request.
+        """
+        cfg = guidance_opt.denoise_guidance_scale
+        unet_output = self._run_unet([self._inversion_inputs(prev_latents_noisy, ind_prev_t, text_embeddings_0, text_embeddings, cfg)])[0]
+        unet_output = self._inversion_output(unet_output, cfg)
+        latents_noisy_mu, _ = self._inversion_step(unet_output, prev_latents_noisy, ind_prev_t, ind_mu_t, xs_delta_t)
+        latents_noisy, _ = self._inversion_step(unet_output, prev_latents_noisy, ind_prev_t, ind_t, current_delta_t)
+        del unet_output
+
+        requests = [self._inversion_inputs(latents_noisy_mu, ind_mu_t, text_embeddings_0, text_embeddings, cfg)]
+        if target_request is not None:
+            requests.append(target_request(latents_noisy))
+        outputs = self._run_unet(requests)
+        target_mu2t = self._inversion_output(outputs[0], cfg)
+        return latents_noisy, target_mu2t, outputs[1] if target_request is not None else None
 
-    
     @torch.no_grad()
     def get_text_embeds(self, prompt):
         # prompt, negative_prompt: [str]
+        if self.embedding_cache is not None:
+            cached = self.embedding_cache.load(prompt, self.device)
+            if cached is not None:
+                return cached
 
         # Define tokenizers and text encoders
         tokenizers = [self.tokenizer, self.tokenizer_2] if self.tokenizer is not None else [self.tokenizer_2]
@@ -264,6 +344,8 @@ class StableDiffusion(nn.Module):
                 prompt_embeds_list.append(prompt_embeds)
 
         prompt_embeds = torch.concat(prompt_embeds_list, dim=-1)
+        if self.embedding_cache is not None:
+            self.embedding_cache.save(prompt, prompt_embeds, pooled_prompt_embeds)
         return prompt_embeds, pooled_prompt_embeds
     
     def _get_add_time_ids(self, original_size, crops_coords_top_left, target_size, dtype):
@@ -278,19 +360,20 @@ class StableDiffusion(nn.Module):
 
 
         # flip aug
-        pred_rgb, pred_depth, pred_alpha = self.augmentation(pred_rgb, pred_depth, pred_alpha)
+        with self.profiler.phase("augmentation"):
+            pred_rgb, pred_depth, pred_alpha = self.augmentation(pred_rgb, pred_depth, pred_alpha)
 
         B = pred_rgb.shape[0]
         K = text_embeddings.shape[0] - 1
         
         add_time_ids = self._get_add_time_ids(resolution, (0, 0), resolution, dtype=text_embeddings.dtype).repeat_interleave(B, dim=0)
         self.add_time_ids = torch.cat([add_time_ids, add_time_ids], dim=0).to(self.device)
-        self.add_time_ids_neg = self.add_time_ids
 
-        if as_latent:      
-            latents, _ = self.encode_imgs(pred_depth.repeat(1,3,1,1))
-        else:
-            latents, _ = self.encode_imgs(pred_rgb)
+        with self.profiler.phase("vae_encode"):
+            if as_latent:      
+                latents, _ = self.encode_imgs(pred_depth.repeat(1,3,1,1), iteration)
+            else:
+                latents, _ = self.encode_imgs(pred_rgb, iteration)
         # timestep ~ U(0.02, 0.98) to avoid very high/low noise level
         
         weights = weights.reshape(-1)
@@ -306,8 +389,9 @@ class StableDiffusion(nn.Module):
         else:
             current_delta_t =  guidance_opt.delta_t
 
-        ind_t = torch.randint(self.min_step, self.max_step + int(self.warmup_step*warm_up_rate), (1, ), dtype=torch.long, generator=self.noise_gen, device=self.device)[0]
-        ind_prev_t = max(ind_t - current_delta_t, torch.ones_like(ind_t) * 0)
+        # one timestep for the whole batch, or one per view (all views still share every UNet call)
+        ind_t = torch.randint(self.min_step, self.max_step + int(self.warmup_step*warm_up_rate), (B if self.per_view_timesteps else 1, ), dtype=torch.long, generator=self.noise_gen, device=self.device)
+        ind_prev_t = torch.clamp(ind_t - current_delta_t, min=0)
         
         gamma = guidance_opt.gamma
         gamma_tensor = torch.tensor(gamma)
@@ -318,8 +402,18 @@ class StableDiffusion(nn.Module):
         t = self.timesteps[ind_t]
         prev_t = self.timesteps[ind_prev_t]
 
+        def target_request(latents_noisy):
+            # guidance UNet request at t for every text embedding
+            latent_model_input = latents_noisy[None, :, ...].repeat(1 + K, 1, 1, 1, 1).reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
+            tt = t.repeat(latent_model_input.shape[0] // t.shape[0])
+
+            latent_model_input = self.scheduler.scale_model_input(latent_model_input, tt[0])
+            return {"sample": latent_model_input, "timestep": tt, "encoder_hidden_states": text_embeddings_0,
+                    "text_embeds": text_embeddings.reshape(-1, text_embeddings.shape[-1]), "time_ids": self._time_ids(latent_model_input.shape[0])}
+
         with torch.no_grad():
             # step unroll via ddim inversion
+            unet_output = None
             if not self.ism:
                 prev_latents_noisy = self.scheduler.add_noise(latents, noise, prev_t)
                 latents_noisy = self.scheduler.add_noise(latents, noise, t)
@@ -327,41 +421,26 @@ class StableDiffusion(nn.Module):
             else:
                 # Step 1: sample x_s with larger steps
                 xs_delta_t = guidance_opt.xs_delta_t if guidance_opt.xs_delta_t is not None else current_delta_t
-                xs_inv_steps = guidance_opt.xs_inv_steps if guidance_opt.xs_inv_steps is not None else int(np.ceil(ind_prev_t / xs_delta_t))
-                starting_ind = max(ind_prev_t - xs_delta_t * xs_inv_steps, torch.ones_like(ind_t) * 0)
-
-                _, prev_latents_noisy, pred_scores_xs = self.add_noise_with_cfg(latents, noise, ind_prev_t, starting_ind, inverse_text_embeddings_0,  embedding_inverse, 
-                                                                                guidance_opt.denoise_guidance_scale, xs_delta_t, xs_inv_steps, eta=guidance_opt.xs_eta)
-                # Step 2: sample x_t
-                _, latents_noisy_mu, pred_scores_mu = self.add_noise_with_cfg(prev_latents_noisy, noise, ind_mu_t,
-                                                                              ind_prev_t,
-                                                                              inverse_text_embeddings_0, embedding_inverse, 
-                                                                              guidance_opt.denoise_guidance_scale,
-                                                                              xs_delta_t, 1, is_noisy_latent=True)
-
-                _, _, pred_scores_mu2t = self.add_noise_with_cfg(latents_noisy_mu, noise, ind_t,
-                                                                                  ind_mu_t,
-                                                                                  inverse_text_embeddings_0,  embedding_inverse,
-                                                                                  guidance_opt.denoise_guidance_scale,
-                                                                                  xs_delta_t, 1, is_noisy_latent=True)
-
-                _, latents_noisy, pred_scores_xt = self.add_noise_with_cfg(prev_latents_noisy, noise, ind_t, ind_prev_t,
-                                                                           inverse_text_embeddings_0,  embedding_inverse,
-                                                                           guidance_opt.denoise_guidance_scale,
-                                                                           current_delta_t, 1, is_noisy_latent=True)
-
-                pred_scores = pred_scores_xt + pred_scores_xs
-                pred_scores_mu2t = pred_scores_mu2t + pred_scores_mu + pred_scores_xs
-                target = pred_scores[0][1]
-                target_mu2t = pred_scores_mu2t[0][1]
+                xs_inv_steps = guidance_opt.xs_inv_steps if guidance_opt.xs_inv_steps is not None else int(np.ceil(ind_prev_t.max().item() / xs_delta_t))
+                starting_ind = torch.clamp(ind_prev_t - xs_delta_t * xs_inv_steps, min=0)
 
+                with self.profiler.phase("xs_inversion"):
+                    _, prev_latents_noisy, pred_scores_xs = self.add_noise_with_cfg(latents, noise, ind_prev_t, starting_ind, inverse_text_embeddings_0,  embedding_inverse, 
+                                                                                    guidance_opt.denoise_guidance_scale, xs_delta_t, xs_inv_steps, eta=guidance_opt.xs_eta)
+                # Step 2: sample x_t; the guidance prediction joins the mu -> t evaluation unless control net is on
+                with self.profiler.phase("ism_step"):
+                    latents_noisy, target_mu2t, unet_output = self.ism_step(prev_latents_noisy, ind_prev_t, ind_mu_t, ind_t,
+                                                                            inverse_text_embeddings_0, embedding_inverse, guidance_opt,
+                                                                            xs_delta_t, current_delta_t,
+                                                                            None if use_control_net else target_request)
 
-        with torch.no_grad():
-            latent_model_input = latents_noisy[None, :, ...].repeat(1 + K, 1, 1, 1, 1).reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
-            tt = t.reshape(1, 1).repeat(latent_model_input.shape[0], 1).reshape(-1)
 
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, tt[0])
+        with torch.no_grad(), self.profiler.phase("target_unet"):
             if use_control_net:
+                latent_model_input = latents_noisy[None, :, ...].repeat(1 + K, 1, 1, 1, 1).reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
+                tt = t.repeat(latent_model_input.shape[0] // t.shape[0])
+
+                latent_model_input = self.scheduler.scale_model_input(latent_model_input, tt[0])
                 pred_depth_input = pred_depth_input[None, :, ...].repeat(1 + K, 1, 3, 1, 1).reshape(-1, 3, 512, 512).half()
                 down_block_res_samples, mid_block_res_sample = self.controlnet_depth(
                     latent_model_input,
@@ -373,9 +452,11 @@ class StableDiffusion(nn.Module):
                 unet_output = self.unet(latent_model_input, tt, encoder_hidden_states=text_embeddings,
                                     down_block_additional_residuals=down_block_res_samples,
                                     mid_block_additional_residual=mid_block_res_sample).sample
-            else:
-                unet_output = self.unet(latent_model_input.to(self.precision_t), tt.to(self.precision_t), encoder_hidden_states=text_embeddings_0.to(self.precision_t), added_cond_kwargs={"text_embeds": text_embeddings.reshape(-1, text_embeddings.shape[-1]), "time_ids": self.add_time_ids.repeat(2, 1)}).sample
+                self.profiler.count_unet(latent_model_input.shape[0])
+            elif unet_output is None:
+                unet_output = self._run_unet([target_request(latents_noisy)])[0]
 
+        with torch.no_grad(), self.profiler.phase("cfg_combine"):
             unet_output = unet_output.reshape(1 + K, -1, 4, resolution[0] // 8, resolution[1] // 8, )
             noise_pred_uncond, noise_pred_text = unet_output[:1].reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, ), unet_output[1:].reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
             delta_noise_preds = noise_pred_text - noise_pred_uncond.repeat(K, 1, 1, 1)
@@ -384,37 +465,17 @@ class StableDiffusion(nn.Module):
         pred_noise = noise_pred_uncond + guidance_opt.guidance_scale * delta_DSD
         w = lambda alphas: (((1 - alphas) / alphas) ** 0.5)
 
-        grad_mu2t = w(self.alphas[t]) * (pred_noise - target_mu2t)
+        grad_mu2t = w(self.alphas[t]).reshape(-1, 1, 1, 1) * (pred_noise - target_mu2t)
 
         grad = torch.nan_to_num(grad_scale * grad_mu2t)
 
         loss = SpecifyGradient.apply(latents, grad)
         
         if iteration % guidance_opt.vis_interval == 0:
-            noise_pred_post = noise_pred_uncond + guidance_opt.guidance_scale * delta_DSD    
-            lat2rgb = lambda x: torch.clip((x.permute(0,2,3,1) @ self.rgb_latent_factors.to(x.dtype)).permute(0,3,1,2), 0., 1.)
-            save_path_iter = os.path.join(save_folder,"iter_{}_step_{}.jpg".format(iteration,prev_t.item()))
-            with torch.no_grad():
-                pred_x0_latent_sp = pred_original(self.scheduler, noise_pred_uncond, prev_t, prev_latents_noisy)    
-                pred_x0_latent_pos = pred_original(self.scheduler, noise_pred_post, prev_t, prev_latents_noisy)        
-                pred_x0_pos = self.decode_latents(pred_x0_latent_pos.type(self.precision_t))
-                pred_x0_sp = self.decode_latents(pred_x0_latent_sp.type(self.precision_t))
-
-                grad_abs = torch.abs(grad.detach())
-                norm_grad  = F.interpolate((grad_abs / grad_abs.max()).mean(dim=1,keepdim=True), (resolution[0], resolution[1]), mode='bilinear', align_corners=False).repeat(1,3,1,1)
-
-                latents_rgb = F.interpolate(lat2rgb(latents), (resolution[0], resolution[1]), mode='bilinear', align_corners=False)
-                latents_sp_rgb = F.interpolate(lat2rgb(pred_x0_latent_sp), (resolution[0], resolution[1]), mode='bilinear', align_corners=False)
-
-                viz_images = torch.cat([pred_rgb, 
-                                        pred_depth.repeat(1, 3, 1, 1), 
-                                        pred_alpha.repeat(1, 3, 1, 1), 
-                                        rgb2sat(pred_rgb, pred_alpha).repeat(1, 3, 1, 1),
-                                        latents_rgb, latents_sp_rgb, 
-                                        norm_grad,
-                                        pred_x0_sp, pred_x0_pos],dim=0) 
-                save_image(viz_images, save_path_iter)
-
+            noise_pred_post = noise_pred_uncond + guidance_opt.guidance_scale * delta_DSD
+            save_path_iter = os.path.join(save_folder,"iter_{}_step_{}.jpg".format(iteration,"_".join(str(step) for step in prev_t.tolist())))
+            self.visualize(save_path_iter, resolution, pred_rgb, pred_depth, pred_alpha, latents, grad,
+                           prev_t, prev_latents_noisy, noise_pred_uncond, noise_pred_post)
 
         return loss
 
@@ -424,7 +485,8 @@ class StableDiffusion(nn.Module):
                     save_folder:Path=None, iteration=0, warm_up_rate = 0,
                     resolution=(1024, 1024), guidance_opt=None,as_latent=False, embedding_inverse = None, embedding_inverse_0 = None):
 
-        pred_rgb, pred_depth, pred_alpha = self.augmentation(pred_rgb, pred_depth, pred_alpha)
+        with self.profiler.phase("augmentation"):
+            pred_rgb, pred_depth, pred_alpha = self.augmentation(pred_rgb, pred_depth, pred_alpha)
 
         B = pred_rgb.shape[0]
         K = text_embeddings.shape[0] - 1
@@ -432,10 +494,11 @@ class StableDiffusion(nn.Module):
         add_time_ids = self._get_add_time_ids(resolution, (0, 0), resolution, dtype=text_embeddings.dtype).repeat_interleave(B, dim=0)
         self.add_time_ids = torch.cat([add_time_ids, add_time_ids], dim=0).to(self.device)
 
-        if as_latent:      
-            latents,_ = self.encode_imgs(pred_depth.repeat(1,3,1,1))
-        else:
-            latents,_ = self.encode_imgs(pred_rgb)
+        with self.profiler.phase("vae_encode"):
+            if as_latent:      
+                latents,_ = self.encode_imgs(pred_depth.repeat(1,3,1,1), iteration)
+            else:
+                latents,_ = self.encode_imgs(pred_rgb, iteration)
         # timestep ~ U(0.02, 0.98) to avoid very high/low noise level
 
         if self.noise_temp is None:
@@ -456,8 +519,9 @@ class StableDiffusion(nn.Module):
         else:
             current_delta_t =  guidance_opt.delta_t
 
-        ind_t = torch.randint(self.min_step, self.max_step + int(self.warmup_step*warm_up_rate), (1, ), dtype=torch.long, generator=self.noise_gen, device=self.device)[0]
-        ind_prev_t = max(ind_t - current_delta_t, torch.ones_like(ind_t) * 0)
+        # one timestep for the whole batch, or one per view (all views still share every UNet call)
+        ind_t = torch.randint(self.min_step, self.max_step + int(self.warmup_step*warm_up_rate), (B if self.per_view_timesteps else 1, ), dtype=torch.long, generator=self.noise_gen, device=self.device)
+        ind_prev_t = torch.clamp(ind_t - current_delta_t, min=0)
         
         gamma = guidance_opt.gamma
         gamma_tensor = torch.tensor(gamma)
@@ -468,8 +532,18 @@ class StableDiffusion(nn.Module):
         t = self.timesteps[ind_t]
         prev_t = self.timesteps[ind_prev_t]
 
+        def target_request(latents_noisy):
+            # guidance UNet request at t for every text embedding
+            latent_model_input = latents_noisy[None, :, ...].repeat(2, 1, 1, 1, 1).reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
+            tt = t.repeat(latent_model_input.shape[0] // t.shape[0])
+
+            latent_model_input = self.scheduler.scale_model_input(latent_model_input, tt[0])
+            return {"sample": latent_model_input, "timestep": tt, "encoder_hidden_states": text_embeddings_0,
+                    "text_embeds": text_embeddings.reshape(-1, text_embeddings.shape[-1]), "time_ids": self._time_ids(latent_model_input.shape[0])}
+
         with torch.no_grad():
             # step unroll via ddim inversion
+            unet_output = None
             if not self.ism:
                 prev_latents_noisy = self.scheduler.add_noise(latents, noise, prev_t)
                 latents_noisy = self.scheduler.add_noise(latents, noise, t)
@@ -477,41 +551,26 @@ class StableDiffusion(nn.Module):
             else:
                 # Step 1: sample x_s with larger steps
                 xs_delta_t = guidance_opt.xs_delta_t if guidance_opt.xs_delta_t is not None else current_delta_t
-                xs_inv_steps = guidance_opt.xs_inv_steps if guidance_opt.xs_inv_steps is not None else int(np.ceil(ind_prev_t / xs_delta_t))
-                starting_ind = max(ind_prev_t - xs_delta_t * xs_inv_steps, torch.ones_like(ind_t) * 0)
-
-                _, prev_latents_noisy, pred_scores_xs = self.add_noise_with_cfg(latents, noise, ind_prev_t, starting_ind, inverse_text_embeddings_0,  embedding_inverse, 
-                                                                                guidance_opt.denoise_guidance_scale, xs_delta_t, xs_inv_steps, eta=guidance_opt.xs_eta)
-                # Step 2: sample x_t
-                _, latents_noisy_mu, pred_scores_mu = self.add_noise_with_cfg(prev_latents_noisy, noise, ind_mu_t,
-                                                                              ind_prev_t,
-                                                                              inverse_text_embeddings_0, embedding_inverse, 
-                                                                              guidance_opt.denoise_guidance_scale,
-                                                                              xs_delta_t, 1, is_noisy_latent=True)
-
-                _, _, pred_scores_mu2t = self.add_noise_with_cfg(latents_noisy_mu, noise, ind_t,
-                                                                                  ind_mu_t,
-                                                                                  inverse_text_embeddings_0,  embedding_inverse,
-                                                                                  guidance_opt.denoise_guidance_scale,
-                                                                                  xs_delta_t, 1, is_noisy_latent=True)
-
-                _, latents_noisy, pred_scores_xt = self.add_noise_with_cfg(prev_latents_noisy, noise, ind_t, ind_prev_t,
-                                                                           inverse_text_embeddings_0,  embedding_inverse,
-                                                                           guidance_opt.denoise_guidance_scale,
-                                                                           current_delta_t, 1, is_noisy_latent=True)
-
-                pred_scores = pred_scores_xt + pred_scores_xs
-                pred_scores_mu2t = pred_scores_mu2t + pred_scores_mu + pred_scores_xs
-                target = pred_scores[0][1]
-                target_mu2t = pred_scores_mu2t[0][1]
+                xs_inv_steps = guidance_opt.xs_inv_steps if guidance_opt.xs_inv_steps is not None else int(np.ceil(ind_prev_t.max().item() / xs_delta_t))
+                starting_ind = torch.clamp(ind_prev_t - xs_delta_t * xs_inv_steps, min=0)
 
+                with self.profiler.phase("xs_inversion"):
+                    _, prev_latents_noisy, pred_scores_xs = self.add_noise_with_cfg(latents, noise, ind_prev_t, starting_ind, inverse_text_embeddings_0,  embedding_inverse, 
+                                                                                    guidance_opt.denoise_guidance_scale, xs_delta_t, xs_inv_steps, eta=guidance_opt.xs_eta)
+                # Step 2: sample x_t; the guidance prediction joins the mu -> t evaluation unless control net is on
+                with self.profiler.phase("ism_step"):
+                    latents_noisy, target_mu2t, unet_output = self.ism_step(prev_latents_noisy, ind_prev_t, ind_mu_t, ind_t,
+                                                                            inverse_text_embeddings_0, embedding_inverse, guidance_opt,
+                                                                            xs_delta_t, current_delta_t,
+                                                                            None if use_control_net else target_request)
 
-        with torch.no_grad():
-            latent_model_input = latents_noisy[None, :, ...].repeat(2, 1, 1, 1, 1).reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
-            tt = t.reshape(1, 1).repeat(latent_model_input.shape[0], 1).reshape(-1)
 
-            latent_model_input = self.scheduler.scale_model_input(latent_model_input, tt[0])
+        with torch.no_grad(), self.profiler.phase("target_unet"):
             if use_control_net:
+                latent_model_input = latents_noisy[None, :, ...].repeat(2, 1, 1, 1, 1).reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
+                tt = t.repeat(latent_model_input.shape[0] // t.shape[0])
+
+                latent_model_input = self.scheduler.scale_model_input(latent_model_input, tt[0])
                 pred_depth_input = pred_depth_input[None, :, ...].repeat(1 + K, 1, 3, 1, 1).reshape(-1, 3, 512, 512).half()
                 down_block_res_samples, mid_block_res_sample = self.controlnet_depth(
                     latent_model_input,
@@ -523,9 +582,11 @@ class StableDiffusion(nn.Module):
                 unet_output = self.unet(latent_model_input, tt, encoder_hidden_states=text_embeddings,
                                     down_block_additional_residuals=down_block_res_samples,
                                     mid_block_additional_residual=mid_block_res_sample).sample
-            else:
-                unet_output = self.unet(latent_model_input.to(self.precision_t), tt.to(self.precision_t), encoder_hidden_states=text_embeddings_0.to(self.precision_t), added_cond_kwargs={"text_embeds": text_embeddings.reshape(-1, text_embeddings.shape[-1]), "time_ids": self.add_time_ids}).sample
+                self.profiler.count_unet(latent_model_input.shape[0])
+            elif unet_output is None:
+                unet_output = self._run_unet([target_request(latents_noisy)])[0]
 
+        with torch.no_grad(), self.profiler.phase("cfg_combine"):
             unet_output = unet_output.reshape(2, -1, 4, resolution[0] // 8, resolution[1] // 8, )
             noise_pred_uncond, noise_pred_text = unet_output[:1].reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, ), unet_output[1:].reshape(-1, 4, resolution[0] // 8, resolution[1] // 8, )
             delta_DSD = noise_pred_text - noise_pred_uncond
@@ -534,39 +595,62 @@ class StableDiffusion(nn.Module):
 
         w = lambda alphas: (((1 - alphas) / alphas) ** 0.5)
 
-        grad_mu2t = w(self.alphas[t]) * (pred_noise - target_mu2t)
+        grad_mu2t = w(self.alphas[t]).reshape(-1, 1, 1, 1) * (pred_noise - target_mu2t)
 
         grad = torch.nan_to_num(grad_scale * grad_mu2t)
 
         loss = SpecifyGradient.apply(latents, grad)
               
         if iteration % guidance_opt.vis_interval == 0:
-            noise_pred_post = noise_pred_uncond + 7.5* delta_DSD    
-            lat2rgb = lambda x: torch.clip((x.permute(0,2,3,1) @ self.rgb_latent_factors.to(x.dtype)).permute(0,3,1,2), 0., 1.)
-            save_path_iter = os.path.join(save_folder,"iter_{}_step_{}.jpg".format(iteration,prev_t.item()))
-            with torch.no_grad():
-                pred_x0_latent_sp = pred_original(self.scheduler, noise_pred_uncond, prev_t, prev_latents_noisy)    
-                pred_x0_latent_pos = pred_original(self.scheduler, noise_pred_post, prev_t, prev_latents_noisy)        
-                pred_x0_pos = self.decode_latents(pred_x0_latent_pos.type(self.precision_t))
-                pred_x0_sp = self.decode_latents(pred_x0_latent_sp.type(self.precision_t))
-                # pred_x0_uncond = pred_x0_sp[:1, ...]
-
-                grad_abs = torch.abs(grad.detach())
-                norm_grad  = F.interpolate((grad_abs / grad_abs.max()).mean(dim=1,keepdim=True), (resolution[0], resolution[1]), mode='bilinear', align_corners=False).repeat(1,3,1,1)
-
-                latents_rgb = F.interpolate(lat2rgb(latents), (resolution[0], resolution[1]), mode='bilinear', align_corners=False)
-                latents_sp_rgb = F.interpolate(lat2rgb(pred_x0_latent_sp), (resolution[0], resolution[1]), mode='bilinear', align_corners=False)
-
-                viz_images = torch.cat([pred_rgb, 
-                                        pred_depth.repeat(1, 3, 1, 1), 
-                                        pred_alpha.repeat(1, 3, 1, 1), 
-                                        rgb2sat(pred_rgb, pred_alpha).repeat(1, 3, 1, 1),
-                                        latents_rgb, latents_sp_rgb, norm_grad,
-                                        pred_x0_sp, pred_x0_pos],dim=0) 
-                save_image(viz_images, save_path_iter)
+            noise_pred_post = noise_pred_uncond + 7.5* delta_DSD
+            save_path_iter = os.path.join(save_folder,"iter_{}_step_{}.jpg".format(iteration,"_".join(str(step) for step in prev_t.tolist())))
+            self.visualize(save_path_iter, resolution, pred_rgb, pred_depth, pred_alpha, latents, grad,
+                           prev_t, prev_latents_noisy, noise_pred_uncond, noise_pred_post)
 
         return loss
 
+    def visualize(self, save_path, resolution, pred_rgb, pred_depth, pred_alpha, latents, grad,
+                  prev_t, prev_latents_noisy, noise_pred_uncond, noise_pred_post):
+        # hands the tensors to the visualizer, the grid is built and saved off the training stream
+        with self.profiler.phase("visualization"):
+            self.visualizer.submit(self._save_visualization, save_path=save_path, resolution=resolution,
+                                   pred_rgb=pred_rgb, pred_depth=pred_depth, pred_alpha=pred_alpha, latents=latents, grad=grad,
+                                   prev_t=prev_t, prev_latents_noisy=prev_latents_noisy,
+                                   noise_pred_uncond=noise_pred_uncond, noise_pred_post=noise_pred_post)
+
+    def _save_visualization(self, save_path, resolution, pred_rgb, pred_depth, pred_alpha, latents, grad,
+                            prev_t, prev_latents_noisy, noise_pred_uncond, noise_pred_post):
+        lat2rgb = lambda x: torch.clip((x.permute(0,2,3,1) @ self.rgb_latent_factors.to(x.dtype)).permute(0,3,1,2), 0., 1.)
+        upsample = lambda x: F.interpolate(x, (resolution[0], resolution[1]), mode='bilinear', align_corners=False)
+
+        pred_x0_latent_sp = pred_original(self.scheduler, noise_pred_uncond, prev_t, prev_latents_noisy)
+        pred_x0_latent_pos = pred_original(self.scheduler, noise_pred_post, prev_t, prev_latents_noisy)
+        if self.vis_mode == "latent":
+            # cheap preview: linear latent -> rgb projection instead of a VAE decode
+            pred_x0_pos = upsample(lat2rgb(pred_x0_latent_pos))
+            pred_x0_sp = upsample(lat2rgb(pred_x0_latent_sp))
+        else:
+            pred_x0_pos = self.decode_latents(pred_x0_latent_pos.type(self.precision_t))
+            pred_x0_sp = self.decode_latents(pred_x0_latent_sp.type(self.precision_t))
+
+        grad_abs = torch.abs(grad)
+        norm_grad  = upsample((grad_abs / grad_abs.max()).mean(dim=1,keepdim=True)).repeat(1,3,1,1)
+
+        latents_rgb = upsample(lat2rgb(latents))
+        latents_sp_rgb = upsample(lat2rgb(pred_x0_latent_sp))
+
+        viz_images = torch.cat([pred_rgb,
+                                pred_depth.repeat(1, 3, 1, 1),
+                                pred_alpha.repeat(1, 3, 1, 1),
+                                rgb2sat(pred_rgb, pred_alpha).repeat(1, 3, 1, 1),
+                                latents_rgb, latents_sp_rgb, norm_grad,
+                                pred_x0_sp.to(pred_rgb.dtype), pred_x0_pos.to(pred_rgb.dtype)],dim=0)
+        save_image(viz_images, save_path)
+
+    def close(self):
+        # waits for the pending visualizations
+        self.visualizer.close()
+
     def decode_latents(self, latents):
         target_dtype = latents.dtype
         latents = latents / self.vae.config.scaling_factor
@@ -576,14 +660,9 @@ class StableDiffusion(nn.Module):
 
         return imgs.to(target_dtype)
 
-    def encode_imgs(self, imgs):
-        target_dtype = imgs.dtype
-        # imgs: [B, 3, H, W]
-        imgs = 2 * imgs - 1
-
-        posterior = self.vae.encode(imgs.to(self.vae.dtype)).latent_dist
-        kl_divergence = posterior.kl()
-
-        latents = posterior.sample() * self.vae.config.scaling_factor
-
-        return latents.to(target_dtype), kl_divergence
\ No newline at end of file
+    def encode_imgs(self, imgs, iteration=None):
+        # the tiny encoder (if any) serves the early iterations, the full VAE the rest
+        encoder = self.vae_encoder
+        if self.tiny_vae_encoder is not None and (self.tiny_vae_until_iter is None or iteration is None or iteration < self.tiny_vae_until_iter):
+            encoder = self.tiny_vae_encoder
+        return encoder(imgs)
@@ -0,0 +1,89 @@
+import json
+import hashlib
+import torch
+import torch.nn as nn
+from diffusers import DDIMScheduler, UNet2DConditionModel, AutoencoderKL
+
+from .sd_utils import StableDiffusion
+from .sd_step import ddim_step
+from .vae_encoders import KLVAEEncoder, encode_kwargs
+
+# SDXL conditioning: 77 tokens of 768 + 1280 hidden states, a 1280 pooled embedding and 6 time ids
+PROMPT_TOKENS = 77
+CROSS_ATTENTION_DIM = 2048
+POOLED_DIM = 1280
+ADD_TIME_EMBED_DIM = 8
+
+STUB_UNET_CONFIG = dict(
+    in_channels=4, out_channels=4,
+    down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+    up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+    block_out_channels=(32, 64), layers_per_block=1,
+    attention_head_dim=(2, 4), use_linear_projection=True,
+    cross_attention_dim=CROSS_ATTENTION_DIM,
+    addition_embed_type="text_time", addition_time_embed_dim=ADD_TIME_EMBED_DIM,
+    projection_class_embeddings_input_dim=POOLED_DIM + 6 * ADD_TIME_EMBED_DIM,
+)
+
+STUB_VAE_CONFIG = dict(
+    in_channels=3, out_channels=3, latent_channels=4,
+    down_block_types=("DownEncoderBlock2D",) * 4, up_block_types=("UpDecoderBlock2D",) * 4,
+    block_out_channels=(8, 16, 16, 16), layers_per_block=1, norm_num_groups=8,
+    scaling_factor=0.13025,
+)
+
+# stabilityai/stable-diffusion-xl-base-1.0 scheduler config
+SDXL_SCHEDULER_CONFIG = dict(
+    num_train_timesteps=1000, beta_start=0.00085, beta_end=0.012, beta_schedule="scaled_linear",
+    clip_sample=False, set_alpha_to_one=False, steps_offset=1,
+)
+
+class StubDiffusion(StableDiffusion):
+    """
+    Guidance backend with the StableDiffusion interface, backed by a tiny randomly initialized UNet and VAE
+    with SDXL-shaped conditioning and pseudo text embeddings. Nothing is downloaded and it runs on CPU;
+    its gradients are meaningless, it exists to exercise and benchmark the training loop.
+    """
+    def __init__(self, device, fp16, vram_O, t_range=[0.02, 0.98], max_t_range=0.98, num_train_timesteps=None,
+                 ddim_inv=False, use_control_net=False, textual_inversion_path = None,
+                 LoRA_path = None, guidance_opt=None, prompts=None):
+        nn.Module.__init__(self)
+
+        self.device = device
+        # half precision convolutions are not available on every CPU
+        self.precision_t = torch.float16 if fp16 and torch.device(device).type == "cuda" else torch.float32
+
+        print(f'[INFO] building stub diffusion models...')
+
+        if use_control_net:
+            raise ValueError('the stub guidance has no control net.')
+
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(guidance_opt.noise_seed)
+            self.unet = UNet2DConditionModel(**STUB_UNET_CONFIG).to(self.device, self.precision_t)
+            self.vae = AutoencoderKL(**STUB_VAE_CONFIG).to(self.device)
+        self.scheduler = DDIMScheduler(**SDXL_SCHEDULER_CONFIG)
+        self.sche_func = ddim_step
+
+        self.vae_encoder = KLVAEEncoder(self.vae, encode_kwargs(guidance_opt))
+        self.tiny_vae_encoder = None
+        self.tiny_vae_until_iter = None
+        self.embedding_cache = None
+        self.tokenizer = None
+        self.tokenizer_2 = None
+        self.text_encoder = None
+        self.text_encoder_2 = None
+
+        self.setup_guidance(t_range, max_t_range, num_train_timesteps, guidance_opt)
+
+        print(f'[INFO] built stub diffusion!')
+
+    @torch.no_grad()
+    def get_text_embeds(self, prompt):
+        # deterministic pseudo embeddings: the same prompt always maps to the same tensors
+        batch = 1 if isinstance(prompt, str) else len(prompt)
+        seed = int(hashlib.sha1(json.dumps(prompt).encode("utf-8")).hexdigest()[:8], 16)
+        generator = torch.Generator().manual_seed(seed)
+        prompt_embeds = torch.randn((batch, PROMPT_TOKENS, CROSS_ATTENTION_DIM), generator=generator)
+        pooled_prompt_embeds = torch.randn((batch, POOLED_DIM), generator=generator)
+        return prompt_embeds.to(self.device, self.precision_t), pooled_prompt_embeds.to(self.device, self.precision_t)
@@ -0,0 +1,145 @@
+import torch
+import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
+from diffusers import AutoencoderKL, AutoencoderTiny
+try:
+    from diffusers.models.autoencoders.vae import DiagonalGaussianDistribution
+except ImportError:
+    from diffusers.models.vae import DiagonalGaussianDistribution
+
+VAE_ENCODERS = ["full", "fp16", "tiny"]
+VAE_ENCODE_MODES = ["default", "checkpoint", "tiled"]
+LATENT_SCALE = 8 # image pixels per latent pixel, for both the SDXL VAE and TAESDXL
+
+def _tile_starts(size, tile, overlap):
+    if size <= tile:
+        return [0]
+    stride = tile - overlap
+    return list(range(0, size - tile, stride)) + [size - tile]
+
+def _ramp(length, overlap, ramp_start, ramp_end, device):
+    # 1 inside the tile, rising linearly over the overlap on the sides shared with a neighbour
+    weight = torch.ones(length, device=device)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, device=device, dtype=torch.float32) / (overlap + 1)
+        if ramp_start:
+            weight[:overlap] = ramp
+        if ramp_end:
+            weight[-overlap:] = torch.minimum(weight[-overlap:], ramp.flip(0))
+    return weight
+
+def tiled_encode(fn, imgs, tile_size, overlap):
+    """
+    Applies a deterministic image -> latent-grid function on overlapping tiles and blends the results
+    with linear ramps. Every tile is checkpointed, so the backward pass only holds one tile's activations.
+    Exact only for encoders whose receptive field stays inside a tile: the SDXL VAE has GroupNorm and
+    mid-block attention over the whole image, so its tiled moments and gradients are approximate.
+    """
+    H, W = imgs.shape[-2:]
+    # tiles are placed and blended on the latent grid, so every tile edge has to fall on a latent pixel boundary
+    for name, value in [("vae_tile_size", tile_size), ("vae_tile_overlap", overlap), ("image height", H), ("image width", W)]:
+        if value % LATENT_SCALE != 0:
+            raise ValueError(f'{name} {value} is not a multiple of {LATENT_SCALE}.')
+    if not 0 <= overlap < tile_size:
+        raise ValueError(f'vae_tile_overlap {overlap} must be in [0, vae_tile_size {tile_size}).')
+    tile_h, tile_w = min(tile_size, H), min(tile_size, W)
+    ys, xs = _tile_starts(H, tile_h, overlap), _tile_starts(W, tile_w, overlap)
+    latent_overlap = overlap // LATENT_SCALE
+
+    output, weights = None, None
+    for y in ys:
+        for x in xs:
+            tile = checkpoint(fn, imgs[..., y:y + tile_h, x:x + tile_w], use_reentrant=False)
+            ly, lx, lh, lw = y // LATENT_SCALE, x // LATENT_SCALE, tile.shape[-2], tile.shape[-1]
+            if output is None:
+                output = torch.zeros(*tile.shape[:-2], H // LATENT_SCALE, W // LATENT_SCALE, device=tile.device, dtype=tile.dtype)
+                weights = torch.zeros(H // LATENT_SCALE, W // LATENT_SCALE, device=tile.device, dtype=tile.dtype)
+            weight = (_ramp(lh, latent_overlap, y > 0, y < ys[-1], tile.device)[:, None] *
+                      _ramp(lw, latent_overlap, x > 0, x < xs[-1], tile.device)[None, :]).to(tile.dtype)
+            output[..., ly:ly + lh, lx:lx + lw] += weight * tile
+            weights[ly:ly + lh, lx:lx + lw] += weight
+    return output / weights
+
+def memory_efficient_encode(fn, imgs, mode="default", batch_size=1, tile_size=512, overlap=128):
+    """
+    Runs fn (image batch -> latent grid) in the given mode:
+    "default" as is, "checkpoint" in checkpointed micro-batches of batch_size images (activations are
+    recomputed one micro-batch at a time in backward, same result as "default"), "tiled" on overlapping
+    checkpointed tiles (approximate for encoders with image-wide normalization or attention, see tiled_encode).
+    """
+    if mode not in VAE_ENCODE_MODES:
+        raise ValueError(f'vae_encode_mode {mode} not supported, choose from {VAE_ENCODE_MODES}.')
+    if mode == "default" or not torch.is_grad_enabled():
+        return fn(imgs)
+    if mode == "checkpoint":
+        return torch.cat([checkpoint(fn, chunk, use_reentrant=False) for chunk in imgs.split(max(batch_size, 1))])
+    return tiled_encode(fn, imgs, tile_size, overlap)
+
+class KLVAEEncoder(nn.Module):
+    """
+    Encodes images in [0, 1] to scaled SDXL latents with an AutoencoderKL (the SDXL VAE or the fp16-fix VAE).
+    Returns the latents and the KL divergence of the posterior.
+    """
+    def __init__(self, vae, encode_kwargs={}):
+        super().__init__()
+        self.vae = vae
+        self.encode_kwargs = encode_kwargs
+
+    def moments(self, imgs):
+        return self.vae.encode(imgs).latent_dist.parameters
+
+    def forward(self, imgs):
+        target_dtype = imgs.dtype
+        # imgs: [B, 3, H, W]
+        imgs = 2 * imgs - 1
+
+        # only the deterministic moments go through checkpointing / tiling, the sampling happens once outside
+        posterior = DiagonalGaussianDistribution(memory_efficient_encode(self.moments, imgs.to(self.vae.dtype), **self.encode_kwargs))
+        kl_divergence = posterior.kl()
+
+        latents = posterior.sample() * self.vae.config.scaling_factor
+
+        return latents.to(target_dtype), kl_divergence
+
+
+class TinyVAEEncoder(nn.Module):
+    """
+    Distilled SDXL encoder (TAESDXL): deterministic, approximate latents at a fraction of the cost.
+    Its latents are already in the scaled SDXL latent space; there is no posterior, so the KL term is None.
+    """
+    def __init__(self, taesd, encode_kwargs={}):
+        super().__init__()
+        self.taesd = taesd
+        self.encode_kwargs = encode_kwargs
+
+    def latents(self, imgs):
+        return self.taesd.encode(imgs).latents
+
+    def forward(self, imgs):
+        target_dtype = imgs.dtype
+        imgs = 2 * imgs - 1
+
+        latents = memory_efficient_encode(self.latents, imgs.to(self.taesd.dtype), **self.encode_kwargs) * self.taesd.config.scaling_factor
+
+        return latents.to(target_dtype), None
+
+
+def load_vae(guidance_opt, model_key, precision_t):
+    # SDXL VAE in fp32 (it overflows in fp16), or the fp16-fix VAE in the guidance precision
+    if guidance_opt.vae_encoder not in VAE_ENCODERS:
+        raise ValueError(f'vae_encoder {guidance_opt.vae_encoder} not supported, choose from {VAE_ENCODERS}.')
+    if guidance_opt.vae_encoder == "fp16":
+        return AutoencoderKL.from_pretrained(guidance_opt.vae_fp16_key, torch_dtype=precision_t)
+    return AutoencoderKL.from_pretrained(model_key, subfolder="vae", torch_dtype=torch.float32)
+
+
+def encode_kwargs(guidance_opt):
+    return {"mode": guidance_opt.vae_encode_mode, "batch_size": guidance_opt.vae_encode_batch,
+            "tile_size": guidance_opt.vae_tile_size, "overlap": guidance_opt.vae_tile_overlap}
+
+
+def load_tiny_vae_encoder(guidance_opt, precision_t):
+    taesd = AutoencoderTiny.from_pretrained(guidance_opt.tiny_vae_key, torch_dtype=precision_t)
+    # only the encoder is used, decoding stays on the full VAE
+    taesd.decoder = None
+    return TinyVAEEncoder(taesd, encode_kwargs(guidance_opt))
@@ -0,0 +1,71 @@
+import torch
+
+FRONT, SIDE, BACK = 0, 1, 2
+
+def _choose(mask, a, b):
+    return torch.where(mask, torch.full_like(mask, a, dtype=torch.long), torch.full_like(mask, b, dtype=torch.long))
+
+class ViewEmbeddingTable:
+    """
+    View-dependent prompt embeddings precomputed over an azimuth grid in [-180, 180].
+
+    The uncond, front/side/back and interpolated positive embeddings live in one bank on the
+    embedding device, so building the text embeddings of a batch is a single gather. Azimuths
+    snap to the nearest of `bins` grid points.
+    """
+    def __init__(self, embeddings, guidance_opt, bins=361):
+        self.bins = bins
+        self.perpneg = guidance_opt.perpneg
+        base = torch.cat([embeddings['front'], embeddings['side'], embeddings['back']], dim=0)
+        device = base.device
+
+        azimuth = torch.linspace(-180, 180, bins, device=device)
+        front_half = torch.logical_and(azimuth >= -90, azimuth < 90)
+        r = torch.where(front_half, 1 - azimuth.abs() / 90, 1 - (azimuth.abs() - 90) / 90)
+
+        # positive prompt: front -> side on the front half, side -> back on the back half
+        start = _choose(front_half, FRONT, SIDE)
+        end = _choose(front_half, SIDE, BACK)
+        r_ = r.view(-1, *([1] * (base.dim() - 1)))
+        pos = (r_ * base[start] + (1 - r_) * base[end]).to(base.dtype)
+
+        # bank = [uncond, front, side, back, pos_0 ... pos_{bins-1}]
+        self.bank = torch.cat([embeddings['uncond'], base, pos], dim=0)
+        pos_index = 1 + base.shape[0] + torch.arange(bins, device=device)
+        uncond_index = torch.zeros_like(pos_index)
+
+        if self.perpneg:
+            # perp-neg negatives: [front, side] on the front half, [side, front] on the back half
+            neg_1 = 1 + _choose(front_half, FRONT, SIDE)
+            neg_2 = 1 + _choose(front_half, SIDE, FRONT)
+            self.index = torch.stack([uncond_index, pos_index, neg_1, neg_2], dim=1)
+
+            negative_w = guidance_opt.negative_w
+            front_decay, side_decay = guidance_opt.front_decay_factor, guidance_opt.side_decay_factor
+            zeros = torch.zeros_like(r)
+            # front half: front weight fades in below r = 0.8, side weight above r = 0.2
+            front_neg_w = torch.where(r > 0.8, zeros, torch.exp(-r * front_decay) * negative_w)
+            side_neg_w = torch.where(r < 0.2, zeros, torch.exp(-(1 - r) * side_decay) * negative_w)
+            # back half: full front weight, side weight fades in below r = 0.8
+            back_side_neg_w = torch.where(r > 0.8, zeros, torch.exp(-r * side_decay) * negative_w / 2)
+            back_front_neg_w = torch.full_like(r, negative_w)
+            self.weights = torch.stack([torch.ones_like(r),
+                                        torch.where(front_half, front_neg_w, back_side_neg_w),
+                                        torch.where(front_half, side_neg_w, back_front_neg_w)], dim=1)
+        else:
+            self.index = torch.stack([uncond_index, pos_index], dim=1)
+            self.weights = None
+
+    def bin_index(self, azimuths):
+        azimuths = torch.as_tensor(azimuths, dtype=torch.float32, device=self.bank.device).reshape(-1)
+        return torch.round((azimuths + 180) / 360 * (self.bins - 1)).long().clamp(0, self.bins - 1)
+
+    def lookup(self, azimuths):
+        """
+        Returns the text embeddings [1 + K, B, ...] (uncond first) for a batch of azimuths and,
+        with perp-neg, the weights [K, B] of the K positive / negative prompts.
+        """
+        bins = self.bin_index(azimuths)
+        text_z = self.bank[self.index[bins].t()]
+        weights = self.weights[bins].t() if self.weights is not None else None
+        return text_z, weights
@@ -0,0 +1,79 @@
+import queue
+import threading
+import torch
+
+class AsyncVisualizer:
+    """
+    Runs visualization jobs fn(**tensors) on a background thread, under no_grad and, on CUDA, on a side stream.
+    Tensors are detached at submission; the side stream waits for the training stream only up to that point.
+    When the worker falls max_queue jobs behind, new jobs are dropped rather than stalling training, or with
+    block set, submit waits for a free slot. Dropped jobs are reported on the first drop and at close.
+    """
+    def __init__(self, device, run_async=True, max_queue=2, block=False):
+        self.run_async = run_async
+        self.block = block
+        self.error = None
+        self.dropped = 0
+        self.stream = torch.cuda.Stream(device=device) if run_async and torch.device(device).type == "cuda" else None
+        if run_async:
+            self.queue = queue.Queue(maxsize=max_queue)
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            if self.error is not None:
+                continue
+            fn, tensors, event = job
+            try:
+                if self.stream is not None:
+                    with torch.cuda.stream(self.stream):
+                        self.stream.wait_event(event)
+                        self._call(fn, tensors)
+                    self.stream.synchronize()
+                else:
+                    self._call(fn, tensors)
+            except Exception as e:
+                self.error = e
+
+    @staticmethod
+    def _call(fn, tensors):
+        with torch.no_grad():
+            fn(**tensors)
+
+    def submit(self, fn, **tensors):
+        if self.error is not None:
+            raise self.error
+        tensors = {k: v.detach() if torch.is_tensor(v) else v for k, v in tensors.items()}
+        if not self.run_async:
+            self._call(fn, tensors)
+            return
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+            # keep the training-stream allocator from reusing these blocks while the side stream reads them
+            for v in tensors.values():
+                if torch.is_tensor(v) and v.is_cuda:
+                    v.record_stream(self.stream)
+        if self.block:
+            self.queue.put((fn, tensors, event))
+            return
+        try:
+            self.queue.put_nowait((fn, tensors, event))
+        except queue.Full:
+            if self.dropped == 0:
+                print(f'[WARN] visualization worker is busy, dropping visualizations (set vis_block to wait instead)')
+            self.dropped += 1
+
+    def close(self):
+        if self.run_async and self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.dropped > 0:
+            print(f'[INFO] {self.dropped} visualizations were dropped while the worker was busy')
+        if self.error is not None:
+            raise self.error
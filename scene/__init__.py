@@ -13,10 +13,10 @@ import os
 import random
 import json
 from utils.system_utils import searchForMaxIteration
-from scene.dataset_readers import sceneLoadTypeCallbacks,GenerateRandomCameras,GeneratePurnCameras,GenerateCircleCameras
+from scene.dataset_readers import sceneLoadTypeCallbacks,GenerateRandomCameraArrays,GeneratePurnCameraArrays,camInfos_from_arrays,take_camera_arrays
 from scene.gaussian_model import GaussianModel
 from arguments import ModelParams, GenerateCamParams
-from utils.camera_utils import cameraList_from_camInfos, camera_to_JSON, cameraList_from_RcamInfos
+from utils.camera_utils import camera_to_JSON, cameraBatch_from_arrays, OrbitCameras
 
 class Scene:
 
@@ -43,20 +43,19 @@ class Scene:
         self.test_cameras = {}
         scene_info = sceneLoadTypeCallbacks["RandomCam"](self.model_path ,pose_args)
 
+        test_cameras = scene_info.test_cameras
         json_cams = []
-        camlist = []
-        if scene_info.test_cameras:
-            camlist.extend(scene_info.test_cameras)
-        for id, cam in enumerate(camlist):
+        for id, cam in enumerate(camInfos_from_arrays(test_cameras)):
             json_cams.append(camera_to_JSON(id, cam))
         with open(os.path.join(self.model_path, "cameras.json"), 'w') as file:
             json.dump(json_cams, file)
 
         if shuffle:
-            random.shuffle(scene_info.test_cameras)  # Multi-res consistent random shuffling
+            # Multi-res consistent random shuffling
+            test_cameras = take_camera_arrays(test_cameras, random.sample(range(len(test_cameras.R)), len(test_cameras.R)))
         self.cameras_extent = pose_args.default_radius #    scene_info.nerf_normalization["radius"]
         for resolution_scale in resolution_scales:
-            self.test_cameras[resolution_scale] = cameraList_from_RcamInfos(scene_info.test_cameras, resolution_scale, self.pose_args)
+            self.test_cameras[resolution_scale] = cameraBatch_from_arrays(test_cameras, resolution_scale, self.pose_args)
         if self.loaded_iter:
             self.gaussians.load_ply(os.path.join(self.model_path,
                                                            "point_cloud",
@@ -69,30 +68,29 @@ class Scene:
 
     def save(self, iteration):
         point_cloud_path = os.path.join(self.model_path, "point_cloud/iteration_{}".format(iteration))
-        self.gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"))
+        self.gaussians.save_ply(os.path.join(point_cloud_path, "point_cloud.ply"), rgb_dump=self.args.rgb_dump)
 
-    def getRandTrainCameras(self, scale=1.0):
-        rand_train_cameras = GenerateRandomCameras(self.pose_args, self.args.batch, SSAA=True)
+    def getRandTrainCameras(self, scale=1.0, pose_args=None, non_blocking=False):
+        # pose_args: a snapshot to sample from instead of the live self.pose_args (see CameraPrefetcher)
+        pose_args = self.pose_args if pose_args is None else pose_args
+        rand_train_cameras = GenerateRandomCameraArrays(pose_args, self.args.batch, SSAA=True)
         train_cameras = {}
         for resolution_scale in self.resolution_scales:
-            train_cameras[resolution_scale] = cameraList_from_RcamInfos(rand_train_cameras, resolution_scale, self.pose_args, SSAA=True)        
+            train_cameras[resolution_scale] = cameraBatch_from_arrays(rand_train_cameras, resolution_scale, pose_args, non_blocking=non_blocking)
         return train_cameras[scale]
 
 
     def getPurnTrainCameras(self, scale=1.0):
-        rand_train_cameras = GeneratePurnCameras(self.pose_args)
+        rand_train_cameras = GeneratePurnCameraArrays(self.pose_args)
         train_cameras = {}
         for resolution_scale in self.resolution_scales:
-            train_cameras[resolution_scale] = cameraList_from_RcamInfos(rand_train_cameras, resolution_scale, self.pose_args)        
+            train_cameras[resolution_scale] = cameraBatch_from_arrays(rand_train_cameras, resolution_scale, self.pose_args)
         return train_cameras[scale]
 
 
     def getTestCameras(self, scale=1.0):
         return self.test_cameras[scale]
 
-    def getCircleVideoCameras(self, scale=1.0,batch_size=120, render45 = True):
-        video_circle_cameras = GenerateCircleCameras(self.pose_args,batch_size,render45)
-        video_cameras = {}
-        for resolution_scale in self.resolution_scales:
-            video_cameras[resolution_scale] = cameraList_from_RcamInfos(video_circle_cameras, resolution_scale, self.pose_args)        
-        return video_cameras[scale]
\ No newline at end of file
+    def getCircleVideoCameras(self, scale=1.0,batch_size=120, render45 = True, cache_size=0):
+        # cameras are built on access, see OrbitCameras
+        return OrbitCameras(self.pose_args, batch_size, render45, resolution_scale=scale, cache_size=cache_size)
\ No newline at end of file
@@ -0,0 +1,107 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import copy
+import threading
+from collections import deque
+import torch
+
+# the pose_args fields the training loop widens in place
+RANGE_KEYS = ["radius_range", "theta_range", "phi_range", "fovy_range"]
+
+def pose_ranges(pose_args):
+    return tuple(tuple(getattr(pose_args, key)) for key in RANGE_KEYS)
+
+class CameraPrefetcher:
+    """
+    Samples random training CameraBatches on a worker thread and hands them out from a ring buffer of
+    `depth` ready batches. Every batch is drawn from a snapshot of scene.pose_args and tagged with its ranges;
+    next() drops batches whose ranges no longer match the current, progressively widened ones.
+    On CUDA the uploads run on a side stream that the consuming stream waits on, so a refill costs no sync.
+    """
+    def __init__(self, scene, depth=2):
+        self.scene = scene
+        self.depth = max(depth, 1)
+        self.ready = deque() # (batch, ranges, event)
+        self.stale = 0
+        self.error = None
+        self.closed = False
+        self.cond = threading.Condition()
+        device = torch.device(scene.pose_args.device)
+        self.stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _snapshot(self):
+        # the loop assigns range elements in place, so sample from private copies of the range lists
+        pose_args = copy.copy(self.scene.pose_args)
+        for key in RANGE_KEYS:
+            setattr(pose_args, key, list(getattr(pose_args, key)))
+        return pose_args
+
+    def _generate(self, pose_args):
+        if self.stream is None:
+            return self.scene.getRandTrainCameras(pose_args=pose_args), None
+        with torch.cuda.stream(self.stream):
+            batch = self.scene.getRandTrainCameras(pose_args=pose_args, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record(self.stream)
+        return batch, event
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.closed and len(self.ready) >= self.depth:
+                    self.cond.wait()
+                if self.closed:
+                    return
+            pose_args = self._snapshot()
+            try:
+                batch, event = self._generate(pose_args)
+            except Exception as e:
+                with self.cond:
+                    self.error = e
+                    self.cond.notify_all()
+                return
+            with self.cond:
+                self.ready.append((batch, pose_ranges(pose_args), event))
+                self.cond.notify_all()
+
+    def next(self):
+        # the oldest ready batch drawn from the current ranges, waiting for the worker if there is none
+        ranges = pose_ranges(self.scene.pose_args)
+        with self.cond:
+            while True:
+                if self.error is not None:
+                    raise self.error
+                if self.closed:
+                    raise RuntimeError("camera prefetcher is closed")
+                while len(self.ready) > 0 and self.ready[0][1] != ranges:
+                    self.ready.popleft()
+                    self.stale += 1
+                    self.cond.notify_all()
+                if len(self.ready) > 0:
+                    batch, _, event = self.ready.popleft()
+                    self.cond.notify_all()
+                    break
+                self.cond.wait()
+        if event is not None:
+            stream = torch.cuda.current_stream(batch.data_device)
+            stream.wait_event(event)
+            batch.record_stream(stream)
+        return batch
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.ready.clear()
@@ -18,19 +18,25 @@ def get_rays_torch(focal, c2w, H=64,W=64):
     """Computes rays using a General Pinhole Camera Model
     Assumes self.h, self.w, self.focal, and self.cam_to_world exist
     """
+    return get_rays_torch_batch(torch.tensor([focal]), c2w[None], H=H, W=W)
+
+def get_rays_torch_batch(focal, c2w, H=64, W=64):
+    # get_rays_torch for N cameras at once: focal [N], c2w [N, 4, 4] -> [N, H, W, 6]
+    focal = focal.to(c2w).reshape(-1, 1, 1)
     x, y = torch.meshgrid(
-        torch.arange(W),  # X-Axis (columns)
-        torch.arange(H),  # Y-Axis (rows)
+        torch.arange(W, device=c2w.device),  # X-Axis (columns)
+        torch.arange(H, device=c2w.device),  # Y-Axis (rows)
         indexing='xy')
+    x, y = x.to(c2w)[None], y.to(c2w)[None]
     camera_directions = torch.stack(
         [(x - W * 0.5 + 0.5) / focal,
             -(y - H * 0.5 + 0.5) / focal,
-            -torch.ones_like(x)],
-        dim=-1).to(c2w)
+            -torch.ones_like(x).expand(focal.shape[0], H, W)],
+        dim=-1)
 
     # Rotate ray directions from camera frame to the world frame
-    directions = ((camera_directions[ None,..., None, :] * c2w[None,None, None, :3, :3]).sum(axis=-1))  # Translate camera frame's origin to the world frame
-    origins = torch.broadcast_to(c2w[ None,None, None, :3, -1], directions.shape)
+    directions = ((camera_directions[..., None, :] * c2w[:, None, None, :3, :3]).sum(axis=-1))  # Translate camera frame's origin to the world frame
+    origins = torch.broadcast_to(c2w[:, None, None, :3, -1], directions.shape)
     viewdirs = directions / torch.linalg.norm(directions, axis=-1, keepdims=True)
 
     return torch.cat((origins,viewdirs),dim=-1)
@@ -73,8 +79,8 @@ class Camera(nn.Module):
         self.trans = trans
         self.scale = scale
 
-        self.world_view_transform = torch.tensor(getWorld2View2(R, T, trans, scale)).transpose(0, 1).cuda()
-        self.projection_matrix = getProjectionMatrix(znear=self.znear, zfar=self.zfar, fovX=self.FoVx, fovY=self.FoVy).transpose(0,1).cuda()
+        self.world_view_transform = torch.tensor(getWorld2View2(R, T, trans, scale)).transpose(0, 1).to(self.data_device)
+        self.projection_matrix = getProjectionMatrix(znear=self.znear, zfar=self.zfar, fovX=self.FoVx, fovY=self.FoVy).transpose(0,1).to(self.data_device)
         self.full_proj_transform = (self.world_view_transform.unsqueeze(0).bmm(self.projection_matrix.unsqueeze(0))).squeeze(0)
         self.camera_center = self.world_view_transform.inverse()[3, :3]
 
@@ -116,12 +122,133 @@ class RCamera(nn.Module):
         self.scale = scale
 
         RT = torch.tensor(getWorld2View2(R, T, trans, scale))
-        self.world_view_transform = RT.transpose(0, 1).cuda()
-        self.projection_matrix = getProjectionMatrix(znear=self.znear, zfar=self.zfar, fovX=self.FoVx, fovY=self.FoVy).transpose(0,1).cuda()
+        self.world_view_transform = RT.transpose(0, 1).to(self.data_device)
+        self.projection_matrix = getProjectionMatrix(znear=self.znear, zfar=self.zfar, fovX=self.FoVx, fovY=self.FoVy).transpose(0,1).to(self.data_device)
         self.full_proj_transform = (self.world_view_transform.unsqueeze(0).bmm(self.projection_matrix.unsqueeze(0))).squeeze(0)
         self.camera_center = self.world_view_transform.inverse()[3, :3]
         # self.rays = get_rays_torch(fov2focal(FoVx, 64), RT).cuda()
-        self.rays = get_rays_torch(fov2focal(FoVx, self.image_width//8), RT, H=self.image_height//8, W=self.image_width//8).cuda()
+        # rays are built on first access, most cameras never need them
+        self._RT = RT
+        self._rays = None
+
+    @property
+    def rays(self):
+        if self._rays is None:
+            self._rays = get_rays_torch(fov2focal(self.FoVx, self.image_width//8), self._RT, H=self.image_height//8, W=self.image_width//8).to(self.data_device)
+        return self._rays
+
+class CameraBatch:
+    """
+    Struct-of-arrays batch of N cameras: world-view, projection and full-projection matrices, camera centers,
+    FoVs and the polar/azimuth/radius deltas to the default view are built with batched numpy math and
+    copied to the device in one transfer. Indexing returns a BatchCamera that renders like an RCamera.
+    """
+    def __init__(self, R, T, FoVx, FoVy, delta_polar, delta_azimuth, delta_radius, image_width, image_height,
+                 uids=None, data_device = "cuda", non_blocking=False):
+        N = len(R)
+        self.R = np.asarray(R, dtype=np.float32) # [N, 3, 3]
+        self.T = np.asarray(T, dtype=np.float32) # [N, 3]
+        self.FoVx = np.broadcast_to(np.asarray(FoVx, dtype=np.float64), (N,))
+        self.FoVy = np.broadcast_to(np.asarray(FoVy, dtype=np.float64), (N,))
+        self.uids = np.arange(N) if uids is None else np.asarray(uids)
+        self.image_width = image_width
+        self.image_height = image_height
+        self.data_device = torch.device(data_device)
+
+        self.zfar = 100.0
+        self.znear = 0.01
+
+        # host copies of the deltas, read per camera (e.g. for the view-dependent prompts)
+        self.host_deltas = np.stack([np.broadcast_to(np.asarray(d, dtype=np.float32).reshape(-1), (N,))
+                                     for d in [delta_polar, delta_azimuth, delta_radius]], axis=1)
+
+        # world -> view, stored transposed like RCamera.world_view_transform (getWorld2View2 with no translate / scale)
+        world_view = np.zeros((N, 4, 4), dtype=np.float64)
+        world_view[:, :3, :3] = self.R
+        world_view[:, 3, :3] = self.T
+        world_view[:, 3, 3] = 1.0
+
+        # getProjectionMatrix for every camera, transposed
+        projection = np.zeros((N, 4, 4), dtype=np.float64)
+        projection[:, 0, 0] = 1.0 / np.tan(self.FoVx / 2)
+        projection[:, 1, 1] = 1.0 / np.tan(self.FoVy / 2)
+        projection[:, 2, 2] = self.zfar / (self.zfar - self.znear)
+        projection[:, 2, 3] = 1.0
+        projection[:, 3, 2] = -(self.zfar * self.znear) / (self.zfar - self.znear)
+
+        full_proj = world_view @ projection
+        # jittered poses are not exactly orthonormal, so the center comes from the inverse rather than -R T
+        camera_center = np.linalg.inv(world_view)[:, 3, :3]
+
+        host = np.concatenate([world_view.reshape(N, 16), projection.reshape(N, 16), full_proj.reshape(N, 16),
+                               camera_center, self.host_deltas], axis=1).astype(np.float32)
+        buffer = torch.from_numpy(host)
+        if non_blocking and self.data_device.type == "cuda":
+            buffer = buffer.pin_memory()
+        buffer = buffer.to(self.data_device, non_blocking=non_blocking)
+        self._buffer = buffer
+        self.world_view_transform = buffer[:, 0:16].view(N, 4, 4)
+        self.projection_matrix = buffer[:, 16:32].view(N, 4, 4)
+        self.full_proj_transform = buffer[:, 32:48].view(N, 4, 4)
+        self.camera_center = buffer[:, 48:51]
+        self.delta_polar = buffer[:, 51]
+        self.delta_azimuth = buffer[:, 52]
+        self.delta_radius = buffer[:, 53]
+        self._rays = None
+
+    @property
+    def rays(self):
+        # [N, H/8, W/8, 6] rays of every camera, computed together on first access
+        if self._rays is None:
+            W, H = self.image_width // 8, self.image_height // 8
+            focal = torch.from_numpy(W / (2 * np.tan(self.FoVx / 2)))
+            self._rays = get_rays_torch_batch(focal, self.world_view_transform.transpose(1, 2), H=H, W=W)
+        return self._rays
+
+    def record_stream(self, stream):
+        # uploaded on another stream: keep the allocator from reusing the buffer until `stream` is done with it
+        self._buffer.record_stream(stream)
+        if self._rays is not None:
+            self._rays.record_stream(stream)
+
+    def __len__(self):
+        return len(self.R)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("camera index {} out of range for a batch of {}".format(idx, len(self)))
+        return BatchCamera(self, int(idx))
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+class BatchCamera:
+    # one camera of a CameraBatch, its device tensors are views into the batch
+    def __init__(self, batch, idx):
+        self._batch = batch
+        self._idx = idx
+        self.uid = int(batch.uids[idx])
+        self.R = batch.R[idx]
+        self.T = batch.T[idx]
+        self.FoVx = float(batch.FoVx[idx])
+        self.FoVy = float(batch.FoVy[idx])
+        self.image_width = batch.image_width
+        self.image_height = batch.image_height
+        self.zfar = batch.zfar
+        self.znear = batch.znear
+        self.data_device = batch.data_device
+        self.delta_polar, self.delta_azimuth, self.delta_radius = batch.host_deltas[idx]
+        self.world_view_transform = batch.world_view_transform[idx]
+        self.projection_matrix = batch.projection_matrix[idx]
+        self.full_proj_transform = batch.full_proj_transform[idx]
+        self.camera_center = batch.camera_center[idx]
+
+    @property
+    def rays(self):
+        # same layout as RCamera.rays; asks the batch, which builds the rays of all its cameras at once
+        return self._batch.rays[self._idx:self._idx + 1]
 
 class MiniCam:
     def __init__(self, width, height, fovy, fovx, znear, zfar, world_view_transform, full_proj_transform):
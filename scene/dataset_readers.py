@@ -20,8 +20,8 @@ from utils.graphics_utils import getWorld2View2, focal2fov, fov2focal
 import numpy as np
 import json
 from pathlib import Path
-from utils.pointe_utils import init_from_pointe
 from plyfile import PlyData, PlyElement
+from utils.ply_utils import vertex_array, write_binary_ply
 from utils.sh_utils import SH2RGB
 from utils.general_utils import inverse_sigmoid_np
 from scene.gaussian_model import BasicPointCloud
@@ -40,6 +40,19 @@ class RandCameraInfo(NamedTuple):
     delta_radius : np.array
 
 
+class RandCameraArrays(NamedTuple):
+    # RandCameraInfo fields for N cameras, stacked along the first axis
+    R: np.array # [N, 3, 3]
+    T: np.array # [N, 3]
+    FovY: np.array # [N]
+    FovX: np.array # [N]
+    width: int
+    height: int
+    delta_polar : np.array # [N]
+    delta_azimuth : np.array # [N]
+    delta_radius : np.array # [N]
+
+
 class SceneInfo(NamedTuple):
     point_cloud: BasicPointCloud
     train_cameras: list
@@ -50,7 +63,7 @@ class SceneInfo(NamedTuple):
 
 class RSceneInfo(NamedTuple):
     point_cloud: BasicPointCloud
-    test_cameras: list
+    test_cameras: RandCameraArrays
     ply_path: str
 
 # def getNerfppNorm(cam_info):
@@ -94,19 +107,16 @@ def storePly(path, xyz, rgb):
     
     normals = np.zeros_like(xyz)
 
-    elements = np.empty(xyz.shape[0], dtype=dtype)
     attributes = np.concatenate((xyz, normals, rgb), axis=1)
-    elements[:] = list(map(tuple, attributes))
+    elements = vertex_array(attributes, dtype)
 
-    # Create the PlyData object and write to file
-    vertex_element = PlyElement.describe(elements, 'vertex')
-    ply_data = PlyData([vertex_element])
-    ply_data.write(path)
+    # Write the binary ply in one go
+    write_binary_ply(path, elements)
 
 #only test_camera
 def readCircleCamInfo(path,opt):
     print("Reading Test Transforms")
-    test_cam_infos = GenerateCircleCameras(opt,render45 = opt.render_45)
+    test_cam_infos = GenerateCircleCameraArrays(opt, render45 = opt.render_45)
     ply_path = os.path.join(path, "init_points3d.ply")
     if not os.path.exists(ply_path):
         # Since this data set has no colmap data, we start with random points
@@ -134,6 +144,8 @@ def readCircleCamInfo(path,opt):
             xyz[:, 1] = xyz[:, 1] * 0.6 - 0.3
             xyz[:, 2] = xyz[:, 2] * 1.2 - 0.6
         elif opt.init_shape == 'pointe':
+            # point-e is only needed (and imported) for this initialization
+            from utils.pointe_utils import init_from_pointe
             num_pts = int(num_pts/5000)
             xyz,rgb = init_from_pointe(opt.init_prompt)
             xyz[:,1] = - xyz[:,1]
@@ -338,71 +350,63 @@ def rand_poses(size, opt, radius_range=[1, 1.5], theta_range=[0, 120], phi_range
 
     return poses.numpy(), thetas.numpy(), phis.numpy(), radius.numpy()
 
+def pose_camera_arrays(opt, poses, thetas, phis, radius, fov, image_w, image_h):
+    # R/T of every pose with one batched inverse; all poses share the fov
+    matrix = np.linalg.inv(poses)
+    R = -np.transpose(matrix[:, :3, :3], (0, 2, 1))
+    R[:, :, 0] = -R[:, :, 0]
+    T = -matrix[:, :3, 3]
+    fovy = focal2fov(fov2focal(fov, image_h), image_w)
+    FovY = np.full(len(poses), fovy)
+    FovX = np.full(len(poses), fov)
+
+    # delta polar/azimuth/radius to default view
+    delta_polar = thetas - opt.default_polar
+    delta_azimuth = phis - opt.default_azimuth
+    delta_azimuth[delta_azimuth > 180] -= 360 # range in [-180, 180]
+    delta_radius = radius - opt.default_radius
+    return RandCameraArrays(R=R, T=T, FovY=FovY, FovX=FovX, width=image_w, height=image_h,
+                            delta_polar=delta_polar, delta_azimuth=delta_azimuth, delta_radius=delta_radius)
+
+def camInfos_from_arrays(arrays, uids=None):
+    uids = range(len(arrays.R)) if uids is None else uids
+    return [RandCameraInfo(uid=uid, R=arrays.R[idx], T=arrays.T[idx], FovY=float(arrays.FovY[idx]), FovX=float(arrays.FovX[idx]),
+                           width=arrays.width, height=arrays.height, delta_polar=arrays.delta_polar[idx],
+                           delta_azimuth=arrays.delta_azimuth[idx], delta_radius=arrays.delta_radius[idx])
+            for idx, uid in enumerate(uids)]
+
+def take_camera_arrays(arrays, indices):
+    # the cameras at indices, in that order
+    return arrays._replace(R=arrays.R[indices], T=arrays.T[indices], FovY=arrays.FovY[indices], FovX=arrays.FovX[indices],
+                           delta_polar=arrays.delta_polar[indices], delta_azimuth=arrays.delta_azimuth[indices],
+                           delta_radius=arrays.delta_radius[indices])
+
+def GenerateCircleCameraArrays(opt, size=8, render45 = False, indices=None):
+    # orbit video frames: size frames at the default polar, then (render45) size at 2/3 of it; indices picks a subset
+    indices = np.arange(size * 2 if render45 else size) if indices is None else np.asarray(indices)
+    ring, step = np.divmod(indices, size)
+    thetas = np.where(ring == 0, opt.default_polar, opt.default_polar*2//3).astype(np.float32)
+    phis = (step / size * 360).astype(np.float32)
+    radius = np.full(len(indices), opt.default_radius, dtype=np.float32)
+    poses = circle_poses(radius=torch.from_numpy(radius), theta=torch.from_numpy(thetas), phi=torch.from_numpy(phis),
+                         angle_overhead=opt.angle_overhead, angle_front=opt.angle_front)
+    return pose_camera_arrays(opt, poses, thetas, phis, radius, opt.default_fovy, opt.image_w, opt.image_h)
+
+def GenerateCircleCamera(opt, idx, size=8):
+    # frame idx of the orbit video, indices past size are on the render45 ring
+    return camInfos_from_arrays(GenerateCircleCameraArrays(opt, size, indices=[idx]), uids=[idx])[0]
+
 def GenerateCircleCameras(opt, size=8, render45 = False):
-    # random focal
-    fov = opt.default_fovy
-    cam_infos = []
     #generate specific data structure
-    for idx in range(size):
-        thetas = torch.FloatTensor([opt.default_polar])
-        phis = torch.FloatTensor([(idx / size) * 360])
-        radius = torch.FloatTensor([opt.default_radius])
-        # random pose on the fly
-        poses = circle_poses(radius=radius, theta=thetas, phi=phis, angle_overhead=opt.angle_overhead, angle_front=opt.angle_front)
-        matrix = np.linalg.inv(poses[0])
-        R = -np.transpose(matrix[:3,:3])
-        R[:,0] = -R[:,0]
-        T = -matrix[:3, 3]
-        fovy = focal2fov(fov2focal(fov, opt.image_h), opt.image_w)
-        FovY = fovy
-        FovX = fov
-
-        # delta polar/azimuth/radius to default view
-        delta_polar = thetas - opt.default_polar
-        delta_azimuth = phis - opt.default_azimuth
-        delta_azimuth[delta_azimuth > 180] -= 360 # range in [-180, 180]
-        delta_radius = radius - opt.default_radius
-        cam_infos.append(RandCameraInfo(uid=idx, R=R, T=T, FovY=FovY, FovX=FovX,width=opt.image_w, 
-                        height = opt.image_h, delta_polar = delta_polar,delta_azimuth = delta_azimuth, delta_radius = delta_radius))  
-    if render45:
-        for idx in range(size):
-            thetas = torch.FloatTensor([opt.default_polar*2//3])
-            phis = torch.FloatTensor([(idx / size) * 360])
-            radius = torch.FloatTensor([opt.default_radius])
-            # random pose on the fly
-            poses = circle_poses(radius=radius, theta=thetas, phi=phis, angle_overhead=opt.angle_overhead, angle_front=opt.angle_front)
-            matrix = np.linalg.inv(poses[0])
-            R = -np.transpose(matrix[:3,:3])
-            R[:,0] = -R[:,0]
-            T = -matrix[:3, 3]
-            fovy = focal2fov(fov2focal(fov, opt.image_h), opt.image_w)
-            FovY = fovy
-            FovX = fov
-
-            # delta polar/azimuth/radius to default view
-            delta_polar = thetas - opt.default_polar
-            delta_azimuth = phis - opt.default_azimuth
-            delta_azimuth[delta_azimuth > 180] -= 360 # range in [-180, 180]
-            delta_radius = radius - opt.default_radius
-            cam_infos.append(RandCameraInfo(uid=idx+size, R=R, T=T, FovY=FovY, FovX=FovX,width=opt.image_w, 
-                            height = opt.image_h, delta_polar = delta_polar,delta_azimuth = delta_azimuth, delta_radius = delta_radius))         
-    return cam_infos
-
+    return camInfos_from_arrays(GenerateCircleCameraArrays(opt, size, render45))
 
-def GenerateRandomCameras(opt, size=2000, SSAA=True):
+def GenerateRandomCameraArrays(opt, size=2000, SSAA=True):
     # random pose on the fly
     poses, thetas, phis, radius = rand_poses(size, opt, radius_range=opt.radius_range, theta_range=opt.theta_range, phi_range=opt.phi_range, 
                                              angle_overhead=opt.angle_overhead, angle_front=opt.angle_front, uniform_sphere_rate=opt.uniform_sphere_rate,
                                              rand_cam_gamma=opt.rand_cam_gamma)
-    # delta polar/azimuth/radius to default view
-    delta_polar = thetas - opt.default_polar
-    delta_azimuth = phis - opt.default_azimuth
-    delta_azimuth[delta_azimuth > 180] -= 360 # range in [-180, 180]
-    delta_radius = radius - opt.default_radius
     # random focal
     fov = random.random() * (opt.fovy_range[1] - opt.fovy_range[0]) + opt.fovy_range[0]
-    
-    cam_infos = []
 
     if SSAA:
         ssaa = opt.SSAA
@@ -411,53 +415,23 @@ def GenerateRandomCameras(opt, size=2000, SSAA=True):
 
     image_h = opt.image_h * ssaa
     image_w = opt.image_w * ssaa
+    return pose_camera_arrays(opt, poses, thetas, phis, radius, fov, image_w, image_h)
 
+def GenerateRandomCameras(opt, size=2000, SSAA=True):
     #generate specific data structure
-    for idx in range(size):
-        matrix = np.linalg.inv(poses[idx])
-        R = -np.transpose(matrix[:3,:3])
-        R[:,0] = -R[:,0]
-        T = -matrix[:3, 3]
-        # matrix = poses[idx]
-        # R = matrix[:3,:3]
-        # T = matrix[:3, 3]
-        fovy = focal2fov(fov2focal(fov, image_h), image_w)
-        FovY = fovy
-        FovX = fov
-
-        cam_infos.append(RandCameraInfo(uid=idx, R=R, T=T, FovY=FovY, FovX=FovX,width=image_w, 
-                                        height=image_h, delta_polar = delta_polar[idx],
-                                        delta_azimuth = delta_azimuth[idx], delta_radius = delta_radius[idx]))           
-    return cam_infos
+    return camInfos_from_arrays(GenerateRandomCameraArrays(opt, size, SSAA))
 
-def GeneratePurnCameras(opt, size=300):
+def GeneratePurnCameraArrays(opt, size=300):
     # random pose on the fly
     poses, thetas, phis, radius = rand_poses(size, opt, radius_range=[opt.default_radius,opt.default_radius+0.1], theta_range=opt.theta_range, phi_range=opt.phi_range, angle_overhead=opt.angle_overhead, angle_front=opt.angle_front, uniform_sphere_rate=opt.uniform_sphere_rate)
-    # delta polar/azimuth/radius to default view
-    delta_polar = thetas - opt.default_polar
-    delta_azimuth = phis - opt.default_azimuth
-    delta_azimuth[delta_azimuth > 180] -= 360 # range in [-180, 180]
-    delta_radius = radius - opt.default_radius
     # random focal
     #fov = random.random() * (opt.fovy_range[1] - opt.fovy_range[0]) + opt.fovy_range[0]
     fov = opt.default_fovy
-    cam_infos = []
+    return pose_camera_arrays(opt, poses, thetas, phis, radius, fov, opt.image_w, opt.image_h)
+
+def GeneratePurnCameras(opt, size=300):
     #generate specific data structure
-    for idx in range(size):
-        matrix = np.linalg.inv(poses[idx])     
-        R = -np.transpose(matrix[:3,:3])
-        R[:,0] = -R[:,0]
-        T = -matrix[:3, 3]
-        # matrix = poses[idx]
-        # R = matrix[:3,:3]
-        # T = matrix[:3, 3]
-        fovy = focal2fov(fov2focal(fov, opt.image_h), opt.image_w)
-        FovY = fovy
-        FovX = fov
-
-        cam_infos.append(RandCameraInfo(uid=idx, R=R, T=T, FovY=FovY, FovX=FovX,width=opt.image_w, 
-                        height = opt.image_h, delta_polar = delta_polar[idx],delta_azimuth = delta_azimuth[idx], delta_radius = delta_radius[idx]))           
-    return cam_infos
+    return camInfos_from_arrays(GeneratePurnCameraArrays(opt, size))
 
 sceneLoadTypeCallbacks = {
     # "Colmap": readColmapSceneInfo,
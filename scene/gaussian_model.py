@@ -10,14 +10,19 @@
 #
 
 import torch
+import math
 import numpy as np
-from utils.general_utils import inverse_sigmoid, get_expon_lr_func, build_rotation
+from utils.general_utils import inverse_sigmoid, get_expon_lr_func, build_rotation, knn_dist2
 from torch import nn
 import os
 from utils.system_utils import mkdir_p
+from utils.ply_utils import vertex_array, write_binary_ply, load_vertex_matrix
 from plyfile import PlyData, PlyElement
 from utils.sh_utils import RGB2SH,SH2RGB
-from simple_knn._C import distCUDA2
+try:
+    from simple_knn._C import distCUDA2
+except ImportError:
+    distCUDA2 = None
 from utils.graphics_utils import BasicPointCloud
 from utils.general_utils import strip_symmetric, build_scaling_rotation
 # from .resnet import *
@@ -42,7 +47,8 @@ class GaussianModel:
         self.rotation_activation = torch.nn.functional.normalize
 
 
-    def __init__(self, sh_degree : int):
+    def __init__(self, sh_degree : int, device="cuda"):
+        self.device = torch.device(device)
         self.active_sh_degree = 0
         self.max_sh_degree = sh_degree  
         self._xyz = torch.empty(0)
@@ -58,21 +64,35 @@ class GaussianModel:
         self.optimizer = None
         self.percent_dense = 0
         self.spatial_lr_scale = 0
+        self.pool_growth = None
+        self._pool = {}
+        self._activation_cache = {}
         self.setup_functions()
 
+    @staticmethod
+    def _snapshot(tensor):
+        # with pooled storage tensors are prefix views of capacity buffers and torch.save would write the
+        # whole buffer, so checkpoints get compact copies
+        if isinstance(tensor, nn.Parameter):
+            return nn.Parameter(tensor.detach().clone())
+        return tensor.detach().clone() if torch.is_tensor(tensor) else tensor
+
     def capture(self):
+        optimizer_state = self.optimizer.state_dict()
+        optimizer_state["state"] = {idx: {k: self._snapshot(v) for k, v in state.items()}
+                                    for idx, state in optimizer_state["state"].items()}
         return (
             self.active_sh_degree,
-            self._xyz,
-            self._features_dc,
-            self._features_rest,
-            self._scaling,
-            self._rotation,
-            self._opacity,
-            self.max_radii2D,
-            self.xyz_gradient_accum,
-            self.denom,
-            self.optimizer.state_dict(),
+            self._snapshot(self._xyz),
+            self._snapshot(self._features_dc),
+            self._snapshot(self._features_rest),
+            self._snapshot(self._scaling),
+            self._snapshot(self._rotation),
+            self._snapshot(self._opacity),
+            self._snapshot(self.max_radii2D),
+            self._snapshot(self.xyz_gradient_accum),
+            self._snapshot(self.denom),
+            optimizer_state,
             self.spatial_lr_scale,
         )
     
@@ -94,13 +114,40 @@ class GaussianModel:
         self.denom = denom
         self.optimizer.load_state_dict(opt_dict)
 
+    def _cached_activation(self, name, fn, *params):
+        # Activated tensors are reused until a parameter is replaced (densification, loading) or
+        # modified in place (optimizer step bumps its version). Grad and no-grad results are kept apart.
+        # The cache is also cleared explicitly after every optimizer step, densification and training_setup,
+        # and a grad entry is dropped as soon as backward runs through it, since backward frees its graph.
+        key = (name, torch.is_grad_enabled())
+        version = tuple((id(p), p._version) for p in params)
+        entry = self._activation_cache.get(key, None)
+        if entry is not None and entry[0] == version:
+            return entry[2]
+        value = fn()
+        # the entry keeps its parameters alive so their ids cannot be reused while cached
+        self._activation_cache[key] = (version, params, value)
+        if value.requires_grad:
+            # hook on the id, not the tensor, so the tensor does not reference itself through its hook
+            value_id = id(value)
+            value.register_hook(lambda grad: self._drop_activation(key, value_id))
+        return value
+
+    def _drop_activation(self, key, value_id):
+        entry = self._activation_cache.get(key, None)
+        if entry is not None and id(entry[2]) == value_id:
+            del self._activation_cache[key]
+
+    def invalidate_activation_cache(self):
+        self._activation_cache = {}
+
     @property
     def get_scaling(self):
-        return self.scaling_activation(self._scaling)
+        return self._cached_activation("scaling", lambda: self.scaling_activation(self._scaling), self._scaling)
     
     @property
     def get_rotation(self):
-        return self.rotation_activation(self._rotation)
+        return self._cached_activation("rotation", lambda: self.rotation_activation(self._rotation), self._rotation)
     
     @property
     def get_xyz(self):
@@ -112,13 +159,12 @@ class GaussianModel:
 
     @property
     def get_features(self):
-        features_dc = self._features_dc
-        features_rest = self._features_rest
-        return torch.cat((features_dc, features_rest), dim=1)
+        return self._cached_activation("features", lambda: torch.cat((self._features_dc, self._features_rest), dim=1),
+                                       self._features_dc, self._features_rest)
     
     @property
     def get_opacity(self):
-        return self.opacity_activation(self._opacity)
+        return self._cached_activation("opacity", lambda: self.opacity_activation(self._opacity), self._opacity)
     
     def get_covariance(self, scaling_modifier = 1):
         return self.covariance_activation(self.get_scaling, scaling_modifier, self._rotation)
@@ -129,20 +175,24 @@ class GaussianModel:
 
     def create_from_pcd(self, pcd : BasicPointCloud, spatial_lr_scale : float):
         self.spatial_lr_scale = spatial_lr_scale
-        fused_point_cloud = torch.tensor(np.asarray(pcd.points)).float().cuda()
-        fused_color = RGB2SH(torch.tensor(np.asarray(pcd.colors))).float().cuda() #RGB2SH(
-        features = torch.zeros((fused_color.shape[0], 3, (self.max_sh_degree + 1) ** 2)).float().cuda()
+        fused_point_cloud = torch.tensor(np.asarray(pcd.points)).float().to(self.device)
+        fused_color = RGB2SH(torch.tensor(np.asarray(pcd.colors))).float().to(self.device) #RGB2SH(
+        features = torch.zeros((fused_color.shape[0], 3, (self.max_sh_degree + 1) ** 2)).float().to(self.device)
         features[:, :3, 0 ] = fused_color
         features[:, 3:, 1:] = 0.0
 
         print("Number of points at initialisation : ", fused_point_cloud.shape[0])
 
-        dist2 = torch.clamp_min(distCUDA2(torch.from_numpy(np.asarray(pcd.points)).float().cuda()), 0.0000001)
+        points = torch.from_numpy(np.asarray(pcd.points)).float().to(self.device)
+        if distCUDA2 is not None and points.is_cuda:
+            dist2 = torch.clamp_min(distCUDA2(points), 0.0000001)
+        else:
+            dist2 = torch.clamp_min(knn_dist2(points), 0.0000001)
         scales = torch.log(torch.sqrt(dist2))[...,None].repeat(1, 3)
-        rots = torch.zeros((fused_point_cloud.shape[0], 4), device="cuda")
+        rots = torch.zeros((fused_point_cloud.shape[0], 4), device=self.device)
         rots[:, 0] = 1
 
-        opacities = inverse_sigmoid(0.1 * torch.ones((fused_point_cloud.shape[0], 1), dtype=torch.float, device="cuda"))
+        opacities = inverse_sigmoid(0.1 * torch.ones((fused_point_cloud.shape[0], 1), dtype=torch.float, device=self.device))
 
         self._xyz = nn.Parameter(fused_point_cloud.requires_grad_(True))
         self._features_dc = nn.Parameter(features[:,:,0:1].transpose(1, 2).contiguous().requires_grad_(True))
@@ -150,13 +200,15 @@ class GaussianModel:
         self._scaling = nn.Parameter(scales.requires_grad_(True))
         self._rotation = nn.Parameter(rots.requires_grad_(True))
         self._opacity = nn.Parameter(opacities.requires_grad_(True))
-        self._background = nn.Parameter(torch.zeros((3,1,1), device="cuda").requires_grad_(True))
-        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
+        self._background = nn.Parameter(torch.zeros((3,1,1), device=self.device).requires_grad_(True))
+        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device=self.device)
 
     def training_setup(self, training_args):
         self.percent_dense = training_args.percent_dense
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
+        self.pool_growth = training_args.pool_growth_factor if training_args.pooled_densification else None
+        self._pool = {}
+        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
+        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device=self.device)
 
         l = [
             {'params': [self._xyz], 'lr': training_args.position_lr_init * self.spatial_lr_scale, "name": "xyz"},
@@ -169,6 +221,8 @@ class GaussianModel:
         ]
         
         self.optimizer = torch.optim.Adam(l, lr=0.0, eps=1e-15)
+        self.optimizer.register_step_post_hook(lambda optimizer, args, kwargs: self.invalidate_activation_cache())
+        self.invalidate_activation_cache()
         self.xyz_scheduler_args = get_expon_lr_func(lr_init=training_args.position_lr_init*self.spatial_lr_scale,
                                                     lr_final=training_args.position_lr_final*self.spatial_lr_scale,
                                                     lr_delay_mult=training_args.position_lr_delay_mult,
@@ -236,7 +290,7 @@ class GaussianModel:
             l.append('rot_{}'.format(i))
         return l
 
-    def save_ply(self, path):
+    def save_ply(self, path, rgb_dump="txt"):
         mkdir_p(os.path.dirname(path))
 
         xyz = self._xyz.detach().cpu().numpy()
@@ -249,12 +303,15 @@ class GaussianModel:
 
         dtype_full = [(attribute, 'f4') for attribute in self.construct_list_of_attributes()]
 
-        elements = np.empty(xyz.shape[0], dtype=dtype_full)
         attributes = np.concatenate((xyz, normals, f_dc, f_rest, opacities, scale, rotation), axis=1)
-        elements[:] = list(map(tuple, attributes))
-        el = PlyElement.describe(elements, 'vertex')
-        PlyData([el]).write(path)
-        np.savetxt(os.path.join(os.path.split(path)[0],"point_cloud_rgb.txt"),np.concatenate((xyz, SH2RGB(f_dc)), axis=1))
+        elements = vertex_array(attributes, dtype_full)
+        write_binary_ply(path, elements)
+
+        # xyz + rgb dump next to the ply: "npy" (binary), "txt" (text) or "none"
+        if rgb_dump == "npy":
+            np.save(os.path.join(os.path.split(path)[0],"point_cloud_rgb.npy"), np.concatenate((xyz, SH2RGB(f_dc)), axis=1))
+        elif rgb_dump == "txt":
+            np.savetxt(os.path.join(os.path.split(path)[0],"point_cloud_rgb.txt"),np.concatenate((xyz, SH2RGB(f_dc)), axis=1))
 
     def reset_opacity(self):
         opacities_new = inverse_sigmoid(torch.min(self.get_opacity, torch.ones_like(self.get_opacity)*0.01))
@@ -262,8 +319,48 @@ class GaussianModel:
         self._opacity = optimizable_tensors["opacity"]
 
     def load_ply(self, path):
-        plydata = PlyData.read(path)
+        vertex_matrix = load_vertex_matrix(path)
+        if vertex_matrix is not None:
+            xyz, features_dc, features_extra, opacities, scales, rots = self.attributes_from_vertex_matrix(*vertex_matrix)
+        else:
+            xyz, features_dc, features_extra, opacities, scales, rots = self.attributes_from_plydata(PlyData.read(path))
+
+        self._xyz = nn.Parameter(torch.as_tensor(xyz, dtype=torch.float, device=self.device).requires_grad_(True))
+        self._features_dc = nn.Parameter(torch.as_tensor(features_dc, dtype=torch.float, device=self.device).transpose(1, 2).contiguous().requires_grad_(True))
+        self._features_rest = nn.Parameter(torch.as_tensor(features_extra, dtype=torch.float, device=self.device).transpose(1, 2).contiguous().requires_grad_(True))
+        self._opacity = nn.Parameter(torch.as_tensor(opacities, dtype=torch.float, device=self.device).requires_grad_(True))
+        self._scaling = nn.Parameter(torch.as_tensor(scales, dtype=torch.float, device=self.device).requires_grad_(True))
+        self._rotation = nn.Parameter(torch.as_tensor(rots, dtype=torch.float, device=self.device).requires_grad_(True))
+        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device=self.device)
+        self.active_sh_degree = self.max_sh_degree
+
+    def attributes_from_vertex_matrix(self, matrix, names):
+        # Attributes are strided views of the mapped (N, F) float32 body when their columns are consecutive,
+        # which is the layout save_ply writes; any other column order falls back to a gathered copy
+        data = torch.from_numpy(matrix)
+        column = {name: idx for idx, name in enumerate(names)}
+
+        def select(attr_names):
+            idx = [column[name] for name in attr_names]
+            if idx == list(range(idx[0], idx[0] + len(idx))):
+                return data[:, idx[0]:idx[0] + len(idx)]
+            return data[:, idx]
+
+        def columns(prefix):
+            return select(sorted([name for name in names if name.startswith(prefix)], key = lambda x: int(x.split('_')[-1])))
 
+        xyz = select(["x", "y", "z"])
+        opacities = select(["opacity"])
+        features_dc = select(["f_dc_0", "f_dc_1", "f_dc_2"]).reshape(-1, 3, 1)
+
+        features_extra = columns("f_rest_")
+        assert features_extra.shape[1]==3*(self.max_sh_degree + 1) ** 2 - 3
+        # Reshape (P,F*SH_coeffs) to (P, F, SH_coeffs except DC)
+        features_extra = features_extra.reshape((features_extra.shape[0], 3, (self.max_sh_degree + 1) ** 2 - 1))
+
+        return xyz, features_dc, features_extra, opacities, columns("scale_"), columns("rot")
+
+    def attributes_from_plydata(self, plydata):
         xyz = np.stack((np.asarray(plydata.elements[0]["x"]),
                         np.asarray(plydata.elements[0]["y"]),
                         np.asarray(plydata.elements[0]["z"])),  axis=1)
@@ -295,16 +392,10 @@ class GaussianModel:
         for idx, attr_name in enumerate(rot_names):
             rots[:, idx] = np.asarray(plydata.elements[0][attr_name])
 
-        self._xyz = nn.Parameter(torch.tensor(xyz, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._features_dc = nn.Parameter(torch.tensor(features_dc, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._features_rest = nn.Parameter(torch.tensor(features_extra, dtype=torch.float, device="cuda").transpose(1, 2).contiguous().requires_grad_(True))
-        self._opacity = nn.Parameter(torch.tensor(opacities, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._scaling = nn.Parameter(torch.tensor(scales, dtype=torch.float, device="cuda").requires_grad_(True))
-        self._rotation = nn.Parameter(torch.tensor(rots, dtype=torch.float, device="cuda").requires_grad_(True))
-        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
-        self.active_sh_degree = self.max_sh_degree
+        return xyz, features_dc, features_extra, opacities, scales, rots
 
     def replace_tensor_to_optimizer(self, tensor, name):
+        self.invalidate_activation_cache()
         optimizable_tensors = {}
         for group in self.optimizer.param_groups:
             if group["name"] not in ['background']:
@@ -320,27 +411,89 @@ class GaussianModel:
                     optimizable_tensors[group["name"]] = group["params"][0]
         return optimizable_tensors
 
-    def _prune_optimizer(self, mask):
+    def _pool_buffer(self, key, like, rows):
+        # Preallocated storage for `key` with room for at least `rows` rows shaped like `like`
+        buf = self._pool.get(key, None)
+        if buf is None or buf.shape[0] < rows or buf.shape[1:] != like.shape[1:] or buf.dtype != like.dtype or buf.device != like.device:
+            capacity = max(rows, int(math.ceil(rows * self.pool_growth)))
+            buf = torch.empty((capacity,) + tuple(like.shape[1:]), dtype=like.dtype, device=like.device)
+            self._pool[key] = buf
+        return buf
+
+    def _resize_rows(self, key, tensor, keep=None, extension=None):
+        # Returns tensor[keep] followed by `extension` (a tensor, or a number of zero rows); keep is a mask or row indices.
+        # In pooled mode the result is a prefix view of a capacity buffer: appending only writes the new rows and
+        # pruning gathers the kept rows straight into the key's spare buffer, which then becomes the live one,
+        # so nothing is allocated until the capacity runs out.
+        with torch.no_grad():
+            if self.pool_growth is None:
+                if keep is not None:
+                    tensor = tensor[keep]
+                if isinstance(extension, int):
+                    extension = torch.zeros((extension,) + tuple(tensor.shape[1:]), dtype=tensor.dtype, device=tensor.device)
+                if extension is not None:
+                    tensor = torch.cat((tensor, extension), dim=0)
+                return tensor
+
+            num_new = extension if isinstance(extension, int) else (0 if extension is None else extension.shape[0])
+            if keep is None:
+                num_kept = tensor.shape[0]
+                buf = self._pool_buffer(key, tensor, num_kept + num_new)
+                # tensors already living at the front of the buffer stay where they are
+                if tensor.data_ptr() != buf.data_ptr():
+                    buf[:num_kept] = tensor
+            else:
+                keep = self._keep_indices(keep)
+                num_kept = keep.shape[0]
+                spare = (key, "spare")
+                buf = self._pool_buffer(spare, tensor, num_kept + num_new)
+                torch.index_select(tensor, 0, keep, out=buf[:num_kept])
+                self._pool[key], self._pool[spare] = buf, self._pool.get(key, None)
+            if isinstance(extension, int):
+                buf[num_kept:num_kept + num_new].zero_()
+            elif extension is not None:
+                buf[num_kept:num_kept + num_new] = extension
+            return buf[:num_kept + num_new]
+
+    @staticmethod
+    def _keep_indices(keep):
+        # boolean masks become row indices once, so callers resizing many tensors pay for a single nonzero() sync
+        if keep is not None and keep.dtype == torch.bool:
+            keep = keep.nonzero().squeeze(1)
+        return keep
+
+    def _zeros(self, key, shape):
+        if self.pool_growth is None:
+            return torch.zeros(shape, device=self.device)
+        return self._resize_rows(key, torch.empty((0,) + tuple(shape[1:]), device=self.device), extension=shape[0])
+
+    def _update_optimizer(self, keep=None, tensors_dict=None):
+        # Rebuilds every point parameter as param[keep] followed by tensors_dict[name]; Adam moments follow with zeros
+        self.invalidate_activation_cache()
         optimizable_tensors = {}
+        keep = self._keep_indices(keep)
         for group in self.optimizer.param_groups:
-            stored_state = self.optimizer.state.get(group['params'][0], None)
             if group["name"] not in ['background']:
+                assert len(group["params"]) == 1
+                extension_tensor = None if tensors_dict is None else tensors_dict[group["name"]]
+                stored_state = self.optimizer.state.get(group['params'][0], None)
                 if stored_state is not None:
-                    stored_state["exp_avg"] = stored_state["exp_avg"][mask]
-                    stored_state["exp_avg_sq"] = stored_state["exp_avg_sq"][mask]
-
+                    num_new = None if extension_tensor is None else extension_tensor.shape[0]
+                    stored_state["exp_avg"] = self._resize_rows((group["name"], "exp_avg"), stored_state["exp_avg"], keep, num_new)
+                    stored_state["exp_avg_sq"] = self._resize_rows((group["name"], "exp_avg_sq"), stored_state["exp_avg_sq"], keep, num_new)
                     del self.optimizer.state[group['params'][0]]
-                    group["params"][0] = nn.Parameter((group["params"][0][mask].requires_grad_(True)))
-                    self.optimizer.state[group['params'][0]] = stored_state
 
-                    optimizable_tensors[group["name"]] = group["params"][0]
-                else:
-                    group["params"][0] = nn.Parameter(group["params"][0][mask].requires_grad_(True))
-                    optimizable_tensors[group["name"]] = group["params"][0]
+                group["params"][0] = nn.Parameter(self._resize_rows((group["name"], "param"), group["params"][0], keep, extension_tensor))
+                if stored_state is not None:
+                    self.optimizer.state[group['params'][0]] = stored_state
+                optimizable_tensors[group["name"]] = group["params"][0]
         return optimizable_tensors
 
+    def _prune_optimizer(self, mask):
+        return self._update_optimizer(keep=mask)
+
     def prune_points(self, mask):
-        valid_points_mask = ~mask
+        valid_points_mask = self._keep_indices(~mask)
         optimizable_tensors = self._prune_optimizer(valid_points_mask)
 
         self._xyz = optimizable_tensors["xyz"]
@@ -350,42 +503,52 @@ class GaussianModel:
         self._scaling = optimizable_tensors["scaling"]
         self._rotation = optimizable_tensors["rotation"]
 
-        self.xyz_gradient_accum = self.xyz_gradient_accum[valid_points_mask]
-
-        self.denom = self.denom[valid_points_mask]
-        self.max_radii2D = self.max_radii2D[valid_points_mask]
+        self.xyz_gradient_accum = self._resize_rows("xyz_gradient_accum", self.xyz_gradient_accum, valid_points_mask)
 
-    def cat_tensors_to_optimizer(self, tensors_dict):
-        optimizable_tensors = {}
-        for group in self.optimizer.param_groups:
-            if group["name"] not in ['background']:
-                assert len(group["params"]) == 1
-                extension_tensor = tensors_dict[group["name"]]
-                stored_state = self.optimizer.state.get(group['params'][0], None)
-                if stored_state is not None:
-                    stored_state["exp_avg"] = torch.cat((stored_state["exp_avg"], torch.zeros_like(extension_tensor)), dim=0)
-                    stored_state["exp_avg_sq"] = torch.cat((stored_state["exp_avg_sq"], torch.zeros_like(extension_tensor)), dim=0)
+        self.denom = self._resize_rows("denom", self.denom, valid_points_mask)
+        self.max_radii2D = self._resize_rows("max_radii2D", self.max_radii2D, valid_points_mask)
 
-                    del self.optimizer.state[group['params'][0]]
-                    group["params"][0] = nn.Parameter(torch.cat((group["params"][0], extension_tensor), dim=0).requires_grad_(True))
-                    self.optimizer.state[group['params'][0]] = stored_state
-
-                    optimizable_tensors[group["name"]] = group["params"][0]
-                else:
-                    group["params"][0] = nn.Parameter(torch.cat((group["params"][0], extension_tensor), dim=0).requires_grad_(True))
-                    optimizable_tensors[group["name"]] = group["params"][0]
+    def _prune_candidates(self, opacity, scaling, min_opacity, extent, max_screen_size):
+        prune_mask = (self.opacity_activation(opacity) < min_opacity).squeeze(-1)
+        if max_screen_size:
+            # the screen-space test (max_radii2D > max_screen_size) never fires at this point:
+            # densification resets max_radii2D to zero before pruning, so only the world-space test remains
+            big_points_ws = self.scaling_activation(scaling).max(dim=1).values > 0.1 * extent
+            prune_mask = torch.logical_or(prune_mask, big_points_ws)
+        return prune_mask
 
-        return optimizable_tensors
+    def densify_and_prune(self, max_grad, min_opacity, extent, max_screen_size, N=2):
+        grads = self.xyz_gradient_accum / self.denom
+        grads[grads.isnan()] = 0.0
 
-    def densification_postfix(self, new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation):
-        d = {"xyz": new_xyz,
-        "f_dc": new_features_dc,
-        "f_rest": new_features_rest,
-        "opacity": new_opacities,
-        "scaling" : new_scaling,
-        "rotation" : new_rotation}
+        # Plan clone, split and prune together (same decisions as clone -> split -> prune),
+        # then apply them to the parameters and optimizer state in a single pass.
+        high_grad = torch.norm(grads, dim=-1) >= max_grad
+        large = torch.max(self.get_scaling, dim=1).values > self.percent_dense*extent
+        clone_mask = torch.logical_and(high_grad, ~large)
+        split_mask = torch.logical_and(high_grad, large)
 
-        optimizable_tensors = self.cat_tensors_to_optimizer(d)
+        stds = self.get_scaling[split_mask].repeat(N,1)
+        means = torch.zeros((stds.size(0), 3),device=self.device)
+        samples = torch.normal(mean=means, std=stds)
+        rots = build_rotation(self._rotation[split_mask]).repeat(N,1,1)
+        split_xyz = torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1) + self.get_xyz[split_mask].repeat(N, 1)
+        split_scaling = self.scaling_inverse_activation(self.get_scaling[split_mask].repeat(N,1) / (0.8*N))
+
+        # new points: clones first, then split children
+        d = {"xyz": torch.cat((self._xyz[clone_mask], split_xyz), dim=0),
+        "f_dc": torch.cat((self._features_dc[clone_mask], self._features_dc[split_mask].repeat(N,1,1)), dim=0),
+        "f_rest": torch.cat((self._features_rest[clone_mask], self._features_rest[split_mask].repeat(N,1,1)), dim=0),
+        "opacity": torch.cat((self._opacity[clone_mask], self._opacity[split_mask].repeat(N,1)), dim=0),
+        "scaling" : torch.cat((self._scaling[clone_mask], split_scaling), dim=0),
+        "rotation" : torch.cat((self._rotation[clone_mask], self._rotation[split_mask].repeat(N,1)), dim=0)}
+
+        # split parents are replaced by their children; everything else goes through the prune test
+        keep_mask = torch.logical_and(~split_mask, ~self._prune_candidates(self._opacity, self._scaling, min_opacity, extent, max_screen_size))
+        keep_new = ~self._prune_candidates(d["opacity"], d["scaling"], min_opacity, extent, max_screen_size)
+        d = {name: tensor[keep_new] for name, tensor in d.items()}
+
+        optimizable_tensors = self._update_optimizer(keep=keep_mask, tensors_dict=d)
         self._xyz = optimizable_tensors["xyz"]
         self._features_dc = optimizable_tensors["f_dc"]
         self._features_rest = optimizable_tensors["f_rest"]
@@ -393,66 +556,25 @@ class GaussianModel:
         self._scaling = optimizable_tensors["scaling"]
         self._rotation = optimizable_tensors["rotation"]
 
-        self.xyz_gradient_accum = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.denom = torch.zeros((self.get_xyz.shape[0], 1), device="cuda")
-        self.max_radii2D = torch.zeros((self.get_xyz.shape[0]), device="cuda")
-
-    def densify_and_split(self, grads, grad_threshold, scene_extent, N=2):
-        n_init_points = self.get_xyz.shape[0]
-        # Extract points that satisfy the gradient condition
-        padded_grad = torch.zeros((n_init_points), device="cuda")
-        padded_grad[:grads.shape[0]] = grads.squeeze()
-        selected_pts_mask = torch.where(padded_grad >= grad_threshold, True, False)
-        selected_pts_mask = torch.logical_and(selected_pts_mask,
-                                              torch.max(self.get_scaling, dim=1).values > self.percent_dense*scene_extent)
-
-        stds = self.get_scaling[selected_pts_mask].repeat(N,1)
-        means =torch.zeros((stds.size(0), 3),device="cuda")
-        samples = torch.normal(mean=means, std=stds)
-        rots = build_rotation(self._rotation[selected_pts_mask]).repeat(N,1,1)
-        new_xyz = torch.bmm(rots, samples.unsqueeze(-1)).squeeze(-1) + self.get_xyz[selected_pts_mask].repeat(N, 1)
-        new_scaling = self.scaling_inverse_activation(self.get_scaling[selected_pts_mask].repeat(N,1) / (0.8*N))
-        new_rotation = self._rotation[selected_pts_mask].repeat(N,1)
-        new_features_dc = self._features_dc[selected_pts_mask].repeat(N,1,1)
-        new_features_rest = self._features_rest[selected_pts_mask].repeat(N,1,1)
-        new_opacity = self._opacity[selected_pts_mask].repeat(N,1)
-
-        self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacity, new_scaling, new_rotation)
-
-        prune_filter = torch.cat((selected_pts_mask, torch.zeros(N * selected_pts_mask.sum(), device="cuda", dtype=bool)))
-        self.prune_points(prune_filter)
-
-    def densify_and_clone(self, grads, grad_threshold, scene_extent):
-        # Extract points that satisfy the gradient condition
-        selected_pts_mask = torch.where(torch.norm(grads, dim=-1) >= grad_threshold, True, False)
-        selected_pts_mask = torch.logical_and(selected_pts_mask,
-                                              torch.max(self.get_scaling, dim=1).values <= self.percent_dense*scene_extent)
-        
-        new_xyz = self._xyz[selected_pts_mask]
-        new_features_dc = self._features_dc[selected_pts_mask]
-        new_features_rest = self._features_rest[selected_pts_mask]
-        new_opacities = self._opacity[selected_pts_mask]
-        new_scaling = self._scaling[selected_pts_mask]
-        new_rotation = self._rotation[selected_pts_mask]
-
-        self.densification_postfix(new_xyz, new_features_dc, new_features_rest, new_opacities, new_scaling, new_rotation)
-
-    def densify_and_prune(self, max_grad, min_opacity, extent, max_screen_size):
-        grads = self.xyz_gradient_accum / self.denom
-        grads[grads.isnan()] = 0.0
-
-        self.densify_and_clone(grads, max_grad, extent)
-        self.densify_and_split(grads, max_grad, extent)
-
-        prune_mask = (self.get_opacity < min_opacity).squeeze()
-        if max_screen_size:
-            big_points_vs = self.max_radii2D > max_screen_size
-            big_points_ws = self.get_scaling.max(dim=1).values > 0.1 * extent
-            prune_mask = torch.logical_or(torch.logical_or(prune_mask, big_points_vs), big_points_ws)
-        self.prune_points(prune_mask)
+        self.xyz_gradient_accum = self._zeros("xyz_gradient_accum", (self.get_xyz.shape[0], 1))
+        self.denom = self._zeros("denom", (self.get_xyz.shape[0], 1))
+        self.max_radii2D = self._zeros("max_radii2D", (self.get_xyz.shape[0],))
 
-        torch.cuda.empty_cache()
+        if self.pool_growth is None and self.device.type == "cuda":
+            torch.cuda.empty_cache()
 
     def add_densification_stats(self, viewspace_point_tensor, update_filter):
-        self.xyz_gradient_accum[update_filter] += torch.norm(viewspace_point_tensor.grad[update_filter,:2], dim=-1, keepdim=True)
-        self.denom[update_filter] += 1
\ No newline at end of file
+        # Accepts a single view (P, 3) / (P,) or a stack of views (C, P, 3) / (C, P).
+        # Masked sums instead of boolean indexing keep this free of host syncs.
+        grad = viewspace_point_tensor.grad
+        if grad.dim() == 2:
+            grad, update_filter = grad[None], update_filter[None]
+        mask = update_filter.unsqueeze(-1).to(grad.dtype)
+        self.xyz_gradient_accum += (torch.norm(grad[..., :2], dim=-1, keepdim=True) * mask).sum(dim=0)
+        self.denom += mask.sum(dim=0)
+
+    def add_max_radii2D(self, radii):
+        # Keep track of max radii in image-space for pruning; radii is (P,) or (C, P), zero where not visible
+        if radii.dim() == 2:
+            radii = radii.amax(dim=0)
+        torch.maximum(self.max_radii2D, radii.to(self.max_radii2D.dtype), out=self.max_radii2D)
\ No newline at end of file
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the repo is not an installed package, tests import its modules from the checkout
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,25 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from guidance.embedding_cache import TextEmbeddingCache
+
+
+class FakeTokenizer:
+    name_or_path = "tokenizer"
+    model_max_length = 77
+
+    def __len__(self):
+        return 49408
+
+
+def test_cache_entries_are_keyed_by_precision(tmp_path):
+    fp32 = TextEmbeddingCache(str(tmp_path), "model", [FakeTokenizer()], torch.float32)
+    fp16 = TextEmbeddingCache(str(tmp_path), "model", [FakeTokenizer()], torch.float16)
+    fp32.save("a prompt", torch.randn(1, 77, 8), torch.randn(1, 8))
+
+    assert fp32.contains(["a prompt"])
+    assert not fp16.contains(["a prompt"])
+    assert fp16.load("a prompt", "cpu") is None
+    prompt_embeds, pooled_prompt_embeds = fp32.load("a prompt", "cpu")
+    assert prompt_embeds.dtype == torch.float32 and pooled_prompt_embeds.dtype == torch.float32
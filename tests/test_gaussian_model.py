@@ -0,0 +1,140 @@
+from argparse import ArgumentParser
+
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from arguments import OptimizationParams
+from scene.gaussian_model import GaussianModel
+from utils.graphics_utils import BasicPointCloud
+from utils.ply_utils import load_vertex_matrix, read_ply_header
+
+NAMES = ["xyz", "f_dc", "f_rest", "opacity", "scaling", "rotation"]
+
+
+def make_model(pooled, num_pts=400):
+    rng = np.random.default_rng(0)
+    pcd = BasicPointCloud(points=rng.normal(size=(num_pts, 3)), colors=rng.uniform(size=(num_pts, 3)), normals=np.zeros((num_pts, 3)))
+    gaussians = GaussianModel(1, device="cpu")
+    gaussians.create_from_pcd(pcd, 1.0)
+    opt = OptimizationParams(ArgumentParser())
+    opt.pooled_densification = pooled
+    gaussians.training_setup(opt)
+    return gaussians
+
+
+def optimizer_step(gaussians, seed):
+    # deterministic fake gradients, so both models take the same Adam steps
+    generator = torch.Generator().manual_seed(seed)
+    gaussians.optimizer.zero_grad(set_to_none=True)
+    for group in gaussians.optimizer.param_groups:
+        param = group["params"][0]
+        param.grad = torch.randn(param.shape, generator=generator)
+    gaussians.optimizer.step()
+
+
+def densify_cycle(gaussians, seed):
+    generator = torch.Generator().manual_seed(seed)
+    num_pts = gaussians.get_xyz.shape[0]
+    gaussians.xyz_gradient_accum += torch.rand((num_pts, 1), generator=generator) * 0.002
+    gaussians.denom += 1
+    gaussians.max_radii2D = torch.rand((num_pts,), generator=generator) * 30
+    torch.manual_seed(seed)
+    gaussians.densify_and_prune(0.0008, 0.3, 1.0, 20)
+    optimizer_step(gaussians, seed)
+    gaussians.prune_points(torch.rand((gaussians.get_xyz.shape[0],), generator=generator) < 0.2)
+    optimizer_step(gaussians, seed + 1)
+
+
+def state(gaussians):
+    params = {group["name"]: group["params"][0] for group in gaussians.optimizer.param_groups if group["name"] in NAMES}
+    return {name: (param.detach().clone(), gaussians.optimizer.state[param]["exp_avg"].clone(),
+                   gaussians.optimizer.state[param]["exp_avg_sq"].clone()) for name, param in params.items()}
+
+
+def test_pooled_densification_matches_reallocation():
+    plain, pooled = make_model(False), make_model(True)
+    optimizer_step(plain, 0)
+    optimizer_step(pooled, 0)
+    for cycle in range(3):
+        densify_cycle(plain, 10 * cycle + 1)
+        densify_cycle(pooled, 10 * cycle + 1)
+
+    plain_state, pooled_state = state(plain), state(pooled)
+    for name in NAMES:
+        for expected, actual in zip(plain_state[name], pooled_state[name]):
+            assert torch.equal(expected, actual), name
+    for name in ["xyz_gradient_accum", "denom", "max_radii2D"]:
+        assert torch.equal(getattr(plain, name), getattr(pooled, name)), name
+
+
+def activation_loss(gaussians):
+    return gaussians.get_scaling.sum() + gaussians.get_rotation.sum() + gaussians.get_opacity.sum() + gaussians.get_features.sum()
+
+
+def test_activation_cache_survives_backward_without_step():
+    gaussians = make_model(False)
+    # two forward/backward passes with no parameter update in between must not reuse a freed graph
+    activation_loss(gaussians).backward()
+    activation_loss(gaussians).backward()
+    grad = gaussians._scaling.grad.clone()
+    gaussians.optimizer.zero_grad(set_to_none=True)
+    activation_loss(gaussians).backward()
+    assert torch.allclose(2 * gaussians._scaling.grad, grad)
+
+
+def test_activation_cache_cleared_by_optimizer_step():
+    gaussians = make_model(False)
+    with torch.no_grad():
+        before = gaussians.get_opacity
+    optimizer_step(gaussians, 0)
+    with torch.no_grad():
+        after = gaussians.get_opacity
+    assert after is not before
+    assert torch.equal(after, gaussians.opacity_activation(gaussians._opacity))
+
+
+def test_load_ply_views_mapped_columns(tmp_path):
+    gaussians = make_model(False, num_pts=50)
+    path = str(tmp_path / "point_cloud.ply")
+    gaussians.save_ply(path, rgb_dump="none")
+
+    matrix, names = load_vertex_matrix(path)
+    base = torch.from_numpy(matrix).untyped_storage().data_ptr()
+    # save_ply writes every attribute group in consecutive columns, so none of them is copied out of the map
+    for attribute in gaussians.attributes_from_vertex_matrix(matrix, names):
+        assert attribute.untyped_storage().data_ptr() == base
+
+    loaded = GaussianModel(1, device="cpu")
+    loaded.load_ply(path)
+    for name in ["_xyz", "_features_dc", "_features_rest", "_opacity", "_scaling", "_rotation"]:
+        assert torch.equal(getattr(loaded, name), getattr(gaussians, name)), name
+
+
+def test_read_ply_header_rejects_property_before_element(tmp_path):
+    path = tmp_path / "bad.ply"
+    path.write_bytes(b"ply\nformat binary_little_endian 1.0\nproperty float x\nelement vertex 1\nend_header\n")
+    with pytest.raises(ValueError, match="property before element"):
+        read_ply_header(str(path))
+
+
+def test_capture_of_pooled_model_is_compact():
+    gaussians = make_model(True)
+    optimizer_step(gaussians, 0)
+    densify_cycle(gaussians, 1)
+    captured = gaussians.capture()
+    tensors = [t for t in captured if torch.is_tensor(t)]
+    tensors += [v for state in captured[10]["state"].values() for v in state.values() if torch.is_tensor(v)]
+    # torch.save writes whole storages, so none of them may carry unused pool capacity
+    for tensor in tensors:
+        assert tensor.untyped_storage().nbytes() == tensor.numel() * tensor.element_size()
+
+    expected = state(gaussians)
+    restored = GaussianModel(1, device="cpu")
+    opt = OptimizationParams(ArgumentParser())
+    opt.pooled_densification = True
+    restored.restore(captured, opt)
+    for name in NAMES:
+        for a, b in zip(expected[name], state(restored)[name]):
+            assert torch.equal(a, b), name
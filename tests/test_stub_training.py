@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+yaml = pytest.importorskip("yaml")
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def stub_config(tmp_path, **overrides):
+    with open(os.path.join(REPO, "configs", "stub_cpu.yaml")) as f:
+        opts = yaml.load(f, Loader=yaml.FullLoader)
+    opts["port"] = 0
+    opts["ModelParams"]["workspace"] = "stub_smoke"
+    opts["GuidanceParams"]["profile_interval"] = 2
+    opts["OptimizationParams"].update(iterations=6, densify_from_iter=2, densify_until_iter=6, densification_interval=2,
+                                      opacity_reset_interval=4, progressive_view_iter=2, scale_up_cameras_iter=2)
+    for group, values in overrides.items():
+        opts[group].update(values)
+    path = tmp_path / "stub_smoke.yaml"
+    with open(path, "w") as f:
+        yaml.dump(opts, f)
+    return path
+
+
+@pytest.mark.parametrize("batch,cfg", [(1, 1.0), (2, 1.0), (3, 7.5)])
+def test_stub_training_runs_on_cpu(tmp_path, batch, cfg):
+    config = stub_config(tmp_path, GuidanceParams={"C_batch_size": batch, "denoise_guidance_scale": cfg})
+    result = subprocess.run([sys.executable, os.path.join(REPO, "train.py"), "--opt", str(config), "--test_ratio", "2"],
+                            cwd=tmp_path, capture_output=True, text=True, timeout=900)
+    assert result.returncode == 0, result.stdout[-4000:] + result.stderr[-4000:]
+    assert "Training complete." in result.stdout
+    assert os.path.exists(tmp_path / "output" / "stub_smoke" / "point_cloud" / "iteration_6" / "point_cloud.ply")
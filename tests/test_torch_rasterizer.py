@@ -0,0 +1,104 @@
+import math
+
+import pytest
+
+torch = pytest.importorskip("torch")
+np = pytest.importorskip("numpy")
+
+from gaussian_renderer import torch_rasterizer
+from gaussian_renderer.torch_rasterizer import GaussianRasterizationSettings, GaussianRasterizer, preprocess, BLOCK_X, BLOCK_Y
+from utils.graphics_utils import getWorld2View2, getProjectionMatrix
+
+H, W = 40, 56
+FOV = 0.8
+
+
+def make_settings(device):
+    world_view = torch.tensor(getWorld2View2(np.eye(3), np.array([0.0, 0.0, 4.0]))).transpose(0, 1).to(device)
+    projection = getProjectionMatrix(znear=0.01, zfar=100.0, fovX=FOV, fovY=FOV).transpose(0, 1).to(device)
+    return GaussianRasterizationSettings(image_height=H, image_width=W, tanfovx=math.tan(FOV * 0.5), tanfovy=math.tan(FOV * 0.5),
+                                         bg=torch.tensor([0.2, 0.4, 0.6], device=device), scale_modifier=1.0,
+                                         viewmatrix=world_view, projmatrix=world_view @ projection, sh_degree=0,
+                                         campos=world_view.inverse()[3, :3], prefiltered=False)
+
+
+def make_gaussians(device, num=80):
+    generator = torch.Generator().manual_seed(0)
+    tensors = {
+        "means3D": torch.rand((num, 3), generator=generator) * 2 - 1,
+        "opacities": torch.rand((num, 1), generator=generator) * 0.9 + 0.05,
+        "shs": torch.randn((num, 1, 3), generator=generator),
+        "scales": torch.rand((num, 3), generator=generator) * 0.15 + 0.02,
+        "rotations": torch.nn.functional.normalize(torch.randn((num, 4), generator=generator), dim=-1),
+    }
+    return {k: v.to(device).requires_grad_(True) for k, v in tensors.items()}
+
+
+def dense_reference(settings, means3D, opacities, shs, scales, rotations):
+    # every pixel composites every Gaussian whose tile rectangle covers it, in depth order, with no tiling or chunking
+    means2D = torch.zeros_like(means3D)
+    xy, conic, opacity, colors, depths, radii, rect = preprocess(means3D, means2D, opacities, shs, None, scales, rotations, None, settings)
+    idx = torch.nonzero(radii > 0).squeeze(1)
+    idx = idx[torch.argsort(depths[idx])]
+    ys, xs = torch.meshgrid(torch.arange(H, device=xy.device), torch.arange(W, device=xy.device), indexing='ij')
+    pix = torch.stack([xs.reshape(-1), ys.reshape(-1)], dim=-1).to(xy.dtype)
+    tile_x, tile_y = (pix[:, 0] // BLOCK_X).long()[:, None], (pix[:, 1] // BLOCK_Y).long()[:, None]
+    r = rect[idx]
+    inside = (tile_x >= r[:, 0]) & (tile_x < r[:, 2]) & (tile_y >= r[:, 1]) & (tile_y < r[:, 3])
+
+    d = xy[idx][None] - pix[:, None]
+    con = conic[idx][None]
+    power = -0.5 * (con[..., 0] * d[..., 0] * d[..., 0] + con[..., 2] * d[..., 1] * d[..., 1]) - con[..., 1] * d[..., 0] * d[..., 1]
+    alpha = torch.clamp_max(opacity[idx][None] * torch.exp(power.clamp_max(0.0)), 0.99)
+    alpha = torch.where(inside & (power <= 0.0) & (alpha >= 1.0 / 255.0), alpha, torch.zeros_like(alpha))
+    with torch.no_grad():
+        contrib = torch.cumprod(1 - alpha, dim=-1) >= 0.0001
+    alpha = alpha * contrib
+    trans = torch.cumprod(1 - alpha, dim=-1)
+    weights = alpha * torch.cat([torch.ones_like(trans[:, :1]), trans[:, :-1]], dim=-1)
+
+    T = trans[:, -1].view(1, H, W)
+    color = (weights @ colors[idx]).t().view(-1, H, W) + T * settings.bg.view(-1, 1, 1)
+    depth = (weights @ depths[idx]).view(1, H, W)
+    return color, radii, torch.cat([depth, T], dim=0)
+
+
+def loss_and_grads(outputs, gaussians):
+    color, _, depth_alpha = outputs
+    generator = torch.Generator().manual_seed(1)
+    loss = (color * torch.rand(color.shape, generator=generator).to(color.device)).sum() + \
+           (depth_alpha * torch.rand(depth_alpha.shape, generator=generator).to(color.device)).sum()
+    return torch.autograd.grad(loss, list(gaussians.values()))
+
+
+@pytest.mark.parametrize("tiles_per_chunk,depth_chunk", [(64, 64), (2, 4), (5, 1)])
+def test_tile_rasterizer_matches_dense_reference(tiles_per_chunk, depth_chunk):
+    settings = make_settings("cpu")
+    gaussians = make_gaussians("cpu")
+    rasterizer = GaussianRasterizer(settings, tiles_per_chunk=tiles_per_chunk, depth_chunk=depth_chunk)
+    outputs = rasterizer(means2D=torch.zeros_like(gaussians["means3D"]), **gaussians)
+    reference = dense_reference(settings, **gaussians)
+
+    assert (outputs[1] > 0).sum() > 0
+    assert torch.equal(outputs[1], reference[1])
+    for actual, expected in [(outputs[0], reference[0]), (outputs[2], reference[2])]:
+        torch.testing.assert_close(actual, expected, rtol=1e-5, atol=1e-5)
+    for actual, expected in zip(loss_and_grads(outputs, gaussians), loss_and_grads(reference, gaussians)):
+        torch.testing.assert_close(actual, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason="needs CUDA")
+def test_tile_rasterizer_matches_cuda_rasterizer():
+    diff_rasterization = pytest.importorskip("diff_gaussian_rasterization")
+    settings = make_settings("cuda")
+    gaussians = make_gaussians("cuda")
+    means2D = torch.zeros_like(gaussians["means3D"])
+    outputs = torch_rasterizer.GaussianRasterizer(settings)(means2D=means2D, **gaussians)
+    cuda_settings = diff_rasterization.GaussianRasterizationSettings(**settings._asdict())
+    expected = diff_rasterization.GaussianRasterizer(cuda_settings)(means2D=means2D, **gaussians)
+
+    assert torch.equal(outputs[1], expected[1])
+    for actual, reference in [(outputs[0], expected[0]), (outputs[2], expected[2])]:
+        torch.testing.assert_close(actual, reference, rtol=1e-3, atol=1e-3)
+    for actual, reference in zip(loss_and_grads(outputs, gaussians), loss_and_grads(expected, gaussians)):
+        torch.testing.assert_close(actual, reference, rtol=1e-2, atol=1e-3)
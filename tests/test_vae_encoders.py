@@ -0,0 +1,41 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+pytest.importorskip("diffusers")
+
+from guidance.vae_encoders import memory_efficient_encode
+
+
+def patch_encoder():
+    # one latent pixel per 8x8 image patch, so tiles and their blend reproduce the full encode exactly;
+    # the SDXL VAE normalizes and attends over the whole image, so its tiled encode is only approximate
+    torch.manual_seed(0)
+    return torch.nn.Sequential(torch.nn.Conv2d(3, 8, 8, stride=8), torch.nn.Tanh(), torch.nn.Conv2d(8, 4, 1))
+
+
+def encode_with_grad(fn, imgs, **kwargs):
+    imgs = imgs.clone().requires_grad_(True)
+    latents = memory_efficient_encode(fn, imgs, **kwargs)
+    weights = torch.linspace(-1, 1, latents.numel()).view_as(latents)
+    grad, = torch.autograd.grad((latents * weights).sum(), imgs)
+    return latents, grad
+
+
+@pytest.mark.parametrize("kwargs", [dict(mode="checkpoint", batch_size=1), dict(mode="checkpoint", batch_size=2),
+                                    dict(mode="tiled", tile_size=32, overlap=16), dict(mode="tiled", tile_size=48, overlap=8),
+                                    dict(mode="tiled", tile_size=128, overlap=0)])
+def test_memory_efficient_encode_matches_default(kwargs):
+    fn = patch_encoder()
+    imgs = torch.rand((3, 3, 64, 80), generator=torch.Generator().manual_seed(1))
+    expected, expected_grad = encode_with_grad(fn, imgs)
+    latents, grad = encode_with_grad(fn, imgs, **kwargs)
+    torch.testing.assert_close(latents, expected, rtol=1e-5, atol=1e-6)
+    torch.testing.assert_close(grad, expected_grad, rtol=1e-5, atol=1e-6)
+
+
+@pytest.mark.parametrize("kwargs,size", [(dict(tile_size=36, overlap=8), 64), (dict(tile_size=32, overlap=12), 64),
+                                         (dict(tile_size=32, overlap=32), 64), (dict(tile_size=32, overlap=8), 60)])
+def test_tiled_encode_rejects_off_grid_tiles(kwargs, size):
+    imgs = torch.rand((1, 3, size, size), requires_grad=True)
+    with pytest.raises(ValueError):
+        memory_efficient_encode(patch_encoder(), imgs, mode="tiled", **kwargs)
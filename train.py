@@ -10,22 +10,24 @@
 #
 
 import random
-import imageio
 import os
 import torch
 import torch.nn as nn
 from random import randint
 from utils.loss_utils import l1_loss, ssim, tv_loss
-from gaussian_renderer import render, network_gui
+from gaussian_renderer import render, render_batch, network_gui
 import sys
 from scene import Scene, GaussianModel
+from scene.camera_prefetcher import CameraPrefetcher
 from utils.general_utils import safe_state
+from utils.video_utils import VideoWriter
+from utils.profile_utils import timing_event
+from guidance.view_embeddings import ViewEmbeddingTable
 import uuid
 from tqdm import tqdm
 from utils.image_utils import psnr
 from argparse import ArgumentParser, Namespace
 from arguments import ModelParams, PipelineParams, OptimizationParams, GenerateCamParams, GuidanceParams
-import math
 from torchvision.utils import save_image
 import torchvision.transforms as T
 import gc
@@ -37,85 +39,20 @@ try:
 except ImportError:
     TENSORBOARD_FOUND = False
 
-def adjust_text_embeddings(embeddings, azimuth, guidance_opt):
-    #TODO: add prenerg functions
-    text_z_list = []
-    weights_list = []
-    K = 0
-    #for b in range(azimuth):
-    text_z_, weights_ = get_pos_neg_text_embeddings(embeddings, azimuth, guidance_opt)
-    K = max(K, weights_.shape[0])
-    text_z_list.append(text_z_)
-    weights_list.append(weights_)
-
-    # Interleave text_embeddings from different dirs to form a batch
-    text_embeddings = []
-    for i in range(K):
-        for text_z in text_z_list:
-            # if uneven length, pad with the first embedding
-            text_embeddings.append(text_z[i] if i < len(text_z) else text_z[0])
-    text_embeddings = torch.stack(text_embeddings, dim=0) # [B * K, 77, 768]
-
-    # Interleave weights from different dirs to form a batch
-    weights = []
-    for i in range(K):
-        for weights_ in weights_list:
-            weights.append(weights_[i] if i < len(weights_) else torch.zeros_like(weights_[0]))
-    weights = torch.stack(weights, dim=0) # [B * K]
-    return text_embeddings, weights
-
-def get_pos_neg_text_embeddings(embeddings, azimuth_val, opt):
-    if azimuth_val >= -90 and azimuth_val < 90:
-        if azimuth_val >= 0:
-            r = 1 - azimuth_val / 90
-        else:
-            r = 1 + azimuth_val / 90
-        start_z = embeddings['front']
-        end_z = embeddings['side']
-        # if random.random() < 0.3:
-        #     r = r + random.gauss(0, 0.08)
-        pos_z = r * start_z + (1 - r) * end_z
-        text_z = torch.cat([pos_z, embeddings['front'], embeddings['side']], dim=0)
-        if r > 0.8:
-            front_neg_w = 0.0
-        else:
-            front_neg_w = math.exp(-r * opt.front_decay_factor) * opt.negative_w
-        if r < 0.2:
-            side_neg_w = 0.0
-        else:
-            side_neg_w = math.exp(-(1-r) * opt.side_decay_factor) * opt.negative_w
-
-        weights = torch.tensor([1.0, front_neg_w, side_neg_w])
-    else:
-        if azimuth_val >= 0:
-            r = 1 - (azimuth_val - 90) / 90
-        else:
-            r = 1 + (azimuth_val + 90) / 90
-        start_z = embeddings['side']
-        end_z = embeddings['back']
-        # if random.random() < 0.3:
-        #     r = r + random.gauss(0, 0.08)
-        pos_z = r * start_z + (1 - r) * end_z
-        text_z = torch.cat([pos_z, embeddings['side'], embeddings['front']], dim=0)
-        front_neg_w = opt.negative_w 
-        if r > 0.8:
-            side_neg_w = 0.0
-        else:
-            side_neg_w = math.exp(-r * opt.side_decay_factor) * opt.negative_w / 2
-
-        weights = torch.tensor([1.0, side_neg_w, front_neg_w])
-    return text_z, weights.to(text_z.device)
+def embedding_prompts(guidance_opt):
+    # name -> prompt for every text embedding the training needs
+    prompts = {'default': [guidance_opt.text], 'uncond': [guidance_opt.negative]}
+    for d in ['front', 'side', 'back']:
+        prompts[d] = [f"{guidance_opt.text}, {d} view"]
+    prompts['inverse_text'] = guidance_opt.inverse_text
+    return prompts
 
 def prepare_embeddings(guidance_opt, guidance):
     embeddings = {}
     embeddings_0 = {}
     # text embeddings (stable-diffusion) and (IF)
-    embeddings_0['default'], embeddings['default'] = guidance.get_text_embeds([guidance_opt.text])
-    embeddings_0['uncond'], embeddings['uncond'] = guidance.get_text_embeds([guidance_opt.negative])
-
-    for d in ['front', 'side', 'back']:
-        embeddings_0[d], embeddings[d] = guidance.get_text_embeds([f"{guidance_opt.text}, {d} view"])
-    embeddings_0['inverse_text'], embeddings['inverse_text'] = guidance.get_text_embeds(guidance_opt.inverse_text)
+    for name, prompt in embedding_prompts(guidance_opt).items():
+        embeddings_0[name], embeddings[name] = guidance.get_text_embeds(prompt)
     del guidance.text_encoder
     del guidance.text_encoder_2
     gc.collect()
@@ -123,15 +60,20 @@ def prepare_embeddings(guidance_opt, guidance):
     return embeddings_0, embeddings
 
 def guidance_setup(guidance_opt):
-    if guidance_opt.guidance=="SD":
-        from guidance.sd_utils import StableDiffusion
+    if guidance_opt.guidance in ["SD", "stub"]:
+        if guidance_opt.guidance == "SD":
+            from guidance.sd_utils import StableDiffusion
+        else:
+            # tiny random models with the same interface, for exercising the loop without SDXL or a GPU
+            from guidance.stub_utils import StubDiffusion as StableDiffusion
         guidance = StableDiffusion(guidance_opt.g_device, guidance_opt.fp16, guidance_opt.vram_O, 
                                    guidance_opt.t_range, guidance_opt.max_t_range, 
                                    num_train_timesteps=guidance_opt.num_train_timesteps, 
                                    ddim_inv=guidance_opt.ddim_inv,
                                    textual_inversion_path = guidance_opt.textual_inversion_path,
                                    LoRA_path = guidance_opt.LoRA_path,
-                                   guidance_opt=guidance_opt)
+                                   guidance_opt=guidance_opt,
+                                   prompts=list(embedding_prompts(guidance_opt).values()))
     else:
         raise ValueError(f'{guidance_opt.guidance} not supported.')
     if guidance is not None:
@@ -144,7 +86,7 @@ def guidance_setup(guidance_opt):
 def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving_iterations, checkpoint_iterations, checkpoint, debug_from, save_video):
     first_iter = 0
     tb_writer = prepare_output_and_logger(dataset)
-    gaussians = GaussianModel(dataset.sh_degree)
+    gaussians = GaussianModel(dataset.sh_degree, dataset.data_device)
     scene = Scene(dataset, gcams, gaussians)
     gaussians.training_setup(opt)
     if checkpoint:
@@ -153,8 +95,8 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
 
     bg_color = [1, 1, 1] if dataset._white_background else [0, 0, 0]
     background = torch.tensor(bg_color, dtype=torch.float32, device=dataset.data_device)
-    iter_start = torch.cuda.Event(enable_timing = True)
-    iter_end = torch.cuda.Event(enable_timing = True)
+    iter_start = timing_event(dataset.data_device)
+    iter_end = timing_event(dataset.data_device)
 
     #
     save_folder = os.path.join(dataset._model_path,"train_process/")
@@ -165,7 +107,12 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
     use_control_net = False
     #set up pretrain diffusion models and text_embedings 
     guidance, embeddings, embeddings_0 = guidance_setup(guidance_opt) 
+    profiler = guidance.profiler
+    view_embeddings = ViewEmbeddingTable(embeddings, guidance_opt, guidance_opt.view_embedding_bins)
+    view_embeddings_0 = ViewEmbeddingTable(embeddings_0, guidance_opt, guidance_opt.view_embedding_bins)
     viewpoint_stack = None
+    viewpoint_order = []
+    camera_source = CameraPrefetcher(scene, dataset.camera_prefetch) if dataset.camera_prefetch > 0 else None
     viewpoint_stack_around = None
     ema_loss_for_log = 0.0
     progress_bar = tqdm(range(first_iter, opt.iterations), desc="Training progress")
@@ -175,9 +122,10 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
         save_folder_proc = os.path.join(scene.args._model_path,"process_videos/")
         if not os.path.exists(save_folder_proc):
             os.makedirs(save_folder_proc)  # makedirs
-        process_view_points = scene.getCircleVideoCameras(batch_size=opt.pro_frames_num,render45=opt.pro_render_45).copy()    
+        process_view_points = scene.getCircleVideoCameras(batch_size=opt.pro_frames_num,render45=opt.pro_render_45)
         save_process_iter = opt.iterations // len(process_view_points)
-        pro_img_frames = []
+        process_view_index = 0
+        process_video = VideoWriter(os.path.join(save_folder_proc, "video_rgb.mp4"), fps=30, quality=8)
 
     for iteration in range(first_iter, opt.iterations + 1):        
         #TODO: DEBUG NETWORK_GUI
@@ -186,7 +134,7 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
         while network_gui.conn != None:
             try:
                 net_image_bytes = None
-                custom_cam, do_training, pipe.convert_SHs_python, pipe.compute_cov3D_python, keep_alive, scaling_modifer = network_gui.receive()
+                custom_cam, do_training, pipe.convert_SHs_python, pipe.compute_cov3D_python, keep_alive, scaling_modifer = network_gui.receive(dataset.data_device)
                 if custom_cam != None:
                     net_image = render(custom_cam, gaussians, pipe, background, scaling_modifer)["render"]
                     net_image_bytes = memoryview((torch.clamp(net_image, min=0, max=1.0) * 255).byte().permute(1, 2, 0).contiguous().cpu().numpy())
@@ -228,89 +176,36 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
                 print('scale up fovy_range to:', scene.pose_args.fovy_range)
 
         # Pick a random Camera
-        if not viewpoint_stack:
-            viewpoint_stack = scene.getRandTrainCameras().copy()         
-        
         C_batch_size = guidance_opt.C_batch_size
         viewpoint_cams = []
-        images = []
-        text_z_ = []
-        text_z_0_ = []
-        weights_ = []
-        depths = []
-        alphas = []
-        scales = []
 
         text_z_inverse = torch.cat([embeddings['uncond'],embeddings['inverse_text']], dim=0)
         text_z_inverse_0 = torch.cat([embeddings_0['uncond'],embeddings_0['inverse_text']], dim=0)
 
-        for i in range(C_batch_size):
-            try:
-                viewpoint_cam = viewpoint_stack.pop(randint(0, len(viewpoint_stack)-1))            
-            except:
-                viewpoint_stack = scene.getRandTrainCameras().copy()
-                viewpoint_cam = viewpoint_stack.pop(randint(0, len(viewpoint_stack)-1))
-                
-            #pred text_z
-            azimuth = viewpoint_cam.delta_azimuth
-            text_z = [embeddings['uncond']]
-            text_z_0 = [embeddings_0['uncond']]
-
-
-            if guidance_opt.perpneg:
-                text_z_comp, _ = adjust_text_embeddings(embeddings, azimuth, guidance_opt)
-                text_z_0_comp, weights = adjust_text_embeddings(embeddings_0, azimuth, guidance_opt)
-                text_z.append(text_z_comp)
-                text_z_0.append(text_z_0_comp)
-                weights_.append(weights)
-
-            else:                
-                if azimuth >= -90 and azimuth < 90:
-                    if azimuth >= 0:
-                        r = 1 - azimuth / 90
-                    else:
-                        r = 1 + azimuth / 90
-                    start_z = embeddings['front']
-                    end_z = embeddings['side']
-                    start_z_0 = embeddings_0['front']
-                    end_z_0 = embeddings_0['side']
-                else:
-                    if azimuth >= 0:
-                        r = 1 - (azimuth - 90) / 90
-                    else:
-                        r = 1 + (azimuth + 90) / 90
-                    start_z = embeddings['side']
-                    end_z = embeddings['back']
-                    start_z_0 = embeddings_0['side']
-                    end_z_0 = embeddings_0['back']
-                text_z.append(r * start_z + (1 - r) * end_z)
-                text_z_0.append(r * start_z_0 + (1 - r) * end_z_0)
-
-            text_z = torch.cat(text_z, dim=0)
-            text_z_.append(text_z)
-            text_z_0 = torch.cat(text_z_0, dim=0)
-            text_z_0_.append(text_z_0)
-
-            # Render
-            if (iteration - 1) == debug_from:
-                pipe.debug = True
-            render_pkg = render(viewpoint_cam, gaussians, pipe, background, 
-                                sh_deg_aug_ratio = dataset.sh_deg_aug_ratio, 
-                                bg_aug_ratio = dataset.bg_aug_ratio, 
-                                shs_aug_ratio = dataset.shs_aug_ratio, 
-                                scale_aug_ratio = dataset.scale_aug_ratio)
-            image, viewspace_point_tensor, visibility_filter, radii = render_pkg["render"], render_pkg["viewspace_points"], render_pkg["visibility_filter"], render_pkg["radii"]
-            depth, alpha = render_pkg["depth"], render_pkg["alpha"]
-
-            scales.append(render_pkg["scales"])
-            images.append(image)
-            depths.append(depth)
-            alphas.append(alpha)
-            viewpoint_cams.append(viewpoint_cams)
-
-        images = torch.stack(images, dim=0)
-        depths = torch.stack(depths, dim=0)
-        alphas = torch.stack(alphas, dim=0)
+        with profiler.phase("cameras"):
+            for i in range(C_batch_size):
+                # draw without replacement through a shuffled order, refilling the camera batch when it runs out
+                if not viewpoint_order:
+                    viewpoint_stack = camera_source.next() if camera_source is not None else scene.getRandTrainCameras()
+                    viewpoint_order = torch.randperm(len(viewpoint_stack)).tolist()
+                viewpoint_cams.append(viewpoint_stack[viewpoint_order.pop()])
+
+        # view-dependent text embeddings [1 + K, B, ...] for the whole batch
+        azimuths = [viewpoint_cam.delta_azimuth for viewpoint_cam in viewpoint_cams]
+        text_z_, weights_ = view_embeddings.lookup(azimuths)
+        text_z_0_, _ = view_embeddings_0.lookup(azimuths)
+
+        # Render
+        if (iteration - 1) == debug_from:
+            pipe.debug = True
+        with profiler.phase("render"):
+            render_pkg = render_batch(viewpoint_cams, gaussians, pipe, background, 
+                                      sh_deg_aug_ratio = dataset.sh_deg_aug_ratio, 
+                                      bg_aug_ratio = dataset.bg_aug_ratio, 
+                                      shs_aug_ratio = dataset.shs_aug_ratio, 
+                                      scale_aug_ratio = dataset.scale_aug_ratio)
+        images, depths, alphas, scales = render_pkg["render"], render_pkg["depth"], render_pkg["alpha"], render_pkg["scales"]
+        viewspace_point_tensor, visibility_filter, radii = render_pkg["viewspace_points"], render_pkg["visibility_filter"], render_pkg["radii"]
 
         # Loss
         warm_up_rate = 1. - min(iteration/opt.warmup_iter,1.)
@@ -320,22 +215,22 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
             _aslatent=True
         if iteration > opt.use_control_net_iter and (random.random() < guidance_opt.controlnet_ratio):
             use_control_net = True
-        if guidance_opt.perpneg:
-            loss = guidance.train_step_perpneg(torch.stack(text_z_0_, dim=1), torch.stack(text_z_, dim=1), images,
-                                                pred_depth=depths, pred_alpha=alphas,
-                                                grad_scale=guidance_opt.lambda_guidance,
-                                                use_control_net = use_control_net ,save_folder = save_folder,  iteration = iteration, warm_up_rate=warm_up_rate, 
-                                                weights = torch.stack(weights_, dim=1), resolution=(gcams.image_h, gcams.image_w),
-                                                guidance_opt=guidance_opt,as_latent=_aslatent, embedding_inverse = text_z_inverse, embedding_inverse_0 = text_z_inverse_0)
-        else:
-            loss = guidance.train_step(torch.stack(text_z_0_, dim=1), torch.stack(text_z_, dim=1), images, 
-                                    pred_depth=depths, pred_alpha=alphas,
-                                    grad_scale=guidance_opt.lambda_guidance,
-                                    use_control_net = use_control_net ,save_folder = save_folder,  iteration = iteration, warm_up_rate=warm_up_rate, 
-                                    resolution=(gcams.image_h, gcams.image_w),
-                                    guidance_opt=guidance_opt,as_latent=_aslatent, embedding_inverse = text_z_inverse, embedding_inverse_0 = text_z_inverse_0)
-            #raise ValueError(f'original version not supported.')
-        scales = torch.stack(scales, dim=0)
+        with profiler.phase("guidance"):
+            if guidance_opt.perpneg:
+                loss = guidance.train_step_perpneg(text_z_0_, text_z_, images,
+                                                    pred_depth=depths, pred_alpha=alphas,
+                                                    grad_scale=guidance_opt.lambda_guidance,
+                                                    use_control_net = use_control_net ,save_folder = save_folder,  iteration = iteration, warm_up_rate=warm_up_rate, 
+                                                    weights = weights_, resolution=(gcams.image_h, gcams.image_w),
+                                                    guidance_opt=guidance_opt,as_latent=_aslatent, embedding_inverse = text_z_inverse, embedding_inverse_0 = text_z_inverse_0)
+            else:
+                loss = guidance.train_step(text_z_0_, text_z_, images, 
+                                        pred_depth=depths, pred_alpha=alphas,
+                                        grad_scale=guidance_opt.lambda_guidance,
+                                        use_control_net = use_control_net ,save_folder = save_folder,  iteration = iteration, warm_up_rate=warm_up_rate, 
+                                        resolution=(gcams.image_h, gcams.image_w),
+                                        guidance_opt=guidance_opt,as_latent=_aslatent, embedding_inverse = text_z_inverse, embedding_inverse_0 = text_z_inverse_0)
+                #raise ValueError(f'original version not supported.')
 
         loss_scale = torch.mean(scales,dim=-1).mean()
         loss_tv = tv_loss(images) + tv_loss(depths)
@@ -371,20 +266,22 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
 
 
         loss = loss + opt.lambda_tv * loss_tv + opt.lambda_scale * loss_scale #+ opt.lambda_bin * loss_bin
-        loss.backward()
+        with profiler.phase("backward"):
+            loss.backward()
         iter_end.record()
 
         with torch.no_grad():
             # Progress bar
             ema_loss_for_log = 0.4 * loss.item() + 0.6 * ema_loss_for_log
             if opt.save_process:
-                if iteration % save_process_iter == 0 and len(process_view_points) > 0:
-                    viewpoint_cam_p = process_view_points.pop(0)
+                if iteration % save_process_iter == 0 and process_view_index < len(process_view_points):
+                    viewpoint_cam_p = process_view_points[process_view_index]
+                    process_view_index += 1
                     render_p = render(viewpoint_cam_p, gaussians, pipe, background, test=True)
                     img_p = torch.clamp(render_p["render"], 0.0, 1.0) 
                     img_p = img_p.detach().cpu().permute(1,2,0).numpy()
                     img_p = (img_p * 255).round().astype('uint8')
-                    pro_img_frames.append(img_p)  
+                    process_video.append(img_p)
 
             if iteration % 10 == 0:
                 progress_bar.set_postfix({"Loss": f"{ema_loss_for_log:.{7}f}"})
@@ -394,6 +291,11 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
 
             # Log and save
             training_report(tb_writer, iteration, iter_start.elapsed_time(iter_end), testing_iterations, scene, render, (pipe, background))
+            if guidance_opt.profile and iteration % guidance_opt.profile_interval == 0:
+                if tb_writer:
+                    for name, value in profiler.summary().items():
+                        tb_writer.add_scalar("profile/" + name, value, iteration)
+                profiler.reset()
             if (iteration in testing_iterations):
                 if save_video:
                     video_inference(iteration, scene, render, (pipe, background))
@@ -404,8 +306,8 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
 
             # Densification
             if iteration < opt.densify_until_iter:
-                # Keep track of max radii in image-space for pruning
-                gaussians.max_radii2D[visibility_filter] = torch.max(gaussians.max_radii2D[visibility_filter], radii[visibility_filter])
+                # Keep track of max radii in image-space for pruning, over every view of the batch
+                gaussians.add_max_radii2D(radii)
                 gaussians.add_densification_stats(viewspace_point_tensor, visibility_filter)
 
                 if iteration > opt.densify_from_iter and iteration % opt.densification_interval == 0:
@@ -426,7 +328,10 @@ def training(dataset, opt, pipe, gcams, guidance_opt, testing_iterations, saving
                 torch.save((gaussians.capture(), iteration), scene._model_path + "/chkpnt" + str(iteration) + ".pth")
 
     if opt.save_process:
-        imageio.mimwrite(os.path.join(save_folder_proc, "video_rgb.mp4"), pro_img_frames, fps=30, quality=8)
+        process_video.close()
+    if camera_source is not None:
+        camera_source.close()
+    guidance.close()
 
 
 
@@ -496,8 +401,8 @@ def video_inference(iteration, scene : Scene, renderFunc, renderArgs):
     torch.cuda.empty_cache()
     config = ({'name': 'test', 'cameras' : scene.getCircleVideoCameras()})
     if config['cameras'] and len(config['cameras']) > 0:
-        img_frames = []
-        depth_frames = []
+        img_video = VideoWriter(os.path.join(save_folder, "video_rgb_{}.mp4".format(iteration)), fps=30, quality=8)
+        depth_video = VideoWriter(os.path.join(save_folder, "video_depth_{}.mp4".format(iteration)), fps=30, quality=8)
         print("Generating Video using", len(config['cameras']), "different view points")
         for idx, viewpoint in enumerate(config['cameras']):
             render_out = renderFunc(viewpoint, scene.gaussians, *renderArgs, test=True)
@@ -507,17 +412,16 @@ def video_inference(iteration, scene : Scene, renderFunc, renderArgs):
                 depths = torch.clamp(depth_norm, 0.0, 1.0) 
                 depths = depths.detach().cpu().permute(1,2,0).numpy()
                 depths = (depths * 255).round().astype('uint8')          
-                depth_frames.append(depths)    
+                depth_video.append(depths)    
   
             image = torch.clamp(rgb, 0.0, 1.0) 
             image = image.detach().cpu().permute(1,2,0).numpy()
             image = (image * 255).round().astype('uint8')
-            img_frames.append(image)    
+            img_video.append(image)    
             #save_image(image,os.path.join(save_folder,"lora_view_{}.jpg".format(viewpoint.uid)))   
-        # Img to Numpy
-        imageio.mimwrite(os.path.join(save_folder, "video_rgb_{}.mp4".format(iteration)), img_frames, fps=30, quality=8)
-        if len(depth_frames) > 0:
-            imageio.mimwrite(os.path.join(save_folder, "video_depth_{}.mp4".format(iteration)), depth_frames, fps=30, quality=8)
+        # frames are encoded while rendering, closing only flushes the tail
+        img_video.close()
+        depth_video.close()
         print("\n[ITER {}] Video Save Done!".format(iteration))
     torch.cuda.empty_cache()
 
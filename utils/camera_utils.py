@@ -9,7 +9,9 @@
 # For inquiries contact  george.drettakis@inria.fr
 #
 
-from scene.cameras import Camera, RCamera
+from scene.cameras import Camera, RCamera, CameraBatch
+from scene.dataset_readers import GenerateCircleCamera
+from collections import OrderedDict
 import numpy as np
 from utils.general_utils import PILtoTorch
 from utils.graphics_utils import fov2focal
@@ -75,6 +77,50 @@ def cameraList_from_RcamInfos(cam_infos, resolution_scale, opt, SSAA=False):
 
     return camera_list
 
+class OrbitCameras:
+    """
+    Indexable lazy sequence of the orbit video RCameras (GenerateCircleCameras order). A camera is built from
+    its analytic pose when it is accessed and dropped afterwards; at most cache_size recently used ones are
+    kept, so device memory does not grow with the number of frames.
+    """
+    def __init__(self, opt, size=120, render45=False, resolution_scale=1.0, cache_size=0):
+        self.opt = opt
+        self.size = size
+        self.render45 = render45
+        self.resolution_scale = resolution_scale
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __len__(self):
+        return self.size * 2 if self.render45 else self.size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError("orbit camera index {} out of range for {} frames".format(idx, len(self)))
+        if idx in self.cache:
+            self.cache.move_to_end(idx)
+            return self.cache[idx]
+        camera = loadRandomCam(self.opt, idx, GenerateCircleCamera(self.opt, idx, self.size), self.resolution_scale)
+        if self.cache_size > 0:
+            self.cache[idx] = camera
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return camera
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+def cameraBatch_from_arrays(arrays, resolution_scale, opt, non_blocking=False):
+    # one CameraBatch straight from the stacked pose arrays; they carry the SSAA-scaled size when SSAA is set
+    return CameraBatch(R=arrays.R, T=arrays.T, FoVx=arrays.FovX, FoVy=arrays.FovY,
+                       delta_polar=arrays.delta_polar, delta_azimuth=arrays.delta_azimuth, delta_radius=arrays.delta_radius,
+                       image_width=arrays.width, image_height=arrays.height,
+                       uids=np.arange(len(arrays.R)), data_device=opt.device, non_blocking=non_blocking)
+
 def camera_to_JSON(id, camera : Camera):
     Rt = np.zeros((4, 4))
     Rt[:3, :3] = camera.R.transpose()
@@ -65,7 +65,7 @@ def get_expon_lr_func(
     return helper
 
 def strip_lowerdiag(L):
-    uncertainty = torch.zeros((L.shape[0], 6), dtype=torch.float, device="cuda")
+    uncertainty = torch.zeros((L.shape[0], 6), dtype=torch.float, device=L.device)
 
     uncertainty[:, 0] = L[:, 0, 0]
     uncertainty[:, 1] = L[:, 0, 1]
@@ -83,7 +83,7 @@ def build_rotation(r):
 
     q = r / norm[:, None]
 
-    R = torch.zeros((q.size(0), 3, 3), device='cuda')
+    R = torch.zeros((q.size(0), 3, 3), device=q.device)
 
     r = q[:, 0]
     x = q[:, 1]
@@ -102,7 +102,7 @@ def build_rotation(r):
     return R
 
 def build_scaling_rotation(s, r):
-    L = torch.zeros((s.shape[0], 3, 3), dtype=torch.float, device="cuda")
+    L = torch.zeros((s.shape[0], 3, 3), dtype=torch.float, device=s.device)
     R = build_rotation(r)
 
     L[:,0,0] = s[:,0]
@@ -112,6 +112,18 @@ def build_scaling_rotation(s, r):
     L = R @ L
     return L
 
+def knn_dist2(points, k=3, chunk_size=4096):
+    # Mean squared distance to the k nearest neighbours, same as simple_knn's distCUDA2 but on any device
+    dist2 = torch.empty(points.shape[0], dtype=points.dtype, device=points.device)
+    k = min(k, points.shape[0] - 1)
+    if k <= 0:
+        return dist2.zero_()
+    for start in range(0, points.shape[0], chunk_size):
+        d = torch.cdist(points[start:start + chunk_size], points).square()
+        # the smallest entry of every row is the point itself
+        dist2[start:start + chunk_size] = d.topk(k + 1, dim=1, largest=False).values[:, 1:].mean(dim=1)
+    return dist2
+
 def safe_state(silent, seed=0):
     old_f = sys.stdout
     class F:
@@ -0,0 +1,88 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import numpy as np
+
+# numpy dtype -> ply property type
+PLY_TYPES = {
+    'i1': 'char', 'u1': 'uchar',
+    'i2': 'short', 'u2': 'ushort',
+    'i4': 'int', 'u4': 'uint',
+    'f4': 'float', 'f8': 'double',
+}
+
+def vertex_array(attributes, dtype):
+    # Packs a (N, F) attribute matrix into a structured array, one column at a time
+    elements = np.empty(attributes.shape[0], dtype=dtype)
+    for idx, name in enumerate(elements.dtype.names):
+        elements[name] = attributes[:, idx]
+    return elements
+
+def write_binary_ply(path, elements, element_name='vertex'):
+    # Writes a single-element binary little-endian ply, the body in one buffer
+    header = ["ply", "format binary_little_endian 1.0", "element {} {}".format(element_name, elements.shape[0])]
+    for name in elements.dtype.names:
+        header.append("property {} {}".format(PLY_TYPES[elements.dtype[name].str[1:]], name))
+    header.append("end_header")
+
+    elements = elements.astype(elements.dtype.newbyteorder('<'), copy=False)
+    with open(path, 'wb') as f:
+        f.write(("\n".join(header) + "\n").encode('ascii'))
+        elements.tofile(f)
+
+# ply property type -> numpy dtype
+PLY_DTYPES = {
+    'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+    'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+    'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+    'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8',
+}
+
+def read_ply_header(path):
+    # Returns the format, the element list [(name, count, [(property, dtype)])] and the header size in bytes
+    with open(path, 'rb') as f:
+        if f.readline().strip() != b'ply':
+            raise ValueError("{} is not a ply file".format(path))
+        fmt = None
+        elements = []
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError("Unexpected end of ply header in {}".format(path))
+            tokens = line.decode('ascii').split()
+            if not tokens or tokens[0] in ['comment', 'obj_info']:
+                continue
+            if tokens[0] == 'format':
+                fmt = tokens[1]
+            elif tokens[0] == 'element':
+                elements.append((tokens[1], int(tokens[2]), []))
+            elif tokens[0] == 'property':
+                if not elements:
+                    raise ValueError("Ply property before element in {}".format(path))
+                # list properties have no fixed row size
+                dtype = None if tokens[1] == 'list' else PLY_DTYPES.get(tokens[1])
+                elements[-1][2].append((tokens[-1], dtype))
+            elif tokens[0] == 'end_header':
+                return fmt, elements, f.tell()
+
+def load_vertex_matrix(path):
+    # Memory-maps the vertex body of a binary little-endian, all-float ply as one (N, F) float32 matrix.
+    # Returns (matrix, property names), or None when the file needs the generic PlyData reader.
+    fmt, elements, offset = read_ply_header(path)
+    if fmt != 'binary_little_endian' or len(elements) == 0 or elements[0][0] != 'vertex':
+        return None
+    _, count, properties = elements[0]
+    if count == 0 or any(dtype != 'f4' for _, dtype in properties):
+        return None
+    names = [name for name, _ in properties]
+    # copy-on-write keeps the mapping writable for torch.from_numpy without touching the file
+    matrix = np.memmap(path, dtype='<f4', mode='c', offset=offset, shape=(count, len(names)))
+    return matrix, names
@@ -0,0 +1,107 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+import torch
+
+class CPUEvent:
+    # stand-in for torch.cuda.Event(enable_timing=True) on hosts without CUDA
+    def __init__(self):
+        self.time = None
+
+    def record(self):
+        self.time = time.perf_counter()
+
+    def elapsed_time(self, end_event):
+        return (end_event.time - self.time) * 1000
+
+def timing_event(device):
+    if torch.device(device).type == "cuda":
+        return torch.cuda.Event(enable_timing = True)
+    return CPUEvent()
+
+class PhaseProfiler:
+    """
+    Named phase timers, UNet forward counters and per-phase memory high-water marks.
+    On CUDA, phases are bracketed with events that are only resolved in summary(), so timing adds no syncs;
+    on CPU they use perf_counter. Disabled, phase() is a null context and the counters are no-ops.
+    """
+    def __init__(self, device, enabled=False):
+        self.enabled = enabled
+        self.cuda = torch.device(device).type == "cuda" and torch.cuda.is_available()
+        self.reset()
+
+    def reset(self):
+        self.pending = [] # (name, start, end) CUDA events not read yet
+        self.times = defaultdict(float) # ms
+        self.calls = defaultdict(int)
+        self.peaks = defaultdict(int) # bytes
+        self.unet_forwards = 0
+        self.unet_samples = 0
+        self.stack = []
+
+    def phase(self, name):
+        if not self.enabled:
+            return nullcontext()
+        return self._phase(name)
+
+    @contextmanager
+    def _phase(self, name):
+        frame = {"peak_before": 0}
+        self.stack.append(frame)
+        if self.cuda:
+            # the enclosing phase keeps what it reached so far, the reset below would discard it
+            if len(self.stack) > 1:
+                self.stack[-2]["peak_before"] = max(self.stack[-2]["peak_before"], torch.cuda.max_memory_allocated())
+            torch.cuda.reset_peak_memory_stats()
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+        else:
+            start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self.cuda:
+                end.record()
+                self.pending.append((name, start, end))
+                # the peak since the last reset (at this phase's or its last child's entry), or one recorded before it
+                peak = max(torch.cuda.max_memory_allocated(), frame["peak_before"])
+                self.peaks[name] = max(self.peaks[name], peak)
+            else:
+                self.times[name] += (time.perf_counter() - start) * 1000
+                peak = 0
+            self.calls[name] += 1
+            self.stack.pop()
+            if len(self.stack) > 0:
+                self.stack[-1]["peak_before"] = max(self.stack[-1]["peak_before"], peak)
+
+    def count_unet(self, batch_size):
+        if self.enabled:
+            self.unet_forwards += 1
+            self.unet_samples += batch_size
+
+    def summary(self):
+        # mean ms per call and peak MB per phase, UNet forwards and their mean batch size since the last reset
+        if len(self.pending) > 0:
+            self.pending[-1][2].synchronize()
+            for name, start, end in self.pending:
+                self.times[name] += start.elapsed_time(end)
+            self.pending = []
+        results = {}
+        for name, calls in self.calls.items():
+            results["time/" + name] = self.times[name] / calls
+            if self.cuda:
+                results["peak_memory/" + name] = self.peaks[name] / 2 ** 20
+        results["unet/forwards"] = self.unet_forwards
+        results["unet/mean_batch"] = self.unet_samples / max(self.unet_forwards, 1)
+        return results
@@ -0,0 +1,70 @@
+#
+# Copyright (C) 2023, Inria
+# GRAPHDECO research group, https://team.inria.fr/graphdeco
+# All rights reserved.
+#
+# This software is free for non-commercial, research and evaluation use
+# under the terms of the LICENSE.md file.
+#
+# For inquiries contact  george.drettakis@inria.fr
+#
+
+import queue
+import threading
+import imageio
+
+class VideoWriter:
+    """
+    Streams uint8 (H, W, C) frames into a video from a background thread.
+    The encoder is opened on the first frame; a bounded queue keeps host memory flat.
+    """
+    def __init__(self, path, fps=30, quality=8, max_queue=16):
+        self.path = path
+        self.fps = fps
+        self.quality = quality
+        self.num_frames = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        writer = None
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                break
+            if self.error is not None:
+                # keep draining so producers never block on a dead writer
+                continue
+            try:
+                if writer is None:
+                    writer = imageio.get_writer(self.path, fps=self.fps, quality=self.quality)
+                writer.append_data(frame)
+            except Exception as e:
+                self.error = e
+        if writer is not None:
+            try:
+                writer.close()
+            except Exception as e:
+                self.error = self.error or e
+
+    def append(self, frame):
+        # blocks only when the encoder falls max_queue frames behind
+        if self.error is not None:
+            raise self.error
+        self.queue.put(frame)
+        self.num_frames += 1
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()